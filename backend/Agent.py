@@ -1,9 +1,108 @@
 from abc import ABC, abstractmethod
-from typing import List, Dict, Generator, Union, Optional
-from openai import OpenAI
+from typing import List, Dict, Generator, Union, Optional, Callable
+from openai import OpenAI, AsyncOpenAI
+import httpx
+import importlib.util
+import hashlib
+import json
 import os
+import sqlite3
+import threading
+import time
 from pathlib import Path  # 必须引入 Path
 
+# --- 0. 共享 HTTP 连接池 ---
+# 所有 Agent 复用同一个 httpx.Client：keep-alive 连接跨调用复用，省去每次的 TCP/TLS 握手
+LLM_HTTP_TIMEOUT = httpx.Timeout(60.0, connect=5.0)
+LLM_HTTP_LIMITS = httpx.Limits(max_keepalive_connections=32, max_connections=64)
+
+_shared_http_client: Optional[httpx.Client] = None
+
+def get_shared_http_client() -> httpx.Client:
+    """懒加载全局 httpx.Client (装了 h2 时启用 HTTP/2)"""
+    global _shared_http_client
+    if _shared_http_client is None or _shared_http_client.is_closed:
+        _shared_http_client = httpx.Client(
+            http2=importlib.util.find_spec("h2") is not None,
+            timeout=LLM_HTTP_TIMEOUT,
+            limits=LLM_HTTP_LIMITS,
+        )
+    return _shared_http_client
+
+def make_async_http_client() -> httpx.AsyncClient:
+    """
+    新建异步 httpx.AsyncClient (参数与共享同步连接池一致)。
+    AsyncClient 绑定创建它的事件循环，因此不做全局共享，由调用方在各自的事件循环里创建并关闭。
+    """
+    return httpx.AsyncClient(
+        http2=importlib.util.find_spec("h2") is not None,
+        timeout=LLM_HTTP_TIMEOUT,
+        limits=LLM_HTTP_LIMITS,
+    )
+
+def close_shared_http_client():
+    """进程退出时关闭共享连接池"""
+    global _shared_http_client
+    if _shared_http_client is not None:
+        _shared_http_client.close()
+        _shared_http_client = None
+
+# --- 0.5 LLM 响应缓存 ---
+# 相同 (服务地址, 模型, 参数, Prompt) 的请求直接复用历史结果，命中时跳过一次完整的 LLM 往返
+LLM_CACHE_PATH = "./.local_llm_cache/responses.sqlite"
+# 缓存上限：超过条数时淘汰最旧的条目，超过有效期的条目视为未命中
+LLM_CACHE_MAX_ENTRIES = 2000
+LLM_CACHE_TTL = 7 * 24 * 3600  # 秒
+LLM_ERROR_PREFIX = '{"error": "Error invoking model'
+
+class LLMResponseCache:
+    """基于 sqlite 的持久化 K-V 缓存 (多线程共享一个连接，写操作加锁；条数与有效期有上限)"""
+    def __init__(self, path: str = LLM_CACHE_PATH, max_entries: int = LLM_CACHE_MAX_ENTRIES, ttl: float = LLM_CACHE_TTL):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self.max_entries = max_entries
+        self.ttl = ttl
+        with self._lock:
+            # 旧版 responses 表无时间戳、无上限，且混有未通过校验的结果，直接丢弃
+            self._conn.execute("DROP TABLE IF EXISTS responses")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS llm_responses (key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_llm_responses_created ON llm_responses (created)")
+            self._conn.commit()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM llm_responses WHERE key = ? AND created > ?", (key, time.time() - self.ttl)
+            ).fetchone()
+        return row[0] if row else None
+
+    def set(self, key: str, value: str):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO llm_responses (key, value, created) VALUES (?, ?, ?)", (key, value, now)
+            )
+            # 写入时顺带清理：先删过期条目，再只保留最新的 max_entries 条
+            self._conn.execute("DELETE FROM llm_responses WHERE created <= ?", (now - self.ttl,))
+            self._conn.execute(
+                "DELETE FROM llm_responses WHERE key NOT IN "
+                "(SELECT key FROM llm_responses ORDER BY created DESC LIMIT ?)", (self.max_entries,)
+            )
+            self._conn.commit()
+
+_llm_cache: Optional[LLMResponseCache] = None
+_llm_cache_lock = threading.Lock()
+
+def get_llm_cache() -> LLMResponseCache:
+    global _llm_cache
+    with _llm_cache_lock:
+        if _llm_cache is None:
+            _llm_cache = LLMResponseCache()
+    return _llm_cache
+
 # --- 1. 定义数据结构 ---
 Message = Dict[str, str]
 
@@ -23,18 +122,30 @@ class Agent(abc_agent):
     通用 Agent，用于 DeepSeek 等标准模型
     """
     def __init__(self, api_key: str, base_url: str, model_name: str, temperature: float = 0.7):
-        self.client = OpenAI(api_key=api_key, base_url=base_url)
+        self.api_key = api_key
+        self.base_url = base_url
+        self.client = OpenAI(api_key=api_key, base_url=base_url, http_client=get_shared_http_client())
         self.model_name = model_name
         self.temperature = temperature
 
-    def chat(self, messages: List[Message], system_prompt: Optional[str] = None, json_mode: bool = False) -> str:
+    def update_config(self, api_key: Optional[str] = None, base_url: Optional[str] = None, model_name: Optional[str] = None):
+        """热更新 Key/URL/模型，新 client 仍挂在共享连接池上"""
+        if api_key:
+            self.api_key = api_key
+        if base_url:
+            self.base_url = base_url
+        if model_name:
+            self.model_name = model_name
+        self.client = OpenAI(api_key=self.api_key, base_url=self.base_url, http_client=get_shared_http_client())
+
+    def _build_params(self, messages: List[Message], system_prompt: Optional[str], json_mode: bool, model_name: str) -> Dict:
         final_msgs = []
         if system_prompt:
             final_msgs.append({"role": "system", "content": system_prompt})
         final_msgs.extend(messages)
         
         params = {
-            "model": self.model_name,
+            "model": model_name,
             "messages": final_msgs,
             "temperature": self.temperature,
             "stream": False
@@ -43,12 +154,61 @@ class Agent(abc_agent):
         # 标准 OpenAI 模型支持 json_object
         if json_mode:
             params["response_format"] = {"type": "json_object"}
+        return params
+
+    def chat(self, messages: List[Message], system_prompt: Optional[str] = None, json_mode: bool = False, model_name: Optional[str] = None) -> str:
+        """:param model_name: 本次调用临时使用的模型 (不修改实例状态，多线程并发调用安全)"""
+        model_name = model_name or self.model_name
+        params = self._build_params(messages, system_prompt, json_mode, model_name)
 
         try:
             response = self.client.chat.completions.create(**params)
             return response.choices[0].message.content
         except Exception as e:
-            return f"{{\"error\": \"Error invoking model {self.model_name}: {str(e)}\"}}"
+            return f"{{\"error\": \"Error invoking model {model_name}: {str(e)}\"}}"
+
+    def async_client(self, http_client: httpx.AsyncClient) -> AsyncOpenAI:
+        """基于调用方提供的 AsyncClient 创建异步客户端 (供 achat 使用)"""
+        return AsyncOpenAI(api_key=self.api_key, base_url=self.base_url, http_client=http_client)
+
+    async def achat(self, client: AsyncOpenAI, messages: List[Message], system_prompt: Optional[str] = None, json_mode: bool = False, model_name: Optional[str] = None) -> str:
+        """
+        chat 的异步版本：单个事件循环即可承载大量在途请求，不必为每个请求占用一个线程
+        :param client: 由 async_client 创建的异步客户端
+        """
+        model_name = model_name or self.model_name
+        params = self._build_params(messages, system_prompt, json_mode, model_name)
+
+        try:
+            response = await client.chat.completions.create(**params)
+            return response.choices[0].message.content
+        except Exception as e:
+            return f"{{\"error\": \"Error invoking model {model_name}: {str(e)}\"}}"
+
+    def chat_cached(self, messages: List[Message], system_prompt: Optional[str] = None, json_mode: bool = False,
+                    is_cacheable: Optional[Callable[[str], bool]] = None) -> str:
+        """
+        带持久化缓存的 chat：key 为 (服务地址, 模型, 温度, json_mode, Prompt, 消息) 的 SHA256。
+        调用失败的错误结果不写入缓存。
+        :param is_cacheable: 结果校验函数，返回 False 的结果不写入缓存
+            (温度 > 0 时同一 Prompt 重试本应得到不同答案，不能把失败的结果固定下来)
+        """
+        payload = json.dumps(
+            [self.base_url, self.model_name, self.temperature, json_mode, system_prompt, messages],
+            ensure_ascii=False, sort_keys=True
+        )
+        key = hashlib.sha256(payload.encode("utf-8")).hexdigest()
+        cache = get_llm_cache()
+
+        cached = cache.get(key)
+        if cached is not None:
+            print(f"⚡ [LLM Cache] 命中缓存 ({self.model_name})")
+            return cached
+
+        result = self.chat(messages, system_prompt=system_prompt, json_mode=json_mode)
+        if result and not result.startswith(LLM_ERROR_PREFIX) and (is_cacheable is None or is_cacheable(result)):
+            cache.set(key, result)
+        return result
 
     def chat_stream(self, messages: List[Message], system_prompt: Optional[str] = None) -> Generator[str, None, None]:
         final_msgs = []
@@ -91,7 +251,8 @@ class qwen_doc_agent:
     def __init__(self, model_name="qwen-long"):
         self.client = OpenAI(
             api_key=API_KEY_qwen,
-            base_url="https://dashscope.aliyuncs.com/compatible-mode/v1"
+            base_url="https://dashscope.aliyuncs.com/compatible-mode/v1",
+            http_client=get_shared_http_client()
         )
         self.model_name = model_name
 
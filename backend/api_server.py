@@ -1,11 +1,15 @@
+import asyncio
 import json
 import os
 import shutil
 import uvicorn
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException, BackgroundTasks
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, BackgroundTasks, Request
+from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.concurrency import run_in_threadpool
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict
+from pathlib import PurePath, PureWindowsPath
 from typing import Optional, List, Dict, Any, Callable
 import glob
 import re
@@ -13,6 +17,9 @@ from datetime import datetime
 import time
 import uuid
 import logging
+import threading
+from dataclasses import dataclass
+from cachetools import TTLCache
 
 # 关闭 httpx (OpenAI/DeepSeek 底层通讯库) 的 INFO 日志
 logging.getLogger("httpx").setLevel(logging.WARNING)
@@ -30,6 +37,7 @@ from document_reader import DocumentAnalyzer
 from project_manager import ProjectManager
 from git_loader import GitHubLoader
 from style_agent import StyleAgent
+from Agent import close_shared_http_client
 
 # --- 配置 ---
 PROJECTS_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "../.projects"))
@@ -39,6 +47,19 @@ DEFAULT_PROJECT = "default"
 
 project_manager = ProjectManager(DEFAULT_PROJECT,PROJECTS_ROOT)
 
+# 项目名校验 (预编译，\Z 避免 $ 放过结尾换行)
+_PROJ_NAME_RE = re.compile(r'^[a-zA-Z0-9_-]+\Z')
+
+# 上传文件名清洗：保留中文等 Unicode 字母数字，其余替换为下划线
+_UNSAFE_FILENAME_RE = re.compile(r'[^\w.-]')
+MAX_FILENAME_LEN = 120
+
+def safe_upload_filename(filename: str) -> str:
+    """去掉目录部分 (兼容 / 和 \\)，防止路径穿越，并清洗非法字符"""
+    name = PurePath(PureWindowsPath(filename or "").name).name
+    name = _UNSAFE_FILENAME_RE.sub("_", name).lstrip(".")
+    return name[-MAX_FILENAME_LEN:] or f"upload_{uuid.uuid4().hex[:8]}"
+
 # --- 初始化 FastAPI ---
 app = FastAPI(title="Smart Mermaid Backend (Project Managed)")
 
@@ -49,8 +70,31 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# 压缩较大的 JSON 响应 (历史记录列表、Mermaid 代码等)；后添加的中间件位于外层
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=6)
+
+@app.exception_handler(HTTPException)
+async def http_exception_handler(request: Request, exc: HTTPException):
+    """错误走真实 HTTP 状态码，响应体仍保持前端约定的 {"status": "error", "message": ...}"""
+    return JSONResponse(
+        status_code=exc.status_code,
+        content={"status": "error", "message": exc.detail},
+        headers=exc.headers,
+    )
 
 # --- 1. 初始化 Agents ---
+@dataclass(slots=True, frozen=True)
+class LLMAgents:
+    """支持 LLM 配置热更新的 Agent 集合"""
+    router: RouterAgent
+    code_gen: CodeGenAgent
+    code_revise: CodeReviseAgent
+
+    def __iter__(self):
+        return iter((self.router, self.code_gen, self.code_revise))
+
+llm_agents: Optional[LLMAgents] = None
+
 print("🚀 [Backend] 正在启动后端引擎，加载 Agents...")
 default_graph_db = os.path.join(project_manager.get_project_dir(DEFAULT_PROJECT), "graph_db")
 
@@ -64,13 +108,57 @@ try:
     )
     doc_analyzer = DocumentAnalyzer() 
     style_agent = StyleAgent(model_name="deepseek-chat")
+    llm_agents = LLMAgents(router=router_agent, code_gen=code_gen_agent, code_revise=code_revise_agent)
     print("✅ [Backend] 引擎加载完毕！")
 except Exception as e:
     print(f"❌ [Backend] 引擎加载失败: {e}")
 
 
+@app.on_event("shutdown")
+def shutdown_http_client():
+    """关闭所有 Agent 共享的 LLM 连接池"""
+    close_shared_http_client()
+
+
 # --- 任务状态管理 ---
-tasks = {}
+# 任务状态只需保留一段时间供前端轮询，过期自动淘汰，避免常驻进程内存无限增长
+TASKS_MAXSIZE = 10_000
+TASKS_TTL = 3600
+
+class _LockedTTLCache(TTLCache):
+    """TTLCache 本身非线程安全 (读写都会触发过期清理)，后台任务跑在线程池里，需加锁"""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._lock = threading.RLock()
+
+    def __getitem__(self, key):
+        with self._lock:
+            return super().__getitem__(key)
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            super().__setitem__(key, value)
+
+    def __delitem__(self, key):
+        with self._lock:
+            super().__delitem__(key)
+
+    def get(self, key, default=None):
+        with self._lock:
+            return super().get(key, default)
+
+    def update_task(self, key, **fields):
+        """
+        合并更新任务状态。TTL 从写入时刻算起，原地修改 dict 不会续期，
+        这里重新赋值，让运行超过 TTL 的长任务在每次进度更新时续期，不会中途被淘汰。
+        """
+        with self._lock:
+            super().__setitem__(key, {**(super().get(key) or {}), **fields})
+
+tasks = _LockedTTLCache(maxsize=TASKS_MAXSIZE, ttl=TASKS_TTL)
+
+# 串行化项目切换：同一时刻只允许一次 reload_db + 切换
+project_switch_lock = asyncio.Lock()
 
 def process_upload_background(task_id: str, file_location: str, project_name: str):
     """后台任务：处理文件并构建图谱"""
@@ -95,55 +183,57 @@ def process_upload_background(task_id: str, file_location: str, project_name: st
 
 # --- 2. Request Models ---
 
-class GenerateRequest(BaseModel):
+class RequestModel(BaseModel):
+    """
+    请求体基类：前端多传的字段 (aiConfig / selectedModel 等) 直接丢弃，不做校验；
+    请求体只读。
+    """
+    model_config = ConfigDict(extra="ignore", frozen=True)
+
+class GenerateRequest(RequestModel):
     text: str
     diagramType: str = "auto"
-    aiConfig: Optional[Dict[str, Any]] = None
     useGraph: bool = True 
     useFileContext: bool = True # 是否使用文件上下文
     useHistory:bool = False
     useMistakes:bool = False
     richness:float = 0.5
 
-class FixRequest(BaseModel):
+class FixRequest(RequestModel):
     mermaidCode: str
     errorMessage: str
 
-class PasswordRequest(BaseModel):
+class PasswordRequest(RequestModel):
     password: str
 
-class ConfigUpdateRequest(BaseModel):
+class ConfigUpdateRequest(RequestModel):
     apiKey: str
     apiUrl: str
     modelName: str
 
-class ProjectCreateRequest(BaseModel):
+class ProjectCreateRequest(RequestModel):
     name: str
 
-class ProjectSwitchRequest(BaseModel):
+class ProjectSwitchRequest(RequestModel):
     name: str
 
-class HistoryEntry(BaseModel):
+class HistoryEntry(RequestModel):
     id: Optional[str] = None
     query: str
     code: str
     diagramType: str = "auto"
     timestamp: Optional[str] = None
 
-class OptimizeRequest(BaseModel):
+class OptimizeRequest(RequestModel):
     code: str
     instruction: str
-    aiConfig: Optional[Dict[str, Any]] = None
-    accessPassword: Optional[str] = None
-    selectedModel: Optional[str] = None
 
-class GitHubAnalysisRequest(BaseModel):
+class GitHubAnalysisRequest(RequestModel):
     repoUrl: str
     diagramType: str = "auto"
-    aiConfig: Optional[Dict[str, Any]] = None
     richness: float = 0.5
 
-class StyleGenRequest(BaseModel):
+class StyleGenRequest(RequestModel):
     description: str
 
 
@@ -208,7 +298,12 @@ def run_code_revision_loop(
                 print("   ❌ 达到最大重试次数，放弃自动修复")
                 break
             
-            attempt_history.append({"code": current_code, "error": error_msg})
+            prev_code = attempt_history[-1]["code"] if attempt_history else None
+            attempt_history.append(CodeReviseAgent.make_attempt(current_code, error_msg, prev_code))
+
+            if CodeReviseAgent.is_stuck(attempt_history):
+                print("   ⛔ 修复结果与上一轮完全相同 (代码与报错均未变化)，提前终止")
+                break
             
             if revise_agent:
                 msg = f"正在自动修复语法错误 ({i+1}/{max_retries})..."
@@ -276,29 +371,35 @@ def background_build_graph(task_id: str):
         if files_to_update:
             msg = f"发现 {len(files_to_update)} 个文件变动，正在更新图谱..."
             print(f"   -> {msg}")
-            tasks[task_id]["message"] = msg
+            tasks.update_task(task_id, message=msg)
             
             graph_input_path = os.path.join(upload_dir, "graph_full_context.md")
             new_content_buffer = ""
+
+            # Blob 文件调用 Vision/文档模型分析：互相独立，先并发分析完，再按原顺序拼接
+            text_file_set = set(text_files)
+            blob_targets = [fpath for fpath, _ in files_to_update if fpath not in text_file_set]
+            if blob_targets:
+                tasks.update_task(task_id, message=f"正在并发解析 {len(blob_targets)} 个非文本文件...")
+            blob_descs = dict(zip(blob_targets, doc_analyzer.analyze_batch(
+                blob_targets,
+                prompt="请详细描述该文件的内容，以便构建准确的知识图谱。",
+                max_token_limit=2400
+            )))
             
             for i, (fpath, record) in enumerate(files_to_update):
                 fname = os.path.basename(fpath)
                 # 更新细粒度进度
-                tasks[task_id]["message"] = f"正在解析 ({i+1}/{len(files_to_update)}): {fname}"
+                tasks.update_task(task_id, message=f"正在解析 ({i+1}/{len(files_to_update)}): {fname}")
                 
                 try:
                     # --- 读取内容 ---
-                    if fpath in text_files:
+                    if fpath in text_file_set:
                         with open(fpath, 'r', encoding='utf-8') as f:
                             content = f.read()
                         new_content_buffer += f"\n\n### File: {fname}\n{content}\n"
                     else:
-                        # Blob 文件调用 Vision 模型分析
-                        blob_desc = doc_analyzer.analyze(
-                            fpath, 
-                            prompt="请详细描述该文件的内容，以便构建准确的知识图谱。", 
-                            max_token_limit=2400
-                        )
+                        blob_desc = blob_descs[fpath]
                         new_content_buffer += f"\n\n### File: {fname}\nContent Description:\n{blob_desc}\n"
                     
                     # --- 更新记录状态 ---
@@ -320,7 +421,7 @@ def background_build_graph(task_id: str):
 
             # 写入 Graph md 并触发构建
             if new_content_buffer:
-                tasks[task_id]["message"] = "正在构建图谱索引 (Embedding)..."
+                tasks.update_task(task_id, message="正在构建图谱索引 (Embedding)...")
                 with open(graph_input_path, "a", encoding="utf-8") as f:
                     f.write(new_content_buffer)
                 
@@ -371,16 +472,14 @@ def build_file_context(user_query: str, use_graph: bool, use_file: bool) -> str:
             file_contexts = []
             print(f"   -> Processing {count} files (Limit: ~{limit_per_file} tokens/file)...")
             
-            for fpath in all_targets:
-                try:
-                    analysis = doc_analyzer.analyze(
-                        fpath, 
-                        prompt=f"Briefly explain this file's relevance to: {user_query}", 
-                        max_token_limit=limit_per_file
-                    )
-                    file_contexts.append(f"### File: {os.path.basename(fpath)}\nSummary:\n{analysis}\n")
-                except Exception as e:
-                    print(f"Error analyzing {fpath}: {e}")
+            # 各文件的分析互相独立，并发执行 (本函数运行在线程池里，可以直接起一个事件循环)
+            analyses = asyncio.run(doc_analyzer.analyze_many(
+                all_targets,
+                prompt=f"Briefly explain this file's relevance to: {user_query}",
+                max_token_limit=limit_per_file
+            ))
+            for fpath, analysis in zip(all_targets, analyses):
+                file_contexts.append(f"### File: {os.path.basename(fpath)}\nSummary:\n{analysis}\n")
             
             context = "\n".join(file_contexts)
     
@@ -403,11 +502,11 @@ async def list_projects():
 
 @app.post("/api/projects")
 async def create_project(req: ProjectCreateRequest):
-    if not re.match(r'^[a-zA-Z0-9_-]+$', req.name):
-        return {"status": "error", "message": "项目名称只能包含字母、数字、下划线和连字符"}
+    if not _PROJ_NAME_RE.match(req.name):
+        raise HTTPException(status_code=400, detail="项目名称只能包含字母、数字、下划线和连字符")
     
-    if req.name in project_manager.list_projects():
-        return {"status": "error", "message": "项目已存在"}
+    if project_manager.project_exists(req.name):
+        raise HTTPException(status_code=409, detail="项目已存在")
     
     project_manager.ensure_project_exists(req.name)
     return {"status": "success", "message": f"项目 {req.name} 已创建"}
@@ -438,19 +537,27 @@ async def trigger_build_graph(background_tasks: BackgroundTasks):
 
 @app.post("/api/projects/switch")
 async def switch_project(req: ProjectSwitchRequest):
-    try:
+    async with project_switch_lock:
         if req.name == project_manager.current_project:
             return {"status": "success", "current": req.name, "message": "Already on this project"}
+        if not project_manager.project_exists(req.name):
+            raise HTTPException(status_code=404, detail=f"Project {req.name} does not exist")
+
+        try:
+            # 先加载新项目的图谱，成功后再提交切换，避免请求在中途看到"新项目 + 旧图谱"
+            # 加载图谱是磁盘密集操作，放到线程池避免阻塞其他请求
+            new_graph_db = os.path.join(project_manager.get_project_dir(req.name), "graph_db")
+            await run_in_threadpool(rag_engine.reload_db, new_graph_db)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
 
-        new_dir = project_manager.switch_project(req.name)
+        try:
+            project_manager.switch_project(req.name)
+        except ValueError as e:
+            raise HTTPException(status_code=404, detail=str(e))
         print(f"🔄 [Project] 切换至: {req.name}")
-        
-        new_graph_db = os.path.join(new_dir, "graph_db")
-        rag_engine.reload_db(new_graph_db)
-        
+
         return {"status": "success", "current": req.name}
-    except Exception as e:
-        return {"status": "error", "message": str(e)}
 
 # === 文件列表接口 ===
 @app.get("/api/files")
@@ -469,10 +576,22 @@ async def get_graph_data():
 
 # === 历史记录接口 ===
 
+def new_history_id() -> str:
+    """
+    生成历史记录 ID (UUIDv7)：48 位毫秒时间戳 + 74 位随机数。
+    字典序即时间序，同一毫秒内的并发插入也不会撞 ID。
+    """
+    if hasattr(uuid, "uuid7"):  # Python 3.14+
+        return str(uuid.uuid7())
+    ts_ms = time.time_ns() // 1_000_000
+    value = ((ts_ms & 0xFFFF_FFFF_FFFF) << 80) | int.from_bytes(os.urandom(10), "big")
+    value = (value & ~(0xF << 76)) | (0x7 << 76)  # version 7
+    value = (value & ~(0x3 << 62)) | (0x2 << 62)  # RFC 4122 variant
+    return str(uuid.UUID(int=value))
+
 @app.get("/api/history")
 async def get_history():
-    p_dir = project_manager.get_project_dir()
-    hist_file = os.path.join(p_dir, "history.json")
+    hist_file = project_manager.history_file
     try:
         if os.path.exists(hist_file):
             with open(hist_file, "r", encoding="utf-8") as f:
@@ -483,12 +602,11 @@ async def get_history():
 
 @app.post("/api/history")
 async def add_history(entry: HistoryEntry):
-    p_dir = project_manager.get_project_dir()
-    hist_file = os.path.join(p_dir, "history.json")
+    hist_file = project_manager.history_file
     
     new_item = entry.dict()
     if not new_item.get("id"):
-        new_item["id"] = str(int(time.time() * 1000))
+        new_item["id"] = new_history_id()
     if not new_item.get("timestamp"):
         new_item["timestamp"] = datetime.now().isoformat()
         
@@ -510,8 +628,7 @@ async def add_history(entry: HistoryEntry):
 
 @app.delete("/api/history/{entry_id}")
 async def delete_history(entry_id: str):
-    p_dir = project_manager.get_project_dir()
-    hist_file = os.path.join(p_dir, "history.json")
+    hist_file = project_manager.history_file
     try:
         if os.path.exists(hist_file):
             with open(hist_file, "r", encoding="utf-8") as f:
@@ -521,12 +638,11 @@ async def delete_history(entry_id: str):
                 json.dump(new_data, f, ensure_ascii=False, indent=2)
         return {"status": "success"}
     except Exception as e:
-        return {"status": "error", "message": str(e)}
+        raise HTTPException(status_code=500, detail=str(e))
     
 @app.delete("/api/history")
 async def clear_history():
-    p_dir = project_manager.get_project_dir()
-    hist_file = os.path.join(p_dir, "history.json")
+    hist_file = project_manager.history_file
     try:
         with open(hist_file, "w", encoding="utf-8") as f:
             json.dump([], f)
@@ -538,14 +654,15 @@ async def clear_history():
 @app.post("/api/system/config")
 async def update_system_config(config: ConfigUpdateRequest):
     print(f"🔄 [System] 收到配置更新请求: {config.modelName} @ {config.apiUrl}")
+    if llm_agents is None:
+        raise HTTPException(status_code=503, detail="Agents 未初始化，请检查后端启动日志")
     try:
         config_dict = config.dict()
-        if 'router_agent' in globals(): router_agent.reload_llm_config(config_dict)
-        if 'code_gen_agent' in globals(): code_gen_agent.reload_llm_config(config_dict)
-        if 'code_revise_agent' in globals(): code_revise_agent.reload_llm_config(config_dict)
+        for agent in llm_agents:
+            agent.reload_llm_config(config_dict)
         return {"status": "success", "message": "AI配置已热更新"}
     except Exception as e:
-        return {"status": "error", "message": str(e)}
+        raise HTTPException(status_code=500, detail=str(e))
 
 # === 文件上传接口 ===
 
@@ -559,7 +676,8 @@ async def upload_file(
         upload_dir = os.path.join(project_manager.get_project_dir(), "uploads")
         os.makedirs(upload_dir, exist_ok=True)
         
-        file_location = os.path.join(upload_dir, file.filename)
+        filename = safe_upload_filename(file.filename)
+        file_location = os.path.join(upload_dir, filename)
         
         with open(file_location, "wb") as f:
             while True:
@@ -569,7 +687,7 @@ async def upload_file(
                 await run_in_threadpool(f.write, chunk)
             
         task_id = str(uuid.uuid4())
-        print(f"📂 [Upload] 收到文件: {file.filename}, ID: {task_id}, AutoBuild: {autoBuild}")
+        print(f"📂 [Upload] 收到文件: {filename}, ID: {task_id}, AutoBuild: {autoBuild}")
         
         initial_status = "pending" if autoBuild else "uploaded"
         initial_msg = "文件等待处理..." if autoBuild else "文件已保存 (待分析)"
@@ -577,14 +695,14 @@ async def upload_file(
         tasks[task_id] = {
             "status": initial_status,
             "message": initial_msg,
-            "filename": file.filename,
+            "filename": filename,
             "timestamp": time.time(),
             "location": file_location 
         }
         
         file_record = {
             "id": task_id,
-            "filename": file.filename,
+            "filename": filename,
             "status": initial_status,
             "message": initial_msg,
             "timestamp": datetime.now().isoformat(),
@@ -605,17 +723,17 @@ async def upload_file(
             "status": "success", 
             "message": "文件上传成功" + ("，已进入处理队列" if autoBuild else "，等待使用"),
             "taskId": task_id,
-            "filename": file.filename
+            "filename": filename
         }
     except Exception as e:
         print(f"🔥 Upload Error: {e}")
-        return {"status": "error", "message": str(e)}
+        raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/api/tasks/{task_id}")
 async def get_task_status(task_id: str):
     task = tasks.get(task_id)
     if not task:
-        return {"status": "error", "message": "任务不存在或已过期"}
+        raise HTTPException(status_code=404, detail="任务不存在或已过期")
     return task
 
 # === 核心生成接口 (增强版：支持多文件分路处理) ===
@@ -625,21 +743,37 @@ async def generate_mermaid(request: GenerateRequest):
     print(f"\n⚡ [Generate] 收到请求: {user_query[:50]}... | Graph: {request.useGraph} | File: {request.useFileContext}")
 
     try:
-        # 1. 调用封装好的上下文构建函数
-        context = build_file_context(user_query, request.useGraph, request.useFileContext)
+        is_auto = request.diagramType == "auto"
+
+        # 1. 上下文构建 与 Router 经验检索 并发执行
+        # 经验检索只依赖用户 query，不需要等待上下文 (图谱检索 / 文件分析)
+        context_job = run_in_threadpool(build_file_context, user_query, request.useGraph, request.useFileContext)
+        if request.useHistory:
+            experience_job = run_in_threadpool(router_agent.retrieve_experiences, user_query, 10 if is_auto else 3)
+            context, experiences = await asyncio.gather(context_job, experience_job)
+        else:
+            context, experiences = await context_job, None
 
         # 2. Router 调度中心
         print("   -> Router 正在制定策略...")
         
-        if request.diagramType == "auto":
-            route_res = router_agent.route_and_analyze(user_content=context, user_target=user_query, use_experience=request.useHistory)
+        if is_auto:
+            route_res = await run_in_threadpool(
+                router_agent.route_and_analyze,
+                user_content=context,
+                user_target=user_query,
+                use_experience=request.useHistory,
+                experiences=experiences
+            )
         else:
             print(f"   -> 用户强制指定类型: {request.diagramType}")
-            route_res = router_agent.analyze_specific_mode(
+            route_res = await run_in_threadpool(
+                router_agent.analyze_specific_mode,
                 user_content=context, 
                 user_target=user_query, 
                 specific_type=request.diagramType,
-                use_experience=request.useHistory
+                use_experience=request.useHistory,
+                experiences=experiences
             )
             
         prompt_file = route_res.get("target_prompt_file", "flowchart.md")
@@ -649,10 +783,13 @@ async def generate_mermaid(request: GenerateRequest):
         
         # 3. 代码生成
         print("   -> 正在生成代码...")
-        initial_code = code_gen_agent.generate_code(logic_analysis, prompt_file=prompt_file, richness=request.richness)
+        initial_code = await run_in_threadpool(
+            code_gen_agent.generate_code, logic_analysis, prompt_file=prompt_file, richness=request.richness
+        )
         
         # 4. 调用封装好的循环修复逻辑
-        final_code, final_error = run_code_revision_loop(
+        final_code, final_error = await run_in_threadpool(
+            run_code_revision_loop,
             initial_code=initial_code,
             revise_agent=code_revise_agent,
             user_query=user_query,
@@ -674,7 +811,7 @@ def process_github_background(task_id: str, repo_url: str, diagram_type: str, ri
     """GitHub 分析的后台任务逻辑"""
     try:
         # 1. 更新状态：克隆中
-        tasks[task_id].update({"status": "processing", "message": "正在克隆仓库..."})
+        tasks.update_task(task_id, status="processing", message="正在克隆仓库...")
         
         project_dir = project_manager.get_project_dir()
         # 源代码存储路径 (与 uploads 隔离)
@@ -688,9 +825,9 @@ def process_github_background(task_id: str, repo_url: str, diagram_type: str, ri
         repo_name = os.path.basename(repo_path)
         
         # 3. 分析结构
-        tasks[task_id].update({"message": "正在分析文件结构..."})
-        files_map = loader.classify_files(repo_path)
-        tree_structure = loader.generate_tree_structure(repo_path)
+        tasks.update_task(task_id, message="正在分析文件结构...")
+        # 一次遍历同时得到文件分类和目录树
+        files_map, tree_structure = loader.walk_and_index(repo_path)
         
         # 4. 深度分析核心代码
         source_files = files_map['source_code']
@@ -706,7 +843,7 @@ def process_github_background(task_id: str, repo_url: str, diagram_type: str, ri
         
         for file_path in selected_files:
             count += 1
-            tasks[task_id].update({"message": f"正在深度阅读 ({count}/{len(selected_files)}): {os.path.basename(file_path)}"})
+            tasks.update_task(task_id, message=f"正在深度阅读 ({count}/{len(selected_files)}): {os.path.basename(file_path)}")
             
             try:
                 res = doc_analyzer.analyze_code_file(file_path, project_root=repo_path)
@@ -752,7 +889,7 @@ def process_github_background(task_id: str, repo_url: str, diagram_type: str, ri
         user_query = f"Analyze the architecture of the GitHub repository '{repo_name}'. Use the Directory Tree to understand the full scope, and the Core File Analysis to understand the specific logic implementation."
         
         # 6. 生成图表
-        tasks[task_id].update({"message": "AI 正在构建图表逻辑..."})
+        tasks.update_task(task_id, message="AI 正在构建图表逻辑...")
         
         if diagram_type == "auto":
             route_res = router_agent.route_and_analyze(user_content=full_context, user_target=user_query)
@@ -766,12 +903,12 @@ def process_github_background(task_id: str, repo_url: str, diagram_type: str, ri
         prompt_file = route_res.get("target_prompt_file", "classDiagram.md")
         logic_analysis = route_res.get("analysis_content", "")
         
-        tasks[task_id].update({"message": "正在生成 Mermaid 代码..."})
+        tasks.update_task(task_id, message="正在生成 Mermaid 代码...")
         initial_code = code_gen_agent.generate_code(logic_analysis, prompt_file=prompt_file, richness=richness)
         
         # 7. Code Revise (使用封装函数，带状态更新回调)
         def update_status(msg):
-            tasks[task_id].update({"message": msg})
+            tasks.update_task(task_id, message=msg)
 
         final_code, final_error = run_code_revision_loop(
             initial_code=initial_code,
@@ -783,15 +920,14 @@ def process_github_background(task_id: str, repo_url: str, diagram_type: str, ri
         # 保存历史记录
         try:
             hist_entry = {
-                "id": str(int(time.time() * 1000)),
+                "id": new_history_id(),
                 "query": f"GitHub Analysis: {repo_name}",
                 "code": final_code,
                 "diagramType": diagram_type,
                 "timestamp": datetime.now().isoformat(),
                 "analysisSummary": logic_analysis
             }
-            p_dir = project_manager.get_project_dir()
-            hist_file = os.path.join(p_dir, "history.json")
+            hist_file = project_manager.history_file
             
             current_hist = []
             if os.path.exists(hist_file):
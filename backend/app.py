@@ -1,40 +1,171 @@
 import streamlit as st
 import os
 import re
+import shutil
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import cached_property
 # --- 引入 Agents 和 GraphRAG ---
 from codez_gen import CodeGenAgent
 from code_revise import CodeReviseAgent
 from router import RouterAgent
 from graphrag import LightGraphRAG
-from vision import QwenVisionAgent
 import utils
 
 # --- 页面配置 ---
 st.set_page_config(layout="wide", page_title="GraphRAG Logic Agent (v5.0 - Evolving)", page_icon="🕸️")
 
 # --- 缓存初始化 ---
-@st.cache_resource
-def init_agents():
-    return {
-        "graph_rag": LightGraphRAG(persist_dir="./.local_graph_db"),
+class AgentRegistry:
+    """
+    Agent 懒加载容器：每个 Agent 在第一次被用到时才初始化。
+    只浏览图谱 / 不上传图片的会话不必为视觉模型、错题本入库等付出启动开销。
+    """
+    @cached_property
+    def graph_rag(self):
+        return LightGraphRAG(persist_dir="./.local_graph_db")
+
+    @cached_property
+    def router(self):
         # Router 默认开启学习模式 (learn_mode=True)
-        "router": RouterAgent(model_name="deepseek-chat", learn_mode=True),
-        "code_gen": CodeGenAgent(model_name="deepseek-chat"),
-        "code_revise": CodeReviseAgent(
+        return RouterAgent(model_name="deepseek-chat", learn_mode=True)
+
+    @cached_property
+    def code_gen(self):
+        return CodeGenAgent(model_name="deepseek-chat")
+
+    @cached_property
+    def code_revise(self):
+        return CodeReviseAgent(
             knowledge_base_dir="./knowledge_base",
             mistake_file_path="./knowledge/experience/mistakes.json",
             model_name="deepseek-chat"
-        ),
-        "vision": QwenVisionAgent()
-    }
+        )
+
+    @cached_property
+    def vision(self):
+        from vision import QwenVisionAgent
+        return QwenVisionAgent()
+
+@st.cache_resource
+def init_agents():
+    return AgentRegistry()
 
 agents = init_agents()
 
+@st.cache_resource
+def init_background_pool():
+    """后台线程池：跑不影响页面展示的收尾工作 (如经验学习)，跨 rerun 复用"""
+    return ThreadPoolExecutor(max_workers=2, thread_name_prefix="learn")
+
+background_pool = init_background_pool()
+
+# 上传文件落盘的分块大小 (1 MiB)，避免整文件读入内存
+UPLOAD_COPY_CHUNK = 1 << 20
+IMG_SAVE_DIR = "./.uploaded_images"
+DOC_SAVE_DIR = "./.uploaded_docs"
+
+def save_upload(up_file, file_path: str):
+    """流式保存 Streamlit 上传文件"""
+    up_file.seek(0)
+    with open(file_path, "wb") as f:
+        shutil.copyfileobj(up_file, f, UPLOAD_COPY_CHUNK)
+
+# 视觉分析的最大并发数 (受限于远端 API 的并发额度)
+VISION_CONCURRENCY = 8
+
+@st.cache_resource
+def init_vision_pool():
+    """视觉分析线程池，跨 rerun 复用，不必每次点击都新建线程"""
+    return ThreadPoolExecutor(max_workers=VISION_CONCURRENCY, thread_name_prefix="vision")
+
+vision_pool = init_vision_pool()
+
+def analyze_images_concurrently(img_paths, on_done=None):
+    """
+    并发执行视觉分析：每张图片的分析互相独立，耗时主要在远端 API 往返上，
+    并发后总耗时从 Σ 延迟降到约 max 延迟。
+    注意：build_graph 会改写 graph_rag 的实例状态 (切片列表等)，不能并发，仍需串行。
+    :return: [(img_path, analysis), ...]，顺序与输入一致
+    """
+    futures = {vision_pool.submit(agents.vision.analyze_image, p): p for p in img_paths}
+    results = {}
+    # as_completed 在脚本主线程上迭代，回调里可以安全更新 Streamlit 组件
+    for fut in as_completed(futures):
+        path = futures[fut]
+        results[path] = fut.result()
+        if on_done: on_done(path)
+    return [(p, results[p]) for p in img_paths]
+
+@st.cache_resource
+def init_retry_pool():
+    """最后一轮修复的竞速线程池：常规修复与从零重写同时进行"""
+    return ThreadPoolExecutor(max_workers=2, thread_name_prefix="retry")
+
+retry_pool = init_retry_pool()
+
+def race_final_revision(code, error_msg, attempt_history, logic, prompt_file):
+    """
+    最后一次修复机会：同时发起“基于报错修复”和“按逻辑从零重写”两路调用，
+    先通过校验的一路胜出；都未通过时沿用常规修复的结果，交给外层循环报错。
+    """
+    futures = {
+        retry_pool.submit(
+            agents.code_revise.revise_code, code,
+            error_message=error_msg, previous_attempts=attempt_history, use_mistake_book=False
+        ): "revise",
+        # 从零重写必须是一次全新尝试，不能回放缓存
+        retry_pool.submit(agents.code_gen.generate_code, logic, prompt_file=prompt_file, use_cache=False): "rewrite",
+    }
+    results = {}
+    for fut in as_completed(futures):
+        try:
+            candidate = agents.code_gen._clean_code(fut.result())
+        except Exception as e:
+            print(f"⚠️ 最后一轮 {futures[fut]} 调用失败: {e}")
+            continue
+        if utils.quick_validate_mermaid(candidate)['valid']:
+            # 另一路若尚未开始则直接取消；已在运行的由线程池自行收尾
+            for other in futures:
+                other.cancel()
+            return candidate, futures[fut]
+        results[futures[fut]] = candidate
+    return results.get("revise", results.get("rewrite", code)), "revise"
+
+# 流式预览的最小刷新间隔 (秒)，避免每个 token 都重绘组件
+STREAM_REFRESH_INTERVAL = 0.1
+
+def stream_to_placeholder(chunks, placeholder) -> str:
+    """边接收 token 边在占位符里实时预览，返回拼接后的完整文本"""
+    buffer = []
+    last_refresh = 0.0
+    for chunk in chunks:
+        buffer.append(chunk)
+        now = time.monotonic()
+        if now - last_refresh >= STREAM_REFRESH_INTERVAL:
+            placeholder.code("".join(buffer), language="mermaid")
+            last_refresh = now
+    text = "".join(buffer)
+    placeholder.code(text, language="mermaid")
+    return text
+
+@st.cache_data(ttl=5)
+def graph_stats(graph_version: int, _graph):
+    """
+    图谱规模统计 (节点数, 边数)。Streamlit 每次交互都会重跑脚本，
+    DiGraph.number_of_edges() 需要遍历全部节点，按图谱版本缓存；建图后显式 clear()。
+    _graph 以下划线开头，不参与缓存 key 的哈希。
+    """
+    return _graph.number_of_nodes(), _graph.number_of_edges()
+
+def current_graph_stats():
+    rag = agents.graph_rag
+    return graph_stats(rag.graph_version, rag.graph)
+
 # --- Session State 管理 ---
 if "graph_built" not in st.session_state:
     try:
-        current_node_count = agents["graph_rag"].graph.number_of_nodes()
+        current_node_count = current_graph_stats()[0]
     except:
         current_node_count = 0
     
@@ -70,61 +201,62 @@ with tab_build:
                 doc_files = []
                 img_files = []
                 
-                img_save_dir = "./.uploaded_images"
-                os.makedirs(img_save_dir, exist_ok=True)
-                doc_save_dir = "./.uploaded_docs" 
-                os.makedirs(doc_save_dir, exist_ok=True)
+                os.makedirs(IMG_SAVE_DIR, exist_ok=True)
+                os.makedirs(DOC_SAVE_DIR, exist_ok=True)
 
                 for up_file in uploaded_files:
-                    if up_file.type.startswith("image"):
-                        file_path = os.path.join(img_save_dir, up_file.name)
-                        with open(file_path, "wb") as f:
-                            f.write(up_file.getbuffer())
-                        img_files.append(file_path)
-                    else:
-                        file_path = os.path.join(doc_save_dir, up_file.name)
-                        with open(file_path, "wb") as f:
-                            f.write(up_file.getbuffer())
-                        doc_files.append(file_path)
+                    is_image = up_file.type.startswith("image")
+                    file_path = os.path.join(IMG_SAVE_DIR if is_image else DOC_SAVE_DIR, up_file.name)
+                    save_upload(up_file, file_path)
+                    (img_files if is_image else doc_files).append(file_path)
                 
                 st.write("🧹 清理旧数据...")
-                agents["graph_rag"].clear_db()
+                agents.graph_rag.clear_db()
                 
                 progress_bar = st.progress(0)
-                total_steps = len(doc_files) + len(img_files)
+                # 图片：视觉分析 + 建图 两步；文档：建图 一步
+                total_steps = len(doc_files) + 2 * len(img_files)
                 current_step = 0
 
-                for img_path in img_files:
-                    st.write(f"👁️ 正在进行视觉逻辑分析: {os.path.basename(img_path)} ...")
-                    vision_analysis = agents["vision"].analyze_image(img_path)
-                    
-                    markdown_content = (
-                        f"# Visual Logic Analysis: {os.path.basename(img_path)}\n\n"
-                        f"{vision_analysis}"
-                    )
-                    
-                    md_filename = f"{os.path.basename(img_path)}.md"
-                    md_save_path = os.path.join(doc_save_dir, md_filename)
-                    with open(md_save_path, "w", encoding='utf-8') as f:
-                        f.write(markdown_content)
-                    
-                    agents["graph_rag"].build_graph(md_save_path)
+                def _advance(_path=None):
+                    global current_step
                     current_step += 1
                     if total_steps > 0: progress_bar.progress(current_step / total_steps)
 
+                if img_files:
+                    st.write(f"👁️ 正在并发进行视觉逻辑分析 ({len(img_files)} 张图片) ...")
+                    vision_results = analyze_images_concurrently(img_files, on_done=_advance)
+
+                    for img_path, vision_analysis in vision_results:
+                        img_name = os.path.basename(img_path)
+                        markdown_content = (
+                            f"# Visual Logic Analysis: {img_name}\n\n"
+                            f"{vision_analysis}"
+                        )
+                        
+                        md_filename = f"{img_name}.md"
+                        md_save_path = os.path.join(DOC_SAVE_DIR, md_filename)
+                        with open(md_save_path, "w", encoding='utf-8') as f:
+                            f.write(markdown_content)
+                        
+                        st.write(f"🧠 正在构建图谱: {md_filename} ...")
+                        agents.graph_rag.build_graph(md_save_path)
+                        _advance()
+
                 for doc_path in doc_files:
                     st.write(f"🧠 正在深度分析: {os.path.basename(doc_path)} ...")
-                    agents["graph_rag"].build_graph(doc_path)
-                    current_step += 1
-                    if total_steps > 0: progress_bar.progress(current_step / total_steps)
+                    agents.graph_rag.build_graph(doc_path)
+                    _advance()
                 
                 st.session_state.graph_built = True
+                graph_stats.clear()
                 status.update(label="✅ 图谱构建完成！", state="complete", expanded=False)
                 st.balloons()
         
         if st.session_state.graph_built:
             try:
-                st.success(f"当前图谱状态：{agents['graph_rag'].graph.number_of_nodes()} 节点, {agents['graph_rag'].graph.number_of_edges()} 关系")
+                node_count, edge_count = current_graph_stats()
+                st.success(f"当前图谱状态：{node_count} 节点, {edge_count} 关系")
             except:
                 pass
 
@@ -146,22 +278,29 @@ with tab_analyze:
             
             # 1. GraphRAG 搜索
             with st.spinner("正在图谱中游走并回溯原文..."):
-                raw_context = agents["graph_rag"].search(query, top_k=3)
+                raw_context = agents.graph_rag.search(query, top_k=3)
                 st.session_state.analysis_result['raw_context'] = raw_context
                 
             # 2. Router 决策 (会利用 Router 经验池)
             with st.spinner("正在由 Router 参考历史经验进行策略制定..."):
-                route_res = agents["router"].route_and_analyze(user_content = raw_context,user_target = query)
+                route_res = agents.router.route_and_analyze(user_content = raw_context,user_target = query)
                 st.session_state.analysis_result['logic'] = route_res.get("analysis_content", "")
                 st.session_state.analysis_result['prompt_file'] = route_res.get("target_prompt_file", "flowchart.md")
                 st.session_state.analysis_result['reason'] = route_res.get("reason", "")
             
-            # 3. 代码生成
+            # 3. 代码生成 (流式输出，首个 token 到达即开始预览)
             with st.spinner("正在生成可视化代码..."):
-                current_code = agents["code_gen"].generate_code(
-                    st.session_state.analysis_result['logic'], 
-                    prompt_file=st.session_state.analysis_result['prompt_file']
+                gen_preview = st.empty()
+                raw_code = stream_to_placeholder(
+                    agents.code_gen.generate_code_stream(
+                        st.session_state.analysis_result['logic'], 
+                        prompt_file=st.session_state.analysis_result['prompt_file']
+                    ),
+                    gen_preview
                 )
+                # 流式接口不做清洗，拿到完整文本后再统一处理
+                current_code = agents.code_gen._clean_code(raw_code)
+                gen_preview.empty()
                 
                        
             # 4. 代码校验与闭环学习
@@ -188,12 +327,12 @@ with tab_analyze:
                         if i > 0 and last_bad_code and last_error:
                             # ... (CodeRevise 录入逻辑) ...
                             try:
-                                agents["code_revise"].record_mistake(last_bad_code, last_error, current_code)
+                                agents.code_revise.record_mistake(last_bad_code, last_error, current_code)
                             except: pass
 
-                        try:
-                            agents["router"].learn_from_success(query, current_code)
-                        except: pass
+                        # Router 经验提炼是一次完整的 LLM 调用，结果只影响后续请求，
+                        # 放到后台线程执行，不阻塞本次结果展示
+                        background_pool.submit(agents.router.learn_from_success, query, current_code)
 
                         st.session_state.analysis_result['code'] = current_code
                         status.update(label="代码生成与系统进化完成", state="complete", expanded=False)
@@ -210,22 +349,52 @@ with tab_analyze:
                             break
                         
                         # 【核心修改】记录本次失败的尝试
-                        attempt_history.append({
-                            "code": current_code,
-                            "error": error_msg
-                        })
+                        attempt_history.append(CodeReviseAgent.make_attempt(
+                            current_code,
+                            error_msg,
+                            previous_code=last_bad_code
+                        ))
+                        
+                        if CodeReviseAgent.is_stuck(attempt_history):
+                            # 修复结果与上一轮完全相同，再试也不会有变化
+                            st.error("自动修复陷入停滞 (代码与报错均未变化)，请手动检查。")
+                            st.session_state.analysis_result['code'] = current_code
+                            status.update(label="自动修复停滞", state="error")
+                            break
                         
                         last_bad_code = current_code
                         last_error = error_msg
                         
+                        if i == max_retries - 1:
+                            # 最后一次机会：常规修复与从零重写并行竞速，取先通过校验的一路
+                            status.write("🔧 最后一次修复：同时尝试定向修复与从零重写...")
+                            current_code, winner = race_final_revision(
+                                current_code, error_msg, attempt_history,
+                                st.session_state.analysis_result['logic'],
+                                st.session_state.analysis_result['prompt_file']
+                            )
+                            if winner == "rewrite":
+                                status.write("♻️ 采用从零重写的版本")
+                                # 重写版本不是对错误代码的修复，不作为错题经验录入
+                                last_bad_code = None
+                            continue
+                        
                         status.write(f"🔧 正在尝试第 {i+1} 种修复方案 (参考前 {len(attempt_history)} 次失败)...")
                         
                         # 【核心修改】调用 revise_code 时传入 previous_attempts
-                        current_code = agents["code_revise"].revise_code(
-                            current_code, 
-                            error_message=error_msg,
-                            previous_attempts=attempt_history # <--- 关键参数
-                        )            
+                        # 流式修复：实时预览修复中的代码，完整结果到达后再做校验
+                        revise_preview = status.empty()
+                        revised = stream_to_placeholder(
+                            agents.code_revise.revise_code_stream(
+                                current_code, 
+                                error_message=error_msg,
+                                previous_attempts=attempt_history, # <--- 关键参数
+                                use_mistake_book=False
+                            ),
+                            revise_preview
+                        )
+                        current_code = revised.replace("```mermaid", "").replace("```", "").strip()
+                        revise_preview.empty()            
 
         # --- 结果展示区 ---
         if st.session_state.analysis_result:
@@ -275,6 +444,6 @@ with tab_graph:
         pass 
     
     if st.session_state.graph_built:
-        utils.visualize_knowledge_graph(agents["graph_rag"], height=700)
+        utils.visualize_knowledge_graph(agents.graph_rag, height=700)
     else:
         st.info("暂无图谱数据。")
\ No newline at end of file
@@ -1,10 +1,25 @@
 import os
 import json
 import glob
-from typing import List, Optional,Dict
+import atexit
+import difflib
+import threading
+from typing import List, Optional,Dict, Tuple
 from Agent import deepseek_agent, Message
+from utils import quick_validate_mermaid
 from rag import LocalKnowledgeBase
 
+# 向量库的错题入库标记：记录已入库的 JSON 版本 (mtime) 和 JSONL 日志读到的位置
+INGEST_MARKER_NAME = "_last_ingest.json"
+
+# 失败尝试在 Prompt 中的摘要长度上限 (字符)
+ATTEMPT_SNIPPET_LEN = 200
+ATTEMPT_DIFF_LEN = 400
+
+# 错题本批量提炼：攒够 N 条或等待超时后，合并成一次 LLM 调用
+MISTAKE_BATCH_SIZE = 8
+MISTAKE_FLUSH_INTERVAL = 30.0  # 秒
+
 class CodeReviseAgent:
     def __init__(self, 
                  knowledge_base_dir: str = "./knowledge_base", 
@@ -22,6 +37,15 @@ class CodeReviseAgent:
         self.rag = LocalKnowledgeBase("./.local_rag_db/mistakes")
         
         self.mistake_file_path = mistake_file_path
+        # 运行时新增的错题只追加写入 JSONL 日志，不再整体重写 JSON 文件
+        self.mistake_log_path = os.path.splitext(mistake_file_path)[0] + ".jsonl"
+        self._seen_q = set()
+
+        # 待提炼的错题缓冲区: [(bad_code, error_message, fixed_code), ...]
+        self._mistake_buffer = []
+        self._mistake_lock = threading.Lock()
+        self._flush_timer = None
+        atexit.register(self.flush_mistakes)
         
         # 1. 加载通用语法手册 (Markdown)
         # self._load_markdown_rules(knowledge_base_dir)
@@ -47,16 +71,146 @@ class CodeReviseAgent:
         if not os.path.exists(os.path.dirname(json_path)):
             os.makedirs(os.path.dirname(json_path), exist_ok=True)
             
-        if os.path.exists(json_path):
-            try:
-                self.rag.add_qa_mistakes(json_path)
-            except Exception as e:
-                print(f"加载错题集失败: {e}")
-        else:
+        if not os.path.exists(json_path):
             # 初始化一个空文件
             with open(json_path, 'w', encoding='utf-8') as f:
                 json.dump([], f)
 
+        # 向量库是持久化的：JSON 未变且库非空时，只需补入 JSONL 日志中新增的部分，
+        # 否则全量重建 (先清掉旧条目，避免每次启动重复入库)
+        json_mtime = os.path.getmtime(json_path)
+        marker = self._read_ingest_marker()
+        log_offset = marker.get("log_offset", 0)
+        log_size = os.path.getsize(self.mistake_log_path) if os.path.exists(self.mistake_log_path) else 0
+        is_fresh = (
+            marker.get("json_mtime") == json_mtime
+            and log_offset <= log_size
+            and self.rag.collection.count() > 0
+        )
+
+        json_loaded = True
+        if is_fresh:
+            print("⏩ 错题向量库已是最新，跳过全量入库")
+            pending, log_offset = self._read_mistake_log(since=log_offset)
+        else:
+            self.rag.clear_qa_experience()
+            try:
+                json_loaded = self.rag.add_qa_mistakes(json_path)
+            except Exception as e:
+                print(f"加载错题集失败: {e}")
+                json_loaded = False
+            pending, log_offset = self._read_mistake_log()
+
+        # 追加日志里的运行时错题
+        if pending and not self.rag.add_qa_batch([(item["q"], item["a"]) for item in pending], source="mistakes_jsonl"):
+            # 入库失败时不推进日志偏移，下次启动重试
+            log_offset = marker.get("log_offset", 0) if is_fresh else 0
+        # JSON 错题集没加载成功时标记里不记它的 mtime，下次启动走全量重建，而不是误判为"已是最新"
+        self._write_ingest_marker(json_mtime if json_loaded else 0.0, log_offset)
+
+        # 去重集合：只在启动时扫描一次
+        self._seen_q = {item.get("q") for item in self._read_mistake_json() + self._read_mistake_log()[0]}
+
+    def _ingest_marker_path(self) -> str:
+        return os.path.join(self.rag.persist_dir, INGEST_MARKER_NAME)
+
+    def _read_ingest_marker(self) -> Dict:
+        try:
+            with open(self._ingest_marker_path(), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except Exception:
+            return {}
+
+    def _write_ingest_marker(self, json_mtime: float, log_offset: int):
+        with open(self._ingest_marker_path(), 'w', encoding='utf-8') as f:
+            json.dump({"json_mtime": json_mtime, "log_offset": log_offset}, f)
+
+    def _read_mistake_json(self) -> List[Dict]:
+        try:
+            with open(self.mistake_file_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            return data if isinstance(data, list) else []
+        except Exception:
+            return []
+
+    def _read_mistake_log(self, since: int = 0) -> Tuple[List[Dict], int]:
+        """
+        从字节偏移 since 开始读取 JSONL 追加日志 (跳过坏行)
+        :return: (条目列表, 最后一个完整行之后的偏移)
+        """
+        items = []
+        offset = since
+        if not os.path.exists(self.mistake_log_path):
+            return items, 0
+        with open(self.mistake_log_path, 'rb') as f:
+            f.seek(since)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break  # 写了一半的行，留给下次
+                offset += len(line)
+                try:
+                    item = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    continue
+                if item.get("q") and item.get("a"):
+                    items.append(item)
+        return items, offset
+
+    def _retrieve_reference_context(self, error_message: str) -> str:
+        """
+        错题本检索：库里存的是 {报错特征 -> 修复策略}，向量化的是报错信息，
+        没有报错时拿代码片段去查匹配不到有效经验，直接跳过检索。
+        """
+        if not error_message:
+            return "No specific past experience found. Follow standard syntax."
+
+        retrieved_docs = self.rag.search(query=error_message, top_k=6)
+        print(f"   [RAG 知识召回]: 检索到 {len(retrieved_docs)} 条相关建议")
+        return "\n- ".join(retrieved_docs) or "No specific past experience found. Follow standard syntax."
+
+    @staticmethod
+    def make_attempt(code: str, error: str, previous_code: Optional[str] = None) -> Dict:
+        """
+        构造一条失败尝试记录 (在追加时一次性算好 Prompt 用的摘要)。
+        首次尝试保留代码前 ATTEMPT_SNIPPET_LEN 个字符；之后的尝试只保留相对上一次的 diff，
+        避免每轮把几乎相同的代码重复发给 LLM。
+        """
+        snippet = code[:ATTEMPT_SNIPPET_LEN] + "..."
+        if previous_code is not None:
+            diff_lines = difflib.unified_diff(previous_code.splitlines(), code.splitlines(), lineterm="", n=1)
+            diff = "\n".join(list(diff_lines)[2:])  # 去掉 ---/+++ 文件头
+            if diff:
+                snippet = "(diff vs previous attempt)\n" + diff[:ATTEMPT_DIFF_LEN]
+        return {"code": code, "error": error, "snippet": snippet}
+
+    @staticmethod
+    def is_stuck(previous_attempts: Optional[List[Dict]]) -> bool:
+        """
+        不动点检测：最近两次失败的代码和报错完全一致，说明修复已原地打转，
+        继续调用 LLM 只是浪费时间。
+        """
+        if not previous_attempts or len(previous_attempts) < 2:
+            return False
+        last, prev = previous_attempts[-1], previous_attempts[-2]
+        return last["code"] == prev["code"] and last["error"] == prev["error"]
+
+    @staticmethod
+    def _format_failed_attempts(previous_attempts: Optional[List[Dict]]) -> str:
+        if not previous_attempts:
+            return ""
+        text = "\n### 🚫 FAILED ATTEMPTS (DO NOT REPEAT!)\nThe following solutions have already been tried and FAILED. You must generate a DIFFERENT solution.\n"
+        for idx, attempt in enumerate(previous_attempts):
+            # 兼容外部直接传入 {"code", "error"} 的旧格式
+            code_snippet = attempt.get('snippet') or attempt.get('code', '')[:ATTEMPT_SNIPPET_LEN] + "..."
+            err_msg = attempt.get('error', '')
+            text += f"--- Attempt {idx+1} ---\n[Code Snippet]:\n{code_snippet}\n[Resulting Error]: {err_msg}\n"
+        return text
+
+    @staticmethod
+    def _clean_revision(text: str) -> str:
+        """移除 markdown 代码块标记"""
+        return text.replace("```mermaid", "").replace("```", "").strip()
+
     def revise_code(self, raw_code: str, error_message: str = "", previous_attempts: List[Dict] = None, language: str = "mermaid", use_mistake_book:bool  = False) -> str:
         """
         核心功能：接收代码和(可选的)报错信息，利用 RAG 检索策略进行修复
@@ -68,21 +222,11 @@ class CodeReviseAgent:
         # 如果没有报错(只是预检)，则用代码片段去查通用的 Markdown 语法书
         reference_context = ""
         if use_mistake_book:
-            search_query = error_message if error_message else raw_code[:200]
-            retrieved_docs = self.rag.search(query=search_query, top_k=6)
-            reference_context = "\n- ".join(retrieved_docs)
-            if not reference_context:
-                reference_context = "No specific past experience found. Follow standard syntax."
-
-            print(f"   [RAG 知识召回]: 检索到 {len(retrieved_docs)} 条相关建议")
+            reference_context = self._retrieve_reference_context(error_message)
 
         # 2. 构建 Prompt
         # 构造失败历史的文本块
-        failed_history_text = ""
-        if previous_attempts:
-            failed_history_text = "\n### 🚫 FAILED ATTEMPTS (DO NOT REPEAT!)\nThe following solutions have already been tried and FAILED. You must generate a DIFFERENT solution.\n"
-            for idx, attempt in enumerate(previous_attempts):
-                failed_history_text += f"--- Attempt {idx+1} ---\n[Code Snippet]:\n{attempt['code'][:200]}...\n[Resulting Error]: {attempt['error']}\n"
+        failed_history_text = self._format_failed_attempts(previous_attempts)
         
         system_prompt = (
             f"You are an expert **Code Reviser** for {language}.\n"
@@ -105,15 +249,17 @@ class CodeReviseAgent:
         
         # 3. 调用 LLM
         try:
-            revised_code = self.llm.chat([{"role": "user", "content": user_content}], system_prompt=system_prompt)
-            # 清洗
-            revised_code = revised_code.replace("```mermaid", "").replace("```", "").strip()
-            return revised_code
+            revised_code = self.llm.chat_cached(
+                [{"role": "user", "content": user_content}], system_prompt=system_prompt,
+                # 只缓存修好的结果：修复失败时重试要能拿到新的答案
+                is_cacheable=lambda r: quick_validate_mermaid(self._clean_revision(r))['valid']
+            )
+            return self._clean_revision(revised_code)
         except Exception as e:
             print(f"修订调用失败: {e}")
             return raw_code
         
-    def revise_code_stream(self, raw_code: str, error_message: str = "", previous_attempts: List[Dict] = None, language: str = "mermaid"):
+    def revise_code_stream(self, raw_code: str, error_message: str = "", previous_attempts: List[Dict] = None, language: str = "mermaid", use_mistake_book: bool = True):
         """
         【流式修复接口】支持打字机效果
         逻辑与 revise_code 完全一致，只是改为 yield 输出
@@ -121,22 +267,12 @@ class CodeReviseAgent:
         print(f"🌊 [CodeRevise] 开始流式修订 (Ref: ErrorLog? {bool(error_message)})")
         
         # 1. RAG 检索策略 (完全复用原有逻辑)
-        search_query = error_message if error_message else raw_code[:200]
-        retrieved_docs = self.rag.search(query=search_query, top_k=6)
-        
-        reference_context = "\n- ".join(retrieved_docs)
-        if not reference_context:
-            reference_context = "No specific past experience found. Follow standard syntax."
+        reference_context = ""
+        if use_mistake_book:
+            reference_context = self._retrieve_reference_context(error_message)
 
         # 2. 构建 Prompt (完全复用原有逻辑)
-        failed_history_text = ""
-        if previous_attempts:
-            failed_history_text = "\n### 🚫 FAILED ATTEMPTS (DO NOT REPEAT!)\nThe following solutions have already been tried and FAILED. You must generate a DIFFERENT solution.\n"
-            for idx, attempt in enumerate(previous_attempts):
-                # 做了简单的防御，防止字段缺失报错
-                code_snippet = attempt.get('code', '')[:200]
-                err_msg = attempt.get('error', '')
-                failed_history_text += f"--- Attempt {idx+1} ---\n[Code Snippet]:\n{code_snippet}...\n[Resulting Error]: {err_msg}\n"
+        failed_history_text = self._format_failed_attempts(previous_attempts)
         
         system_prompt = (
             f"You are an expert **Code Reviser** for {language}.\n"
@@ -197,58 +333,99 @@ class CodeReviseAgent:
         """
         核心功能 (错题本)：
         当修复成功后，调用此函数。
-        让 LLM 总结 {q: 报错特征, a: 通用修复策略} 并存入文件。
+        错题先进入缓冲区，攒够 MISTAKE_BATCH_SIZE 条 (或等待 MISTAKE_FLUSH_INTERVAL 秒) 后
+        由 flush_mistakes 一次性让 LLM 总结 {q: 报错特征, a: 通用修复策略} 并存入文件。
         """
-        print("📝 正在记录错题经验 (Experience Replay)...")
+        print("📝 错题已加入待提炼队列 (Experience Replay)...")
+        with self._mistake_lock:
+            self._mistake_buffer.append((bad_code, error_message, fixed_code))
+            should_flush = len(self._mistake_buffer) >= MISTAKE_BATCH_SIZE
+            if not should_flush and self._flush_timer is None:
+                self._flush_timer = threading.Timer(MISTAKE_FLUSH_INTERVAL, self.flush_mistakes)
+                self._flush_timer.daemon = True
+                self._flush_timer.start()
+
+        if should_flush:
+            self.flush_mistakes()
+
+    def flush_mistakes(self):
+        """把缓冲区里的错题合并成一次 LLM 调用提炼规则，并一次性写入文件"""
+        with self._mistake_lock:
+            batch, self._mistake_buffer = self._mistake_buffer, []
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+        if not batch:
+            return
+
+        print(f"📝 正在批量提炼错题经验 ({len(batch)} 条)...")
         
         # 1. 构造 Prompt 让 LLM 提炼规则
         system_prompt = (
             "You are a Tech Lead summarizing coding mistakes.\n"
-            "Compare the Bad Code and Fixed Code based on the Error Log.\n"
-            "Extract a GENERIC rule in JSON format: {\"q\": \"Error feature\", \"a\": \"Fix strategy\"}.\n"
+            "For EACH numbered case, compare the Bad Code and Fixed Code based on the Error Log.\n"
+            "Extract GENERIC rules in JSON format: {\"rules\": [{\"q\": \"Error feature\", \"a\": \"Fix strategy\"}, ...]}, one rule per case.\n"
             "Rules:\n"
             "1. 'q' should capture the key part of the error message (for vector matching).\n"
             "2. 'a' should be a general advice (e.g., 'Do not use spaces in IDs'), NOT specific to this user's variable names.\n"
             "3. Output JSON ONLY."
         )
         
-        user_content = (
+        user_content = "\n\n".join(
+            f"### Case {idx+1}\n"
             f"Error: {error_message}\n"
             f"Bad Code Fragment: {bad_code[:300]}...\n"
             f"Fixed Code Fragment: {fixed_code[:300]}..."
+            for idx, (bad_code, error_message, fixed_code) in enumerate(batch)
         )
         
         try:
             response = self.llm.chat([{"role": "user", "content": user_content}], system_prompt=system_prompt, json_mode=True)
             result = json.loads(response)
+            if isinstance(result, dict):
+                # 只有一条时模型常直接返回 {"q":..., "a":...}，当作单元素列表处理
+                rules = [result] if "q" in result else result.get("rules", [])
+            else:
+                rules = result
+            if isinstance(rules, dict):
+                rules = [rules]
             
-            new_q = result.get("q")
-            new_a = result.get("a")
+            # 2. 避免完全重复，并追加写入日志 (O(新增条数)，不重写整个文件)
+            new_rules = []
+            with self._mistake_lock:
+                for rule in rules:
+                    if not isinstance(rule, dict): continue
+                    new_q, new_a = rule.get("q"), rule.get("a")
+                    if new_q and new_a and new_q not in self._seen_q:
+                        self._seen_q.add(new_q)
+                        new_rules.append((new_q, new_a))
+
+                if new_rules:
+                    log_start = os.path.getsize(self.mistake_log_path) if os.path.exists(self.mistake_log_path) else 0
+                    with open(self.mistake_log_path, 'a', encoding='utf-8') as f:
+                        f.write("".join(json.dumps({"q": q, "a": a}, ensure_ascii=False) + "\n" for q, a in new_rules))
+                    log_end = os.path.getsize(self.mistake_log_path)
+
+            if not new_rules:
+                print("重复的经验，跳过录入。")
+                return
             
-            if new_q and new_a:
-                # 2. 写入文件
-                current_data = []
-                if os.path.exists(self.mistake_file_path):
-                    with open(self.mistake_file_path, 'r', encoding='utf-8') as f:
-                        try:
-                            current_data = json.load(f)
-                        except:
-                            current_data = []
-                
-                # 避免完全重复
-                if not any(item['q'] == new_q for item in current_data):
-                    current_data.append({"q": new_q, "a": new_a})
-                    with open(self.mistake_file_path, 'w', encoding='utf-8') as f:
-                        json.dump(current_data, f, ensure_ascii=False, indent=2)
-                    
-                    # 3. 运行时热更新 (让它立即生效)
-                    self.rag.add_single_qa(new_q, new_a, source="auto_recorded")
-                    print(f"✅ 错题已录入: {new_q[:50]}...")
-                else:
-                    print("重复的经验，跳过录入。")
+            # 3. 运行时热更新 (让它立即生效)
+            if not self.rag.add_qa_batch(new_rules, source="auto_recorded"):
+                # 未入库的条目留在日志里，入库标记不动，下次启动会补入
+                print(f"⚠️ 错题已写入日志但未能热加载 ({len(new_rules)} 条)，将在下次启动时入库")
+                return
+
+            # 入库成功后才推进标记；标记停在更早的位置 (之前有失败) 时保持不动，下次启动一并补入
+            with self._mistake_lock:
+                marker = self._read_ingest_marker()
+                if marker and marker.get("log_offset") == log_start:
+                    self._write_ingest_marker(marker.get("json_mtime", 0.0), log_end)
+            print(f"✅ 错题已录入 {len(new_rules)} 条")
                     
         except Exception as e:
             print(f"记录错题失败: {e}")
+
     def reload_llm_config(self, config: dict):
         """
         【热更新】接收前端配置(驼峰命名)并更新底层 LLM
@@ -1,8 +1,20 @@
 import os
+import re
+from functools import lru_cache
 from Agent import deepseek_agent, Message
+from utils import quick_validate_mermaid
 from typing import List, Optional
 
+@lru_cache(maxsize=32)
+def _read_prompt(file_path: str) -> str:
+    """读取提示词文件 (运行期不变，按路径缓存；文件不存在时抛异常，不会进缓存)"""
+    with open(file_path, 'r', encoding='utf-8') as f:
+        return f.read().strip()
+
 class CodeGenAgent:
+    # markdown 代码块头尾标记 (头部预留了 python 等其他语言标记)
+    _CLEAN_RE = re.compile(r'\A```(?:mermaid|python|javascript|xml|json)?|```\Z')
+
     def __init__(self, model_name: str = "deepseek-chat", prompt_dir: str = "./prompt/code_gen"):
         """
         初始化代码生成 Agent
@@ -27,27 +39,18 @@ class CodeGenAgent:
         if not prompt_filename.endswith(".md"):
             prompt_filename += ".md"
             
-        file_path = os.path.join(self.prompt_dir, prompt_filename)
+        file_path = os.path.normpath(os.path.join(self.prompt_dir, prompt_filename))
         
-        if not os.path.exists(file_path):
+        try:
+            return _read_prompt(file_path)
+        except FileNotFoundError:
             error_msg = f"错误: 提示词文件 '{file_path}' 未找到。请检查 prompt 目录下是否存在该文件。"
             print(error_msg)
             # 返回一个极其基础的默认 Prompt 防止程序直接崩溃
             return "You are a code generator, please generate mermaid code for user's content."
-            
-        with open(file_path, 'r', encoding='utf-8') as f:
-            content = f.read().strip()
-            return content
 
-    def generate_code(self, input_text: str, prompt_file: str = "flowchart.md",richness:float = 0.5) -> str:
-        """
-        【通用生成接口】
-        根据传入的 prompt_file 不同，生成不同类型的代码 (流程图、思维导图、Python绘图等)
-        
-        :param input_text: 用户的需求描述或逻辑文本
-        :param prompt_file: 位于 prompt 文件夹下的文件名
-        """
-        # 1. 加载 Prompt
+    def _build_system_prompt(self, prompt_file: str, richness: float) -> str:
+        """加载 Prompt 文件并追加丰富度 (richness) 控制要求"""
         system_prompt = self._load_system_prompt(prompt_file)
         
         richness_requirement = f"""
@@ -73,7 +76,20 @@ class CodeGenAgent:
             **Constraint**: Your output Mermaid code complexity MUST strictly match the richness level of **{richness}**.
             """
         
-        system_prompt += richness_requirement
+        return system_prompt + richness_requirement
+
+    def generate_code(self, input_text: str, prompt_file: str = "flowchart.md",richness:float = 0.5, use_cache: bool = True) -> str:
+        """
+        【通用生成接口】
+        根据传入的 prompt_file 不同，生成不同类型的代码 (流程图、思维导图、Python绘图等)
+        
+        :param input_text: 用户的需求描述或逻辑文本
+        :param prompt_file: 位于 prompt 文件夹下的文件名
+        :param use_cache: 是否复用缓存 (只缓存通过校验的结果)；需要一次全新尝试时传 False
+        """
+        # 1. 加载 Prompt
+        system_prompt = self._build_system_prompt(prompt_file, richness)
+        
         # 2. 构建消息
         messages: List[Message] = [
             {"role": "user", "content": f"[Requirements or content]:\n{input_text}"}
@@ -82,18 +98,25 @@ class CodeGenAgent:
         print(f"正在生成代码 (模式: {prompt_file}, Input长度: {len(input_text)})...")
         
         # 3. 调用 LLM
-        response = self.llm.chat(messages, system_prompt=system_prompt)
+        if use_cache:
+            response = self.llm.chat_cached(messages, system_prompt=system_prompt, is_cacheable=self._is_valid_code)
+        else:
+            response = self.llm.chat(messages, system_prompt=system_prompt)
 
         # 4. 清洗代码 (移除 Markdown 标记)
         return self._clean_code(response)
 
-    def generate_code_stream(self, input_text: str, prompt_file: str = "flowchart.md"):
+    def _is_valid_code(self, response: str) -> bool:
+        """缓存准入：清洗后能通过图表校验的结果才缓存 (校验结论本身有缓存，调用方随后的校验不会重复请求)"""
+        return quick_validate_mermaid(self._clean_code(response))['valid']
+
+    def generate_code_stream(self, input_text: str, prompt_file: str = "flowchart.md", richness: float = 0.5):
         """
         【流式生成接口】支持打字机效果
         逻辑与 generate_code 完全一致，只是改为 yield 输出
         """
         # 1. 加载 Prompt (复用原有逻辑)
-        system_prompt = self._load_system_prompt(prompt_file)
+        system_prompt = self._build_system_prompt(prompt_file, richness)
         
         # 2. 构建消息
         messages: List[Message] = [
@@ -111,22 +134,7 @@ class CodeGenAgent:
         
     def _clean_code(self, text: str) -> str:
         """内部工具：移除 markdown 代码块标记，提取纯代码"""
-        text = text.strip()
-        
-        # 移除常见的 markdown 代码块头部
-        # 这里不仅包含 mermaid，也预留了 python 等其他标记
-        prefixes = ["```mermaid", "```python", "```javascript", "```xml", "```json", "```"]
-        
-        for prefix in prefixes:
-            if text.startswith(prefix):
-                text = text[len(prefix):]
-                break # 只要匹配到一个前缀就跳出
-        
-        # 移除结尾的 ```
-        if text.endswith("```"):
-            text = text[:-3]
-            
-        return text.strip()
+        return self._CLEAN_RE.sub('', text.strip()).strip()
     def reload_llm_config(self, config: dict):
         """
         【热更新】接收前端配置(驼峰命名)并更新底层 LLM
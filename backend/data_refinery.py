@@ -1,7 +1,6 @@
 import os
-import glob
 import json
-import hashlib
+import xxhash
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from tqdm import tqdm # 建议安装: pip install tqdm，如果没有安装，脚本会自动降级处理
 
@@ -12,13 +11,56 @@ from Agent import deepseek_agent
 # ================= 配置区 =================
 RAW_DATA_DIR = "./knowledge/mermaid_code"
 EXPERIENCE_DB = "./knowledge/experience/router.json"
+# 炼丹新增经验以 JSON Lines 追加写入，不再整体重写 router.json (RouterAgent 启动时会一并加载)
+EXPERIENCE_LOG = os.path.splitext(EXPERIENCE_DB)[0] + ".jsonl"
 MODEL_NAME = "deepseek-chat" # 使用 Chat 模型即可，成本低速度快
 
 # 过滤阈值
 MIN_LINES = 5
 MAX_LINES = 100
+# 行数统计的读取块大小 (64 KiB)
+LINE_COUNT_CHUNK = 1 << 16
+# 行数过滤的并发线程数 (纯磁盘 I/O，read 期间释放 GIL)
+LINE_COUNT_WORKERS = 16
+# 每次 LLM 调用分析的片段数
+ANALYZE_BATCH_SIZE = 8
 # ==========================================
 
+# 炼丹 Prompt (模块级常量，不必每次调用都重建)
+# 我们要求 LLM 对每个片段做两件事：鉴别真伪 + 提炼经验
+_ANALYST_SYSTEM_PROMPT = (
+    "You are a Mermaid Code Analyst. Your task is to analyze each of the provided code snippets independently.\n"
+    "1. **Validation**: Check if it is valid Mermaid code. (Ignore minor syntax errors, focus on structure).\n"
+    "2. **Extraction**: If valid, extract the 'Scenario' (What is this graph about?) and 'Design Strategy' (Why use this chart type? Layout? Key features?).\n\n"
+    "Output STRICT JSON format, with one entry per snippet:\n"
+    "{\n"
+    "  \"results\": [\n"
+    "    {\n"
+    "      \"idx\": <snippet number>,\n"
+    "      \"is_mermaid\": true/false,\n"
+    "      \"q\": \"Brief description of the content/scenario (e.g., User Login Flow)\",\n"
+    "      \"a\": \"Brief explanation of design choices (e.g., Used SequenceDiagram to show time-ordered interactions...)\"\n"
+    "    }\n"
+    "  ]\n"
+    "}"
+)
+# 批量 User Prompt 中单个片段的模板
+_SNIPPET_TEMPLATE = "### Snippet {idx}\n```mermaid\n{code}\n```"
+
+# 内容哈希算法标识：随记录一起落盘，算法变更后旧记录的 _hash 不再可信，加载时按源码重算
+HASH_ALG = "xxh3_128"
+
+def content_hash(code: str) -> str:
+    """
+    内容去重用的哈希 (非安全用途，miner 与 refinery 共用)：
+    xxh3_128 远快于 md5，32 字符十六进制摘要与 md5 文件名等长
+    """
+    return xxhash.xxh3_128(code.encode('utf-8')).hexdigest()
+
+def dedup_key(hex_digest: str) -> bytes:
+    """去重集合里存 16 字节原始摘要而非 32 字符十六进制串，每条约省一半内存"""
+    return bytes.fromhex(hex_digest)
+
 class DataRefinery:
     def __init__(self):
         print(f"--- 初始化 DataRefinery [模型: {MODEL_NAME}] ---")
@@ -28,93 +70,140 @@ class DataRefinery:
         os.makedirs(os.path.dirname(EXPERIENCE_DB), exist_ok=True)
         
         # 加载现有经验库 (防止重复炼丹)
+        # 元素为 dedup_key() 得到的 bytes
         self.existing_hashes = set()
+        for item in self._load_existing_items():
+            # 计算源码的 hash 用于去重 (JSONL 新记录自带当前算法的 _hash，无需重算)
+            if "_hash" in item and item.get("_hash_alg") == HASH_ALG:
+                self.existing_hashes.add(dedup_key(item["_hash"]))
+            elif "source_code" in item:
+                self.existing_hashes.add(dedup_key(content_hash(item["source_code"].strip())))
+        print(f"📚 已加载现有经验库: {len(self.existing_hashes)} 条经验")
+
+    def _load_existing_items(self):
+        """读取旧版 router.json 与 JSONL 追加日志中的全部经验 (坏行跳过)"""
+        items = []
         if os.path.exists(EXPERIENCE_DB):
             try:
                 with open(EXPERIENCE_DB, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    for item in data:
-                        # 计算源码的 hash 用于去重
-                        if "source_code" in item:
-                            code_hash = hashlib.md5(item["source_code"].strip().encode()).hexdigest()
-                            self.existing_hashes.add(code_hash)
-                print(f"📚 已加载现有经验库: {len(self.existing_hashes)} 条经验")
+                    items.extend(json.load(f))
             except Exception as e:
-                print(f"⚠️ 读取现有经验库失败: {e}，将重新创建。")
-                self.existing_hashes = set()
+                print(f"⚠️ 读取现有经验库失败: {e}")
+        if os.path.exists(EXPERIENCE_LOG):
+            with open(EXPERIENCE_LOG, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        items.append(json.loads(line))
+                    except ValueError:
+                        continue
+        return items
 
     def _count_lines(self, file_path):
-        """快速统计行数"""
+        """
+        快速统计行数：按块读取字节并用 bytes.count 数换行符 (C 层实现)。
+        超过 MAX_LINES 立即返回，超大文件只需读一个块即可淘汰。
+        """
+        cnt = 0
+        last = b""
         try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                return sum(1 for _ in f)
-        except:
+            with open(file_path, 'rb', buffering=0) as f:
+                read = f.read
+                while True:
+                    b = read(LINE_COUNT_CHUNK)
+                    if not b: break
+                    cnt += b.count(b'\n')
+                    if cnt > MAX_LINES: return cnt
+                    last = b
+        except OSError:
             return 0
+        # 与逐行迭代保持一致：末行没有换行符时也算一行
+        if last and not last.endswith(b'\n'):
+            cnt += 1
+        return cnt
 
-    def _analyze_single_file(self, file_path):
+    def _analyze_batch(self, file_paths):
         """
         核心处理逻辑：读取 -> 校验 -> LLM分析 -> 返回结构化数据
+        一次 LLM 调用分析一批片段，摊薄 HTTP 往返和重复的 System Prompt。
+        :return: 与 file_paths 一一对应的结果列表，元素为 经验dict / "INVALID" / None (跳过)
         """
+        results = [None] * len(file_paths)
         try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                code = f.read().strip()
-            
-            # 1. 基础哈希去重 check
-            code_hash = hashlib.md5(code.encode()).hexdigest()
-            if code_hash in self.existing_hashes:
-                return None # 跳过已存在的
+            # 1. 读取 + 基础哈希去重 check
+            batch = []  # [(结果下标, code, code_hash)]
+            for i, file_path in enumerate(file_paths):
+                try:
+                    with open(file_path, 'r', encoding='utf-8') as f:
+                        code = f.read().strip()
+                except (OSError, UnicodeDecodeError) as e:
+                    # 单个文件读不了只跳过它，不拖累同批其他片段
+                    print(f"⚠️ 读取失败，跳过 {os.path.basename(file_path)}: {e}")
+                    continue
+                code_hash = content_hash(code)
+                if dedup_key(code_hash) in self.existing_hashes:
+                    continue # 跳过已存在的
+                batch.append((i, code, code_hash))
+            if not batch:
+                return results
 
             # 2. 构造 Prompt
-            # 我们要求 LLM 做两件事：鉴别真伪 + 提炼经验
-            system_prompt = (
-                "You are a Mermaid Code Analyst. Your task is to analyze the provided code snippet.\n"
-                "1. **Validation**: Check if it is valid Mermaid code. (Ignore minor syntax errors, focus on structure).\n"
-                "2. **Extraction**: If valid, extract the 'Scenario' (What is this graph about?) and 'Design Strategy' (Why use this chart type? Layout? Key features?).\n\n"
-                "Output STRICT JSON format:\n"
-                "{\n"
-                "  \"is_mermaid\": true/false,\n"
-                "  \"q\": \"Brief description of the content/scenario (e.g., User Login Flow)\",\n"
-                "  \"a\": \"Brief explanation of design choices (e.g., Used SequenceDiagram to show time-ordered interactions...)\"\n"
-                "}"
+            user_msg = "\n\n".join(
+                _SNIPPET_TEMPLATE.format(idx=idx, code=code) for idx, (_, code, _) in enumerate(batch)
             )
-
-            user_msg = f"Code snippet:\n```mermaid\n{code}\n```"
             
             # 3. 调用 LLM
             response = self.llm.chat(
                 [{"role": "user", "content": user_msg}], 
-                system_prompt=system_prompt, 
+                system_prompt=_ANALYST_SYSTEM_PROMPT, 
                 json_mode=True
             )
             
-            result = json.loads(response)
+            parsed = json.loads(response).get("results", [])
             
-            # 4. 结果处理
-            if result.get("is_mermaid") is True:
-                # 成功提炼
-                return {
-                    "q": result.get("q", "Unknown Scenario"),
-                    "a": result.get("a", "Standard Layout"),
-                    "source_code": code # 按照要求，保留源码作为案底
-                }
-            else:
-                # LLM 认为这不是 Mermaid 代码 (可能是误爬的 markdown 文本)
-                return "INVALID"
+            # 4. 结果处理 (按 idx 映射回文件；模型漏掉的片段按跳过处理，下次运行还会再试)
+            for result in parsed:
+                idx = result.get("idx")
+                if not isinstance(idx, int) or not 0 <= idx < len(batch):
+                    continue
+                i, code, code_hash = batch[idx]
+                if result.get("is_mermaid") is True:
+                    # 成功提炼
+                    results[i] = {
+                        "q": result.get("q", "Unknown Scenario"),
+                        "a": result.get("a", "Standard Layout"),
+                        "source_code": code, # 按照要求，保留源码作为案底
+                        "_hash": code_hash,  # 去重哈希随记录一起返回并落盘，后续不必重算
+                        "_hash_alg": HASH_ALG
+                    }
+                else:
+                    # LLM 认为这不是 Mermaid 代码 (可能是误爬的 markdown 文本)
+                    results[i] = "INVALID"
 
         except Exception as e:
-            # print(f"Error processing {file_path}: {e}")
-            return None
+            # print(f"Error processing batch: {e}")
+            pass
+        return results
 
     def run(self):
         print(f"🚀 开始扫描目录: {RAW_DATA_DIR}")
-        all_files = glob.glob(os.path.join(RAW_DATA_DIR, "*.mmd"))
+        # scandir 的 DirEntry 自带 stat 信息：每行至少 1 个字节，体积不足 MIN_LINES 字节的直接淘汰
+        all_files = []
+        sized_files = []
+        if not os.path.isdir(RAW_DATA_DIR):
+            print("没有可处理的原始数据目录。")
+            return
+        with os.scandir(RAW_DATA_DIR) as it:
+            for entry in it:
+                if not entry.name.endswith(".mmd") or not entry.is_file():
+                    continue
+                all_files.append(entry.path)
+                if entry.stat().st_size >= MIN_LINES:
+                    sized_files.append(entry.path)
         
-        # 1. 第一轮过滤：硬规则 (行数)
-        candidates = []
-        for p in all_files:
-            lines = self._count_lines(p)
-            if MIN_LINES <= lines <= MAX_LINES:
-                candidates.append(p)
+        # 1. 第一轮过滤：硬规则 (行数)，多线程并发读盘
+        with ThreadPoolExecutor(max_workers=LINE_COUNT_WORKERS) as ex:
+            line_counts = list(ex.map(self._count_lines, sized_files))
+        candidates = [p for p, n in zip(sized_files, line_counts) if MIN_LINES <= n <= MAX_LINES]
         
         print(f"🔍 扫描到 {len(all_files)} 个文件，经行数过滤({MIN_LINES}-{MAX_LINES})后剩余 {len(candidates)} 个候选。")
         
@@ -124,29 +213,28 @@ class DataRefinery:
         
         # 2. 第二轮：并发 LLM 提炼
         # 根据你的 API 额度调整 max_workers，DeepSeek 通常 5-10 并发没问题
+        batches = [candidates[i:i + ANALYZE_BATCH_SIZE] for i in range(0, len(candidates), ANALYZE_BATCH_SIZE)]
         with ThreadPoolExecutor(max_workers=5) as executor:
-            # 提交任务
-            future_to_file = {executor.submit(self._analyze_single_file, fp): fp for fp in candidates}
+            # 提交任务 (按批)
+            futures = [executor.submit(self._analyze_batch, batch) for batch in batches]
             
             # 进度条处理
             try:
-                iterator = tqdm(as_completed(future_to_file), total=len(candidates), desc="炼丹进度")
+                iterator = tqdm(as_completed(futures), total=len(batches), desc="炼丹进度")
             except ImportError:
-                iterator = as_completed(future_to_file)
+                iterator = as_completed(futures)
                 print("提示: 安装 tqdm 可显示进度条 (pip install tqdm)")
 
             for future in iterator:
-                res = future.result()
-                
-                if res == "INVALID":
-                    invalid_count += 1
-                elif res is None:
-                    skipped_count += 1
-                else:
-                    new_experiences.append(res)
-                    # 实时写入哈希防止本次运行重复 (虽然 glob 不会重，但为了逻辑严谨)
-                    code_hash = hashlib.md5(res['source_code'].encode()).hexdigest()
-                    self.existing_hashes.add(code_hash)
+                for res in future.result():
+                    if res == "INVALID":
+                        invalid_count += 1
+                    elif res is None:
+                        skipped_count += 1
+                    else:
+                        new_experiences.append(res)
+                        # 实时写入哈希防止本次运行重复 (虽然文件列表不会重，但为了逻辑严谨)
+                        self.existing_hashes.add(dedup_key(res['_hash']))
 
         print(f"\n📊 炼丹报告:")
         print(f"   ✅ 新增经验: {len(new_experiences)} 条")
@@ -155,31 +243,18 @@ class DataRefinery:
 
         # 3. 结果保存
         if new_experiences:
-            self._save_to_json(new_experiences)
+            self._append_experiences(new_experiences)
         else:
             print("没有提取到新经验。")
 
-    def _save_to_json(self, new_items):
-        """将新经验追加到 JSON 文件"""
-        final_data = []
-        
-        # 读取旧数据
-        if os.path.exists(EXPERIENCE_DB):
-            try:
-                with open(EXPERIENCE_DB, 'r', encoding='utf-8') as f:
-                    final_data = json.load(f)
-            except:
-                final_data = []
-        
-        # 追加新数据
-        final_data.extend(new_items)
-        
-        # 写入
-        with open(EXPERIENCE_DB, 'w', encoding='utf-8') as f:
-            json.dump(final_data, f, ensure_ascii=False, indent=2)
+    def _append_experiences(self, new_items):
+        """将新经验逐行追加到 JSONL 日志：O(新增条数)，中途崩溃也不会丢失已写入的行"""
+        with open(EXPERIENCE_LOG, 'a', encoding='utf-8') as f:
+            for item in new_items:
+                f.write(json.dumps(item, ensure_ascii=False) + "\n")
             
-        print(f"💾 经验池已更新，当前总容量: {len(final_data)} 条。")
-        print(f"📂 文件路径: {EXPERIENCE_DB}")
+        print(f"💾 经验池已追加 {len(new_items)} 条。")
+        print(f"📂 文件路径: {EXPERIENCE_LOG}")
 
 if __name__ == "__main__":
     refinery = DataRefinery()
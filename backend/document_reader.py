@@ -1,12 +1,63 @@
 import os
+import asyncio
+import aiohttp
 import requests
 import tempfile
 import shutil
 import base64
+import hashlib
+import json
 import mimetypes
-from pathlib import Path
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse
-from Agent import Agent
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from typing import BinaryIO, List, Optional, Tuple
+from Agent import Agent, LLM_ERROR_PREFIX
+
+# 远程文件下载：块大小 1 MiB，超时 (连接, 读取) 秒
+DOWNLOAD_CHUNK = 1 << 20
+DOWNLOAD_TIMEOUT = (5, 30)
+# 下载连接池与瞬时故障重试 (连接错误 / 5xx)
+DOWNLOAD_POOL_CONNECTIONS = 10
+DOWNLOAD_POOL_MAXSIZE = 20
+DOWNLOAD_RETRY = Retry(total=3, backoff_factor=0.3, status_forcelist=(500, 502, 503, 504))
+# 批量分析：同时进行的 LLM 分析数 (避免压垮 DashScope)，以及异步下载的连接上限
+ANALYZE_CONCURRENCY = 8
+ASYNC_DOWNLOAD_LIMIT = 32
+ASYNC_DOWNLOAD_LIMIT_PER_HOST = 8
+# 已上传到 DashScope 的文件：内容哈希 -> file_id，同一文件换个 Prompt 再分析时不必重新上传解析
+FILE_ID_CACHE_PATH = "./.local_llm_cache/dashscope_files.json"
+HASH_CHUNK = 1 << 20
+# URL 下载的内存缓冲上限，超过后自动转存到临时文件
+SPOOL_MAX_SIZE = 32 << 20
+# 图片 base64 流式编码的读取块大小：必须是 3 的倍数，分块编码结果才能直接拼接
+B64_CHUNK = 3 * 65536
+# 超过该大小的本地图片改为上传后以 fileid:// 引用，避免 base64 内联带来的 ~33% 请求体膨胀
+IMAGE_UPLOAD_MIN_BYTES = 256 * 1024
+# 错误信息中出现这些关键词才认定服务端不接受 fileid 图片 (永久改用 base64)；超时、限流等临时错误只对本次调用回退
+FILEID_REJECT_MARKERS = ("fileid", "file_id", "file id", "image format", "invalid image",
+                         "unsupported image", "image url", "invalid url")
+# 分析结果 LRU 缓存条数 (键为 文件内容哈希 + Prompt + 长度限制 + 模型)
+RESPONSE_CACHE_SIZE = 128
+# 常见后缀直接查表得到 MIME，未知后缀才回退到 mimetypes (其映射表首次使用时要加载系统数据库)
+_FAST_MIME = {
+    '.pdf': 'application/pdf',
+    '.png': 'image/png',
+    '.jpg': 'image/jpeg',
+    '.jpeg': 'image/jpeg',
+    '.gif': 'image/gif',
+    '.webp': 'image/webp',
+    '.docx': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+    '.txt': 'text/plain',
+}
+
+def _guess_mime(name: str) -> str:
+    """按文件名推断 MIME 类型，无法判断时返回空字符串"""
+    ext = os.path.splitext(name)[1].lower()
+    return _FAST_MIME.get(ext) or mimetypes.guess_type(name)[0] or ""
 
 class DocumentAnalyzer(Agent):
     """
@@ -30,6 +81,24 @@ class DocumentAnalyzer(Agent):
         # 定义视觉模型名称，用于在分析图片时临时切换
         self.vision_model = "qwen-vl-max"
 
+        # 远程文件下载复用同一个会话，连续分析多个 URL 时不必重复握手
+        self._http = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=DOWNLOAD_POOL_CONNECTIONS,
+            pool_maxsize=DOWNLOAD_POOL_MAXSIZE,
+            max_retries=DOWNLOAD_RETRY
+        )
+        self._http.mount("http://", adapter)
+        self._http.mount("https://", adapter)
+
+        self._file_id_cache = self._load_file_id_cache()
+        self._file_id_lock = threading.Lock()
+        # 视觉模型不接受 fileid:// 图片时置为 False，之后一律走 base64 内联
+        self._image_fileid_ok = True
+        # 相同文件 + 相同指令的分析结果 (temperature=0.1，结果基本确定)，重复调用直接返回
+        self._resp_cache = OrderedDict()
+        self._resp_lock = threading.Lock()
+
         # --- 预定义 System Prompts ---
         # 1. 视觉分析提示词 (移植自原 vision.py)
         self.vision_system_prompt = (
@@ -50,6 +119,12 @@ class DocumentAnalyzer(Agent):
             "Synthesize the above into a coherent summary of what is happening and the underlying intent or narrative of the scene."
         )
 
+    def __del__(self):
+        # 释放下载会话持有的 keep-alive 连接
+        http = getattr(self, "_http", None)
+        if http is not None:
+            http.close()
+
     def _is_url(self, path_string):
         """判断字符串是否为 URL"""
         try:
@@ -58,58 +133,189 @@ class DocumentAnalyzer(Agent):
         except ValueError:
             return False
 
-    def _download_file(self, url):
+    def _filename_for(self, url):
+        """从 URL 推断文件名 (用于判断类型及上传时的文件名)"""
+        path = urlparse(url).path
+        filename = os.path.basename(path)
+        if not filename:
+            filename = "temp_downloaded_doc"
+            # 尝试根据 Content-Type 猜后缀，这里简单处理
+            if url.endswith(".pdf"): filename += ".pdf"
+            elif url.endswith(".png"): filename += ".png"
+            elif url.endswith(".jpg") or url.endswith(".jpeg"): filename += ".jpg"
+        return filename
+
+    def _temp_path_for(self, url):
+        """为下载文件在新建的临时目录中分配本地路径"""
+        return os.path.join(tempfile.mkdtemp(), self._filename_for(url))
+
+    def _download_to_spool(self, url):
         """
-        下载 URL 文件到临时目录
-        :return: (临时文件路径, 是否需要清理的标记)
+        下载 URL 文件：小文件留在内存里，超过 SPOOL_MAX_SIZE 才落到临时文件 (关闭即删除)，
+        下载内容直接交给上传/编码，不再经过一次"写盘再读盘"
+        :return: (文件名, 已定位到开头的二进制文件对象)
         """
+        spool = None
         try:
-            path = urlparse(url).path
-            filename = os.path.basename(path)
-            if not filename:
-                filename = "temp_downloaded_doc"
-                # 尝试根据 Content-Type 猜后缀，这里简单处理
-                if url.endswith(".pdf"): filename += ".pdf"
-                elif url.endswith(".png"): filename += ".png"
-                elif url.endswith(".jpg") or url.endswith(".jpeg"): filename += ".jpg"
-            
-            temp_dir = tempfile.mkdtemp()
-            local_path = os.path.join(temp_dir, filename)
-
             print(f"⬇️ [UnifiedReader] Downloading from URL: {url}")
-            with requests.get(url, stream=True) as r:
+            spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+            with self._http.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT) as r:
                 r.raise_for_status()
-                with open(local_path, 'wb') as f:
-                    for chunk in r.iter_content(chunk_size=8192):
-                        f.write(chunk)
-            
-            return local_path, True 
+                # 直接从底层流按大块拷贝 (自动解压 gzip 等编码)，省去 Python 层的逐块循环
+                r.raw.decode_content = True
+                shutil.copyfileobj(r.raw, spool, DOWNLOAD_CHUNK)
+            spool.seek(0)
+            return self._filename_for(url), spool
         except Exception as e:
+            # 下载失败时立即关闭 (已落盘的临时文件随之删除)，不留到垃圾回收
+            if spool is not None:
+                spool.close()
             raise Exception(f"Failed to download file: {str(e)}")
 
-    def _encode_image(self, image_path: str) -> str:
-        """读取本地图片转 Base64 (用于 Vision API)"""
-        mime_type, _ = mimetypes.guess_type(image_path)
-        if not mime_type:
-            mime_type = "image/jpeg"
+    async def _download_file_async(self, session: aiohttp.ClientSession, url: str) -> str:
+        """异步下载：供 analyze_many 并发下载，返回临时文件路径"""
+        local_path = self._temp_path_for(url)
+        print(f"⬇️ [UnifiedReader] Downloading from URL: {url}")
+        async with session.get(url) as r:
+            r.raise_for_status()
+            with open(local_path, 'wb') as f:
+                async for chunk in r.content.iter_chunked(DOWNLOAD_CHUNK):
+                    f.write(chunk)
+        return local_path
+
+    async def analyze_many(self, sources: List[str], prompt: str = None, max_token_limit: int = None) -> List[str]:
+        """
+        批量分析入口：URL 源通过 aiohttp 并发下载，各文件的 LLM 分析在线程池中并发执行
+        (最多 ANALYZE_CONCURRENCY 个)。总耗时从 Σ 往返降到约 max 往返。
+        :return: 与 sources 顺序一致的分析结果
+        """
+        loop = asyncio.get_running_loop()
+        sem = asyncio.Semaphore(ANALYZE_CONCURRENCY)
+        connector = aiohttp.TCPConnector(
+            limit=ASYNC_DOWNLOAD_LIMIT, limit_per_host=ASYNC_DOWNLOAD_LIMIT_PER_HOST, ttl_dns_cache=300
+        )
+        timeout = aiohttp.ClientTimeout(sock_connect=DOWNLOAD_TIMEOUT[0], sock_read=DOWNLOAD_TIMEOUT[1])
+
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            async def analyze_one(source: str) -> str:
+                temp_path: Optional[str] = None
+                try:
+                    local_path = source
+                    if self._is_url(source):
+                        temp_path = local_path = await self._download_file_async(session, source)
+                    async with sem:
+                        return await loop.run_in_executor(None, self.analyze, local_path, prompt, max_token_limit)
+                except Exception as e:
+                    print(f"❌ [UnifiedReader] Error: {str(e)}")
+                    return f"Error in unified analysis: {str(e)}"
+                finally:
+                    if temp_path:
+                        shutil.rmtree(os.path.dirname(temp_path), ignore_errors=True)
+
+            return await asyncio.gather(*(analyze_one(s) for s in sources))
+
+    @staticmethod
+    def _load_file_id_cache() -> dict:
+        try:
+            with open(FILE_ID_CACHE_PATH, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_file_id_cache(self):
+        os.makedirs(os.path.dirname(FILE_ID_CACHE_PATH), exist_ok=True)
+        with open(FILE_ID_CACHE_PATH, 'w', encoding='utf-8') as f:
+            json.dump(self._file_id_cache, f)
+
+    @staticmethod
+    def _file_digest(source: BinaryIO) -> str:
+        """按块流式计算文件内容哈希 (blake2b，非安全用途)，结束后回到开头"""
+        h = hashlib.blake2b(digest_size=16)
+        source.seek(0)
+        for block in iter(lambda: source.read(HASH_CHUNK), b""):
+            h.update(block)
+        source.seek(0)
+        return h.hexdigest()
+
+    def _get_file_id(self, name: str, source: BinaryIO, digest: str, refresh: bool = False) -> Tuple[str, bool]:
+        """
+        获取文件在 DashScope 上的 file_id：内容相同的文件只上传一次
+        :param refresh: 为 True 时忽略缓存强制重新上传 (缓存的 file_id 已过期时使用)
+        :return: (file_id, 是否来自缓存)
+        """
+        with self._file_id_lock:
+            file_id = self._file_id_cache.get(digest)
+        if file_id and not refresh:
+            print(f"♻️ [UnifiedReader] Reusing uploaded file: {file_id}")
+            return file_id, True
+
+        # 上传文件 (Qwen-Long file-extract 协议)
+        print(f"📤 [UnifiedReader] Uploading to DashScope: {name}...")
+        source.seek(0)
+        file_object = self.client.files.create(
+            file=(name, source),
+            purpose="file-extract"
+        )
+        print(f"✅ [UnifiedReader] File ID: {file_object.id}")
+
+        with self._file_id_lock:
+            self._file_id_cache[digest] = file_object.id
+            self._save_file_id_cache()
+        return file_object.id, False
+
+    def analyze_batch(self, sources: List[str], prompt: str = None, max_token_limit: int = None, max_workers: int = ANALYZE_CONCURRENCY) -> List[str]:
+        """
+        同步版批量分析 (供线程中的调用方使用)：各文件的 analyze 互相独立，
+        线程池并发执行，最多 max_workers 个同时请求 DashScope。
+        :return: 与 sources 顺序一致的分析结果
+        """
+        if not sources:
+            return []
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(sources)), thread_name_prefix="doc-analyze") as executor:
+            return list(executor.map(lambda src: self.analyze(src, prompt, max_token_limit), sources))
+
+    def _encode_image(self, name: str, source: BinaryIO) -> str:
+        """图片内容转 Base64 Data URL (用于 Vision API)"""
+        mime_type = _guess_mime(name) or "image/jpeg"
         try:
-            with open(image_path, "rb") as image_file:
-                base64_encoded_data = base64.b64encode(image_file.read()).decode('utf-8')
-            return f"data:{mime_type};base64,{base64_encoded_data}"
+            # 分块编码：不必先把整张图片读进内存再整体编码
+            buf = bytearray()
+            source.seek(0)
+            for chunk in iter(lambda: source.read(B64_CHUNK), b""):
+                buf += base64.b64encode(chunk)
+            return f"data:{mime_type};base64,{buf.decode('ascii')}"
         except Exception as e:
-            raise ValueError(f"无法读取图片: {image_path}, 错误: {e}")
+            raise ValueError(f"无法读取图片: {name}, 错误: {e}")
 
-    def analyze(self, file_source: str, prompt: str = None, max_token_limit: int = None) -> str:
+    def _response_key(self, digest: str, prompt: Optional[str], max_token_limit: Optional[int], model: str) -> str:
+        h = hashlib.blake2b(digest_size=16)
+        for part in (digest, prompt or "", str(max_token_limit), model):
+            h.update(part.encode("utf-8"))
+            h.update(b"\0")
+        return h.hexdigest()
+
+    def _cache_get(self, key: str) -> Optional[str]:
+        with self._resp_lock:
+            response = self._resp_cache.get(key)
+            if response is not None:
+                self._resp_cache.move_to_end(key)
+            return response
+
+    def _cache_put(self, key: str, response: str):
+        with self._resp_lock:
+            self._resp_cache[key] = response
+            self._resp_cache.move_to_end(key)
+            while len(self._resp_cache) > RESPONSE_CACHE_SIZE:
+                self._resp_cache.popitem(last=False)
+
+    def analyze(self, file_source: str, prompt: str = None, max_token_limit: int = None, disable_cache: bool = False) -> str:
         """
         统一分析入口 (Unified Entry Point)
         :param file_source: 本地文件路径 或 文件 URL
         :param prompt: 用户指令 (可选)。若为空，则使用内置默认提示词。
         :param max_token_limit: (新增) 最大输出长度限制 (Token/字数)，用于防止多文件时上下文溢出。
+        :param disable_cache: 为 True 时跳过结果缓存，强制重新调用模型
         """
-        local_path = file_source
-        is_temp = False
-        file_id = None
-
         # --- 0. 构造字数限制指令 ---
         limit_instruction = ""
         if max_token_limit:
@@ -120,101 +326,117 @@ class DocumentAnalyzer(Agent):
             )
 
         try:
-            # --- 1. 处理文件源 (URL vs Local) ---
+            # --- 1. 处理文件源 (URL vs Local)：统一成 (文件名, 二进制文件对象) ---
             if self._is_url(file_source):
-                local_path, is_temp = self._download_file(file_source)
+                name, source = self._download_to_spool(file_source)
             else:
-                if not os.path.exists(local_path):
-                    return f"Error: File not found at {local_path}"
+                if not os.path.exists(file_source):
+                    return f"Error: File not found at {file_source}"
+                name, source = os.path.basename(file_source), open(file_source, "rb")
+
+            # 退出时关闭文件；下载缓冲随之释放 (落盘的临时文件也会自动删除)
+            with source:
+                digest = self._file_digest(source)
+                model = self.vision_model if _guess_mime(name).startswith("image/") else self.model_name
+                key = self._response_key(digest, prompt, max_token_limit, model)
+                if not disable_cache:
+                    cached = self._cache_get(key)
+                    if cached is not None:
+                        print(f"⚡ [UnifiedReader] Cache hit: {name}")
+                        return cached
 
-            # --- 2. 智能分流 (Image vs Document) ---
-            mime_type, _ = mimetypes.guess_type(local_path)
-            if not mime_type: mime_type = ""
+                response = self._analyze_source(name, source, digest, prompt, limit_instruction)
+                # 失败的调用不缓存，下次仍会重试
+                if not response.startswith(LLM_ERROR_PREFIX):
+                    self._cache_put(key, response)
+                return response
+
+        except Exception as e:
+            print(f"❌ [UnifiedReader] Error: {str(e)}")
+            return f"Error in unified analysis: {str(e)}"
+        # 注意：DashScope 的云端文件通常会自动过期或需要显式删除，视需求可调用 self.client.files.delete(file_id)
+
+    def _analyze_source(self, name: str, source: BinaryIO, digest: str, prompt: Optional[str], limit_instruction: str) -> str:
+        # --- 2. 智能分流 (Image vs Document) ---
+        mime_type = _guess_mime(name)
+        
+        is_image = mime_type.startswith("image/")
+        
+        # ====== 分支 A: 视觉分析 (Vision) ======
+        if is_image:
+            print(f"👁️ [UnifiedReader] Detected Image format: {name}")
             
-            is_image = mime_type.startswith("image/")
+            # 准备 Prompt (如果用户没给，就用默认的逻辑提取指令)
+            user_query = prompt if prompt else "Please analyze the image structure and logic."
+            final_query = user_query + limit_instruction
             
-            # ====== 分支 A: 视觉分析 (Vision) ======
-            if is_image:
-                print(f"👁️ [UnifiedReader] Detected Image format: {os.path.basename(local_path)}")
-                
-                # 准备 Prompt (如果用户没给，就用默认的逻辑提取指令)
-                user_query = prompt if prompt else "Please analyze the image structure and logic."
-                final_query = user_query + limit_instruction
-                
-                # 构造 Payload
-                img_data = self._encode_image(local_path)
-                messages = [
+            def build_messages(image_url):
+                return [
                     {
                         "role": "user",
                         "content": [
-                            {"type": "image_url", "image_url": {"url": img_data}},
+                            {"type": "image_url", "image_url": {"url": image_url}},
                             {"type": "text", "text": final_query},
                         ]
                     }
                 ]
-                
-                # 临时切换到 Vision 模型
-                original_model = self.model_name
-                self.model_name = self.vision_model
-                try:
-                    # 使用专门的 Vision System Prompt
-                    response = self.chat(messages, system_prompt=self.vision_system_prompt)
+
+            # 本次调用使用 Vision 模型 (按调用传入，不改实例状态，并发分析时互不干扰)
+            # 使用专门的 Vision System Prompt
+            # 大图：上传一次 (按内容哈希复用 file_id)，请求里只带 fileid:// 引用
+            size = source.seek(0, os.SEEK_END)
+            if self._image_fileid_ok and size > IMAGE_UPLOAD_MIN_BYTES:
+                file_id, _ = self._get_file_id(name, source, digest)
+                response = self.chat(build_messages(f"fileid://{file_id}"),
+                                     system_prompt=self.vision_system_prompt, model_name=self.vision_model)
+                if not response.startswith(LLM_ERROR_PREFIX):
                     return response
-                finally:
-                    self.model_name = original_model # 恢复原状
-            
-            # ====== 分支 B: 文档分析 (File Extract) ======
-            else:
-                print(f"📄 [UnifiedReader] Detected Document format: {os.path.basename(local_path)}")
-                
-                # 准备 Prompt
-                if not prompt:
-                    prompt = (
-                        "Please analyze this document carefully to extract core information suitable for creating technical diagrams.\n"
-                        "Focus on:\n"
-                        "1. Key Entities & Roles\n"
-                        "2. Relationships & Interactions\n"
-                        "3. Process Logic & Conditions\n"
-                        "Instruction: Remove irrelevant decorative text."
-                    )
-                
-                final_prompt = prompt + limit_instruction
-
-                # 上传文件 (Qwen-Long file-extract 协议)
-                file_path = Path(local_path)
-                print(f"📤 [UnifiedReader] Uploading to DashScope: {file_path.name}...")
-                
-                file_object = self.client.files.create(
-                    file=file_path,
-                    purpose="file-extract"
-                )
-                file_id = file_object.id
-                print(f"✅ [UnifiedReader] File ID: {file_id}")
-
-                # Qwen-Long 需要在 system prompt 中注入 fileid
-                system_instruction = f"fileid://{file_id}"
-                
-                response_content = self.chat(
-                    messages=[{"role": "user", "content": final_prompt}],
-                    system_prompt=system_instruction
-                )
-
-                return response_content
+                if any(marker in response.lower() for marker in FILEID_REJECT_MARKERS):
+                    print("⚠️ [UnifiedReader] fileid image rejected, switching to inline base64")
+                    self._image_fileid_ok = False
+                else:
+                    print("⚠️ [UnifiedReader] fileid image request failed, retrying once with inline base64")
 
-        except Exception as e:
-            print(f"❌ [UnifiedReader] Error: {str(e)}")
-            return f"Error in unified analysis: {str(e)}"
+            # 小图 (或不支持 fileid 时)：base64 内联
+            img_data = self._encode_image(name, source)
+            response = self.chat(build_messages(img_data), system_prompt=self.vision_system_prompt, model_name=self.vision_model)
+            return response
         
-        finally:
-            # --- 3. 清理资源 ---
-            if is_temp and local_path and os.path.exists(local_path):
-                try:
-                    shutil.rmtree(os.path.dirname(local_path))
-                    print(f"🧹 [UnifiedReader] Cleaned up temp files.")
-                except OSError as e:
-                    print(f"⚠️ [UnifiedReader] Cleanup failed: {e}")
-            
-            # 注意：DashScope 的云端文件通常会自动过期或需要显式删除，视需求可在此调用 self.client.files.delete(file_id)
+        # ====== 分支 B: 文档分析 (File Extract) ======
+        print(f"📄 [UnifiedReader] Detected Document format: {name}")
+        
+        # 准备 Prompt
+        if not prompt:
+            prompt = (
+                "Please analyze this document carefully to extract core information suitable for creating technical diagrams.\n"
+                "Focus on:\n"
+                "1. Key Entities & Roles\n"
+                "2. Relationships & Interactions\n"
+                "3. Process Logic & Conditions\n"
+                "Instruction: Remove irrelevant decorative text."
+            )
+        
+        final_prompt = prompt + limit_instruction
+
+        # 上传文件 (按内容哈希复用已上传的 file_id)
+        file_id, from_cache = self._get_file_id(name, source, digest)
+
+        # Qwen-Long 需要在 system prompt 中注入 fileid
+        response_content = self.chat(
+            messages=[{"role": "user", "content": final_prompt}],
+            system_prompt=f"fileid://{file_id}"
+        )
+
+        # 缓存的 file_id 可能已在云端过期：调用失败时重新上传再试一次
+        if from_cache and response_content.startswith(LLM_ERROR_PREFIX):
+            file_id, _ = self._get_file_id(name, source, digest, refresh=True)
+            response_content = self.chat(
+                messages=[{"role": "user", "content": final_prompt}],
+                system_prompt=f"fileid://{file_id}"
+            )
+
+        return response_content
+
     # 在 DocumentAnalyzer 类中添加以下方法
 
     def analyze_code_file(self, file_path: str, project_root: str = None) -> str:
@@ -0,0 +1,44 @@
+import os
+import threading
+import torch
+from sentence_transformers import SentenceTransformer
+
+# 默认 Embedding 模型：中英文效果顶级 (约 2.5GB)
+# 如果下载慢，请提前下载好模型文件夹，把下面的字符串换成路径
+DEFAULT_EMBED_MODEL = "BAAI/bge-m3"
+# CPU 推理后端：默认 PyTorch。
+# 可选 EMBED_CPU_BACKEND=onnx 启用 ONNX Runtime 加速 (需另行 pip install "optimum[onnxruntime]"，未列入 requirements)，
+# 加载失败时自动回退到 PyTorch
+CPU_BACKEND = os.getenv("EMBED_CPU_BACKEND", "torch")
+
+_models = {}
+_models_lock = threading.Lock()
+
+def _load_cpu_model(model_name: str) -> SentenceTransformer:
+    if CPU_BACKEND == "torch":
+        return SentenceTransformer(model_name, device="cpu")
+    try:
+        return SentenceTransformer(model_name, device="cpu", backend=CPU_BACKEND)
+    except Exception as e:
+        print(f"⚠️ {CPU_BACKEND} 后端加载失败，回退到 PyTorch: {e}")
+        return SentenceTransformer(model_name, device="cpu")
+
+def get_embedding_model(model_name: str = DEFAULT_EMBED_MODEL) -> SentenceTransformer:
+    """
+    进程内共享的 Embedding 模型。
+    GraphRAG、错题本 RAG、Router 经验库原先各自加载一份 bge-m3，
+    现在同名模型只加载一次，所有调用方复用同一份权重。
+    """
+    with _models_lock:
+        model = _models.get(model_name)
+        if model is None:
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+            print(f"正在加载 Embedding 模型 ({model_name}) 到 {device}...")
+            if device == "cuda":
+                model = SentenceTransformer(model_name, device=device)
+                # GPU 上用 FP16 推理：显存带宽减半，并能用上 Tensor Core
+                model.half()
+            else:
+                model = _load_cpu_model(model_name)
+            _models[model_name] = model
+        return model
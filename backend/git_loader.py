@@ -1,13 +1,98 @@
 import os
+import re
+import heapq
 import subprocess
 import shutil
 import logging
-from typing import Dict, List, Set
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Dict, FrozenSet, List, Optional, Tuple
 
 # 配置日志
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# 目录遍历的并发线程数 (stat/dirent 系统调用期间释放 GIL)
+SCAN_WORKERS = 8
+
+# 定义分类规则 (后缀名)
+EXT_RULES = {
+    "source_code": frozenset({
+        '.py', '.java', '.c', '.cpp', '.h', '.hpp', '.cs', '.go', '.rs', 
+        '.js', '.jsx', '.ts', '.tsx', '.php', '.rb', '.swift', '.kt', 
+        '.scala', '.lua', '.pl', '.sh', '.bat'
+    }),
+    "configuration": frozenset({
+        '.json', '.yaml', '.yml', '.toml', '.ini', '.cfg', '.conf', 
+        '.env', '.gitignore', '.dockerignore', '.xml', '.gradle', 
+        '.properties', '.cmake'
+    }),
+    "documentation": frozenset({
+        '.md', '.markdown', '.rst', '.txt', '.pdf', '.doc', '.docx'
+    })
+}
+
+# 定义特定文件名规则 (优先级高于后缀)
+FILENAME_RULES = {
+    "configuration": frozenset({
+        'dockerfile', 'makefile', 'cmakelists.txt', 'requirements.txt', 
+        'package.json', 'tsconfig.json', 'pom.xml', 'setup.py', 'go.mod', 'go.sum'
+    }),
+    "documentation": frozenset({
+        'readme', 'license', 'contributing', 'changelog', 'authors', 'faq', 'notice'
+    })
+}
+
+# 由上面的规则预先生成的反向索引：每个文件一次字典查找即可定类
+EXT_TO_CATEGORY = {ext: cat for cat, exts in EXT_RULES.items() for ext in exts}
+CONFIG_FILENAMES = FILENAME_RULES['configuration']
+# 文件名 (去后缀) 中包含 readme 等关键词即视为文档
+DOC_NAME_RE = re.compile('|'.join(map(re.escape, FILENAME_RULES['documentation'])))
+
+# 需要忽略的目录
+CLASSIFY_IGNORE_DIRS = frozenset({'.git', '__pycache__', 'node_modules', 'venv', '.idea', '.vscode', 'dist', 'build'})
+# 目录树额外忽略的目录与文件后缀
+TREE_EXTRA_IGNORE_DIRS = frozenset({'coverage', 'target'})
+# smart_select_files 的关键词权重配置：每组合并成一个正则，一次扫描找出路径中出现的全部关键词
+HIGH_WEIGHT_KEYWORDS = ['core', 'main', 'app', 'server', 'api', 'service', 'model', 'controller', 'router', 'utils', 'lib', 'src']
+LOW_WEIGHT_KEYWORDS = ['test', 'demo', 'example', 'sample', 'doc', 'mock', 'bench']
+HIGH_WEIGHT_RE = re.compile('|'.join(map(re.escape, HIGH_WEIGHT_KEYWORDS)))
+LOW_WEIGHT_RE = re.compile('|'.join(map(re.escape, LOW_WEIGHT_KEYWORDS)))
+TREE_IGNORE_EXTS = frozenset({'.png', '.jpg', '.jpeg', '.gif', '.ico', '.svg', '.pyc', '.class', '.exe', '.dll', '.so'})
+# smart_select_files 的文件级加分规则
+SCORE_BONUS_EXTS = ('.py', '.js', '.ts', '.java', '.go')
+CORE_FILENAMES = frozenset({'main.py', 'app.py', 'index.js', 'server.go', 'application.java', 'api.py'})
+
+def _split_ext(name: str) -> Tuple[str, str]:
+    """
+    等价于 os.path.splitext (仅用于不含路径分隔符的文件名)：常见情况只做一次 rfind。
+    以点开头的文件名 (如 .gitignore) 规则特殊，仍交给 os.path.splitext。
+    """
+    if name.startswith('.'):
+        return os.path.splitext(name)
+    dot = name.rfind('.')
+    if dot > 0:
+        return name[:dot], name[dot:]
+    return name, ''
+
+def _scan_dir(path: str, ignore_dirs: FrozenSet[str]) -> Tuple[str, List[str], List[Tuple[str, str]]]:
+    """
+    扫描单个目录 (一次 os.scandir)，DirEntry 自带类型信息与完整路径，无需再 stat / 拼接路径
+    :return: (目录路径, 需要继续遍历的子目录路径, [(文件名, 文件路径), ...])
+    """
+    subdirs, files = [], []
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                # 与 os.walk 一致：不跟随目录符号链接
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name not in ignore_dirs:
+                        subdirs.append(entry.path)
+                elif entry.is_file():
+                    files.append((entry.name, entry.path))
+    except OSError as e:
+        logger.warning(f"无法读取目录 {path}: {e}")
+    return path, subdirs, files
+
 class GitHubLoader:
     def __init__(self, base_dir: str = "./.Project"):
         """
@@ -34,6 +119,9 @@ class GitHubLoader:
 
         if os.path.exists(target_path):
             if force_update:
+                # 已有同一远端的克隆：增量拉取最新提交即可，只传输变化的对象
+                if self._update_repo(repo_url, target_path):
+                    return target_path
                 logger.info(f"目录已存在，正在清理旧文件: {target_path}")
                 shutil.rmtree(target_path, ignore_errors=True)
             else:
@@ -43,11 +131,16 @@ class GitHubLoader:
         logger.info(f"正在克隆仓库 {repo_url} 到 {target_path} ...")
         try:
             # 使用系统 git 命令，避免依赖 heavy 的 gitpython 库
+            # 浅克隆只取默认分支、不取 tag；协议 v2 让服务端只广播需要的引用
+            # GIT_TERMINAL_PROMPT=0：私有/不存在的仓库直接失败，而不是卡在账号密码输入上
             subprocess.run(
-                ["git", "clone", "--depth", "1", repo_url, target_path],
+                ["git", "-c", "protocol.version=2", "clone",
+                 "--depth", "1", "--single-branch", "--no-tags",
+                 repo_url, target_path],
                 check=True,
                 stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE
+                stderr=subprocess.PIPE,
+                env={**os.environ, "GIT_TERMINAL_PROMPT": "0"}
             )
             logger.info("克隆完成。")
         except subprocess.CalledProcessError as e:
@@ -56,11 +149,122 @@ class GitHubLoader:
         
         return target_path
 
-    def classify_files(self, repo_path: str) -> Dict[str, List[str]]:
+    def _update_repo(self, repo_url: str, target_path: str) -> bool:
+        """
+        将已存在的浅克隆更新到远端最新提交 (fetch + reset --hard + clean)
+        :return: 是否更新成功；失败时由调用方删除后重新克隆
+        """
+        if not os.path.isdir(os.path.join(target_path, '.git')):
+            return False
+
+        def git(*args):
+            return subprocess.run(
+                ["git", "-C", target_path, *args],
+                check=True,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                env={**os.environ, "GIT_TERMINAL_PROMPT": "0"}
+            )
+
+        try:
+            # 不同作者的同名仓库会落到同一目录，远端不一致时不能复用
+            origin = git("config", "--get", "remote.origin.url").stdout.decode().strip()
+            if origin != repo_url:
+                return False
+            logger.info(f"目录已存在，正在增量更新: {target_path}")
+            git("-c", "protocol.version=2", "fetch", "--depth", "1", "--no-tags", "origin")
+            git("reset", "--hard", "FETCH_HEAD")
+            git("clean", "-fdx")
+            logger.info("更新完成。")
+            return True
+        except (OSError, subprocess.CalledProcessError) as e:
+            logger.warning(f"增量更新失败，改为重新克隆: {e}")
+            return False
+
+    def _walk_parallel(self, repo_path: str, ignore_dirs: FrozenSet[str]) -> List[Tuple[str, List[Tuple[str, str]]]]:
+        """
+        并发版 os.walk：每个目录交给线程池扫描，扫出的子目录再提交回线程池。
+        结果顺序不固定 (与完成先后有关)。
+        :return: [(目录路径, [(文件名, 文件路径), ...]), ...]
+        """
+        results = []
+        with ThreadPoolExecutor(max_workers=SCAN_WORKERS) as pool:
+            pending = {pool.submit(_scan_dir, repo_path, ignore_dirs)}
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    root, subdirs, files = fut.result()
+                    results.append((root, files))
+                    pending |= {pool.submit(_scan_dir, d, ignore_dirs) for d in subdirs}
+        return results
+
+    def _list_tracked_files(self, repo_path: str) -> Optional[List[str]]:
+        """
+        用 git ls-files 直接从索引读出受版本控制的文件 (相对路径，'/' 分隔)
+        :return: 文件列表；不是 git 仓库或 git 调用失败时返回 None
+        """
+        if not os.path.isdir(os.path.join(repo_path, '.git')):
+            return None
+        try:
+            result = subprocess.run(
+                ["git", "-C", repo_path, "ls-files", "-z"],
+                check=True,
+                capture_output=True
+            )
+        except (OSError, subprocess.CalledProcessError) as e:
+            logger.warning(f"git ls-files 失败，改为遍历目录: {e}")
+            return None
+        return [p for p in result.stdout.decode('utf-8', errors='surrogateescape').split('\0') if p]
+
+    def _index_tracked_files(self, repo_path: str, ignore_dirs: FrozenSet[str]) -> Optional[List[Tuple[Tuple[str, ...], str, List[Tuple[str, str]]]]]:
+        """
+        把 git ls-files 的结果按目录归组，产出与目录遍历相同的结构 (免去逐目录 readdir/stat)
+        :return: 按路径分量排序的 [(路径分量, 目录路径, [(文件名, 文件路径), ...]), ...]；不可用时返回 None
         """
-        遍历仓库文件并进行分类
+        tracked = self._list_tracked_files(repo_path)
+        if tracked is None:
+            return None
+
+        # 路径分量 -> (目录路径, 带结尾分隔符的前缀, 文件列表)；文件路径用前缀直接拼接
+        dirs = {(): (repo_path, os.path.join(repo_path, ''), [])}
+        for rel in tracked:
+            *parts, name = rel.split('/')
+            parts = tuple(parts)
+            entry = dirs.get(parts)
+            if entry is None:
+                if ignore_dirs.intersection(parts):
+                    continue
+                # 只含子目录的目录在 ls-files 里没有条目，需要补齐各级祖先目录
+                for i in range(1, len(parts) + 1):
+                    if parts[:i] not in dirs:
+                        root = os.path.join(repo_path, *parts[:i])
+                        dirs[parts[:i]] = (root, root + os.sep, [])
+                entry = dirs[parts]
+            entry[2].append((name, entry[1] + name))
+
+        return sorted((parts, root, files) for parts, (root, _, files) in dirs.items())
+
+    def _classify(self, file_name: str) -> str:
+        """按文件名/后缀判断文件类别"""
+        file_lower = file_name.lower()
+        filename_no_ext, ext = _split_ext(file_lower)
+
+        # 1. 优先检查特定文件名
+        # 特殊处理：setup.py 虽然是 py 文件，但在项目中通常归为配置
+        if file_lower in CONFIG_FILENAMES:
+            return 'configuration'
+        # 检查文件名是否包含 readme 等关键词
+        if DOC_NAME_RE.search(filename_no_ext):
+            return 'documentation'
+
+        # 2. 检查后缀名
+        return EXT_TO_CATEGORY.get(ext, 'others')
+
+    def walk_and_index(self, repo_path: str) -> Tuple[Dict[str, List[str]], str]:
+        """
+        一次遍历同时完成文件分类与目录树生成 (原先两者各自 os.walk 一遍)
         :param repo_path: 仓库本地路径
-        :return: 包含分类路径列表的字典
+        :return: (包含分类路径列表的字典, 紧凑的项目目录树文本)
         """
         classified_files = {
             "documentation": [], # 介绍性文件
@@ -68,159 +272,95 @@ class GitHubLoader:
             "source_code": [],   # 核心代码
             "others": []         # 其他资源(图片等)
         }
+        tree_lines = []
+        start_dir = os.path.abspath(repo_path)
 
-        # 定义分类规则 (后缀名)
-        ext_rules = {
-            "source_code": {
-                '.py', '.java', '.c', '.cpp', '.h', '.hpp', '.cs', '.go', '.rs', 
-                '.js', '.jsx', '.ts', '.tsx', '.php', '.rb', '.swift', '.kt', 
-                '.scala', '.lua', '.pl', '.sh', '.bat'
-            },
-            "configuration": {
-                '.json', '.yaml', '.yml', '.toml', '.ini', '.cfg', '.conf', 
-                '.env', '.gitignore', '.dockerignore', '.xml', '.gradle', 
-                '.properties', '.cmake'
-            },
-            "documentation": {
-                '.md', '.markdown', '.rst', '.txt', '.pdf', '.doc', '.docx'
-            }
-        }
+        # 克隆下来的仓库优先从 git 索引列出文件 (自动遵守 .gitignore，不扫 .git 内部与构建产物)
+        walked = self._index_tracked_files(repo_path, CLASSIFY_IGNORE_DIRS)
+        if walked is None:
+            # 并发遍历 (跳过忽略的目录)；按路径分量排序即得到与 os.walk 相同的先序 (目录在其子目录之前)
+            walked = []
+            for root, files in self._walk_parallel(repo_path, CLASSIFY_IGNORE_DIRS):
+                rel = os.path.relpath(root, repo_path)
+                parts = () if rel == os.curdir else tuple(rel.split(os.sep))
+                walked.append((parts, root, files))
+            walked.sort(key=lambda item: item[0])
 
-        # 定义特定文件名规则 (优先级高于后缀)
-        filename_rules = {
-            "configuration": {
-                'dockerfile', 'makefile', 'cmakelists.txt', 'requirements.txt', 
-                'package.json', 'tsconfig.json', 'pom.xml', 'setup.py', 'go.mod', 'go.sum'
-            },
-            "documentation": {
-                'readme', 'license', 'contributing', 'changelog', 'authors', 'faq', 'notice'
-            }
-        }
+        for parts, root, files in walked:
+            # --- 分类 ---
+            for file, path in files:
+                classified_files[self._classify(file)].append(path)
 
-        # 需要忽略的目录
-        ignore_dirs = {'.git', '__pycache__', 'node_modules', 'venv', '.idea', '.vscode', 'dist', 'build'}
-
-        for root, dirs, files in os.walk(repo_path):
-            # 修改 dirs 列表以跳过忽略的目录
-            dirs[:] = [d for d in dirs if d not in ignore_dirs]
-
-            for file in files:
-                file_path = os.path.join(root, file)
-                file_lower = file.lower()
-                filename_no_ext = os.path.splitext(file_lower)[0]
-                _, ext = os.path.splitext(file_lower)
-
-                is_classified = False
-
-                # 1. 优先检查特定文件名
-                if file_lower in filename_rules['configuration'] or (file_lower == 'setup.py'):
-                    # 特殊处理：setup.py 虽然是 py 文件，但在项目中通常归为配置
-                    classified_files['configuration'].append(file_path)
-                    is_classified = True
-                
-                # 检查文件名是否包含 readme 等关键词
-                elif any(key in filename_no_ext for key in filename_rules['documentation']):
-                    classified_files['documentation'].append(file_path)
-                    is_classified = True
-                
-                # 2. 检查后缀名
-                if not is_classified:
-                    if ext in ext_rules['source_code']:
-                        classified_files['source_code'].append(file_path)
-                    elif ext in ext_rules['configuration']:
-                        classified_files['configuration'].append(file_path)
-                    elif ext in ext_rules['documentation']:
-                        classified_files['documentation'].append(file_path)
-                    else:
-                        classified_files['others'].append(file_path)
+            # --- 目录树 (额外忽略 coverage/target 等目录，以及图片/二进制文件) ---
+            if TREE_EXTRA_IGNORE_DIRS.intersection(parts):
+                continue
+            level = len(parts)
+            if level == 0:
+                tree_lines.append(f"📦 {os.path.basename(start_dir)}")
+            else:
+                indent = '│   ' * (level - 1) + '├── '
+                tree_lines.append(f"{indent}📂 {parts[-1]}/")
+            sub_indent = '│   ' * level + '├── '
+            for f, _ in files:
+                ext = _split_ext(f)[1]
+                if ext.lower() not in TREE_IGNORE_EXTS:
+                    tree_lines.append(f"{sub_indent}📄 {f}")
 
         # 统计输出
         logger.info(f"文件分类完成: "
                     f"代码({len(classified_files['source_code'])}), "
                     f"配置({len(classified_files['configuration'])}), "
                     f"文档({len(classified_files['documentation'])})")
-        
-        return classified_files
-    # 在 GitHubLoader 类中添加以下方法
+
+        return classified_files, "\n".join(tree_lines)
+
+    def classify_files(self, repo_path: str) -> Dict[str, List[str]]:
+        """
+        遍历仓库文件并进行分类 (只需要分类结果时使用；两者都要请直接调用 walk_and_index)
+        :param repo_path: 仓库本地路径
+        :return: 包含分类路径列表的字典
+        """
+        return self.walk_and_index(repo_path)[0]
+
     def generate_tree_structure(self, repo_path: str) -> str:
         """
         生成紧凑的项目目录树，辅助 AI 理解整体架构
         """
-        tree_lines = []
-        start_dir = os.path.abspath(repo_path)
-        
-        # 忽略规则
-        ignore_dirs = {'.git', '__pycache__', 'node_modules', 'venv', '.idea', '.vscode', 'dist', 'build', 'coverage', 'target'}
-        ignore_exts = {'.png', '.jpg', '.jpeg', '.gif', '.ico', '.svg', '.pyc', '.class', '.exe', '.dll', '.so'}
+        return self.walk_and_index(repo_path)[1]
 
-        for root, dirs, files in os.walk(start_dir):
-            # 1. 过滤目录
-            dirs[:] = [d for d in dirs if d not in ignore_dirs]
-            
-            # 计算缩进
-            level = root.replace(start_dir, '').count(os.sep)
-            indent = '│   ' * (level - 1) + '├── ' if level > 0 else ''
-            
-            if level == 0:
-                tree_lines.append(f"📦 {os.path.basename(root)}")
-            else:
-                tree_lines.append(f"{indent}📂 {os.path.basename(root)}/")
+    def _score_path(self, fpath: str) -> float:
+        """核心文件打分：不仅仅看深度，更看重目录名和文件名"""
+        score = 0
+        lower_path = fpath.lower()
+        
+        # 1. 基础分：路径越浅，分数稍微高一点点（权重低，避免深层核心被埋没）
+        depth = fpath.count(os.sep)
+        score -= depth * 0.1
+        
+        # 2. 关键目录加分 (每个命中的关键词计一次)
+        score += 5 * len(set(HIGH_WEIGHT_RE.findall(lower_path)))
+        
+        # 3. 垃圾目录减分
+        score -= 10 * len(set(LOW_WEIGHT_RE.findall(lower_path)))
+        
+        # 4. 关键文件后缀微调
+        if fpath.endswith(SCORE_BONUS_EXTS):
+            score += 2
             
-            # 2. 过滤并打印文件
-            sub_indent = '│   ' * level + '├── '
-            for f in files:
-                _, ext = os.path.splitext(f)
-                if ext.lower() not in ignore_exts:
-                    tree_lines.append(f"{sub_indent}📄 {f}")
-                    
-        return "\n".join(tree_lines)
+        # 5. 特定核心文件名加分
+        filename = os.path.basename(fpath).lower()
+        if filename in CORE_FILENAMES:
+            score += 10
+        
+        return score
 
     def smart_select_files(self, file_paths: List[str], max_files: int = 30) -> List[str]:
         """
         智能筛选核心文件：不仅仅看深度，更看重目录名和文件名
         """
-        scored_files = []
-        
-        # 关键词权重配置
-        high_weight_keywords = ['core', 'main', 'app', 'server', 'api', 'service', 'model', 'controller', 'router', 'utils', 'lib', 'src']
-        low_weight_keywords = ['test', 'demo', 'example', 'sample', 'doc', 'mock', 'bench']
-        
-        for fpath in file_paths:
-            score = 0
-            lower_path = fpath.lower()
-            
-            # 1. 基础分：路径越浅，分数稍微高一点点（权重低，避免深层核心被埋没）
-            depth = fpath.count(os.sep)
-            score -= depth * 0.1
-            
-            # 2. 关键目录加分
-            for kw in high_weight_keywords:
-                if kw in lower_path:
-                    score += 5
-            
-            # 3. 垃圾目录减分
-            for kw in low_weight_keywords:
-                if kw in lower_path:
-                    score -= 10
-            
-            # 4. 关键文件后缀微调
-            if fpath.endswith('.py') or fpath.endswith('.js') or fpath.endswith('.ts') or fpath.endswith('.java') or fpath.endswith('.go'):
-                score += 2
-                
-            # 5. 特定核心文件名加分
-            filename = os.path.basename(fpath).lower()
-            if filename in ['main.py', 'app.py', 'index.js', 'server.go', 'application.java', 'api.py']:
-                score += 10
-            
-            scored_files.append((score, fpath))
-            
-        # 按分数从高到低排序
-        scored_files.sort(key=lambda x: x[0], reverse=True)
-        
-        # 选出前 max_files 个
-        selected = [item[1] for item in scored_files[:max_files]]
+        # 只取分数最高的 max_files 个：用有界堆做部分排序，不必对全部文件排序
+        # (nlargest 与 sorted(..., reverse=True)[:n] 结果一致，同分时保持原顺序)
+        top = heapq.nlargest(max_files, ((self._score_path(f), f) for f in file_paths), key=lambda x: x[0])
         
         # 重新按路径字母序排列，方便人类阅读
-        selected.sort()
-        
-        return selected
\ No newline at end of file
+        return sorted(fpath for _, fpath in top)
@@ -3,18 +3,20 @@ import json
 import networkx as nx
 import numpy as np
 import pickle
-import torch
+import zstandard as zstd
 import heapq
 import time
 import re
 from collections import Counter, defaultdict
 from typing import List, Dict, Any, Optional, Set, Tuple
-from sentence_transformers import SentenceTransformer
+from embedding import get_embedding_model
 from concurrent.futures import ThreadPoolExecutor, as_completed
 import threading
+import asyncio
+import orjson
 
 # 假设 Agent 已经按照之前的接口实现好
-from Agent import deepseek_agent, qwen_doc_agent
+from Agent import deepseek_agent, qwen_doc_agent, make_async_http_client
 import logging
 
 # 关闭 httpx (OpenAI/DeepSeek 底层通讯库) 的 INFO 日志
@@ -29,6 +31,25 @@ logging.getLogger("openai").setLevel(logging.WARNING)
 
 MAX_RETRIES = 2
 RETRY_DELAY = 1
+# Layer 2/3 LLM 调用的共享线程池大小 (纯网络 I/O，可按服务商限流调整)
+LLM_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", "32"))
+# 同时在途的 LLM 请求上限 (服务商 Rate Limit)，默认与线程池大小一致
+LLM_MAX_INFLIGHT = int(os.getenv("LLM_MAX_INFLIGHT", str(LLM_CONCURRENCY)))
+# 图谱持久化文件：zstd 压缩的 JSON (旧版的未压缩 graph.json 仍可读取)
+GRAPH_FILE = "graph.json"
+GRAPH_ZST_FILE = "graph.json.zst"
+GRAPH_ZSTD_LEVEL = 3
+# 实体 (名称 + 描述) 向量相似度达到该阈值即视为同一实体，在 Stage 4 之前本地自动合并
+ENTITY_MERGE_THRESHOLD = 0.95
+# 实体名中的数字/版本号 (Stage 2 vs Stage 3、v1 API vs v2 API)：不一致时绝不自动合并
+ENTITY_NUMBER_RE = re.compile(r'\d+')
+# 相似度矩阵分块计算的行数 (避免一次性生成 V×V 的大矩阵)
+ENTITY_SIM_BLOCK = 1024
+# Stage 4 每个 LLM 请求负责的碎片分量数，以及每轮最多并发的请求数
+STAGE4_FRAGMENTS_PER_REQUEST = 5
+STAGE4_MAX_REQUESTS = 8
+# Embedding 批量编码的 batch 大小
+ENCODE_BATCH_SIZE = 64
 
 def clean_json_response(response: str) -> str:
     """清洗 LLM 可能返回的 markdown 标记"""
@@ -67,8 +88,18 @@ class LightGraphRAG:
         # Edges: src, dst, description, weight, source_chunk_id
         self.graph = nx.DiGraph()
         self.graph_version = 0
+        # Stage 4 使用的并查集 (弱连通分量)
+        self._uf = {}
+        self._uf_rank = {}
+        self._uf_dirty = True
+        # search 用的节点向量缓存：node_id -> (编码时的文本, 向量)
+        self._node_vecs = {}
 
         self.lock = threading.Lock() # ✅ 新增：全局图写入锁
+
+        # 各阶段复用同一个线程池；信号量限制同时在途的 LLM 请求数
+        self._pool = ThreadPoolExecutor(max_workers=LLM_CONCURRENCY, thread_name_prefix="graphrag-llm")
+        self._llm_slots = threading.BoundedSemaphore(LLM_MAX_INFLIGHT)
         
         # 2. Chunk Storage
         # 我们维护两套切片：Big Chunks 用于层级2，Small Chunks 用于层级3和最终检索
@@ -76,10 +107,10 @@ class LightGraphRAG:
         self.big_chunks = []   # List[Dict]
         
         # 3. Embedding Model
-        device = "cuda" if torch.cuda.is_available() else "cpu"
-        print(f"   🚀 Loading Embedding Model (BGE-M3) on {device}...")
+        # 与其他 RAG 组件共享同一份 bge-m3 权重
+        print(f"   🚀 Loading Embedding Model (BGE-M3)...")
         try:
-            self.embed_model = SentenceTransformer("BAAI/bge-m3", device=device)
+            self.embed_model = get_embedding_model()
         except Exception as e:
             print(f"   ❌ Embedding Model Load Failed: {e}")
             self.embed_model = None
@@ -92,6 +123,16 @@ class LightGraphRAG:
         # 5. Load State
         self.load_graph()
 
+    def close(self):
+        """释放共享线程池 (不等待在途任务)"""
+        pool = getattr(self, "_pool", None)
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    def __del__(self):
+        self.close()
+
     # =========================================================================
     # Phase 0: Pre-processing
     # =========================================================================
@@ -141,7 +182,7 @@ class LightGraphRAG:
         if not self.embed_model or not self.small_chunks: return
         print("   📊 Vectorizing Small Chunks...")
         texts = [c['text'] for c in self.small_chunks]
-        embeddings = self.embed_model.encode(texts, normalize_embeddings=True,show_progress_bar=False)
+        embeddings = self._encode_texts(texts)
         for i, chunk in enumerate(self.small_chunks):
             chunk['vec'] = embeddings[i]
 
@@ -195,81 +236,130 @@ class LightGraphRAG:
     # =========================================================================
     # Phase 2: Intermediate Structure (DeepSeek + Big Chunks)
     # =========================================================================
+    def _stage2_prompts(self, chunk: Dict, backbone_context_str: str, user_intent: str) -> Tuple[str, str]:
+        """构造单个 Big Chunk 的 Layer 2 提示词 (system, user)"""
+        system_prompt = (
+            "You are a Structural Engineer. Your goal is to Bridge local details to the Global Backbone."
+            "Prioritize connecting to existing nodes, but also establish local self-contained structures."
+        )
+        
+        user_prompt = (
+            f"User Intent: \"{user_intent}\"\n"
+            f"**Global Backbone Context**: {backbone_context_str}\n\n"
+            f"Current Text Fragment ({chunk['id']}):\n"
+            f"```\n{chunk['text']}\n```\n\n"
+            "Task:\n"
+            "1. **PRIORITY 1 - Anchor to Backbone**: Identify how entities in this text relate to the 'Global Backbone Context'. Create edges connecting local entities to these Backbone Nodes.\n"
+            "2. **PRIORITY 2 - Local Structure**: Extract important entities/relationships that are defined LOCALLY in this text, even if they don't directly touch the Backbone yet.\n"
+            "3. **Completeness**: Do not ignore a valid relationship just because it's not in the backbone.\n\n"
+            "4. **Find As More Nodes And Edges As You Can**"
+            "Output JSON:\n"
+            "{\n"
+            "  \"nodes\": [{\"id\": \"EntityName\", \"desc\": \"Contextual definition\"}],\n"
+            "  \"edges\": [{\"src\": \"Source\", \"dst\": \"Target\", \"desc\": \"Relation\"}]\n"
+            "}"
+        )
+        return system_prompt, user_prompt
+
+    def _stage2_apply(self, chunk: Dict, resp: str) -> bool:
+        """解析 Layer 2 响应并写入图谱"""
+        try:
+            # === 🛠️ [DEBUG] 打印原始响应的前50个字符，看看是不是根本没返回 JSON ===
+            # print(f"   [Raw Resp Snippet] {resp[:50].replace('\n', ' ')}...") 
+            
+            cleaned_resp = clean_json_response(resp) # 建议把 clean 拿出来单独赋值，方便调试
+            data = json.loads(cleaned_resp)
+            
+            # 图写入
+            with self.lock:
+                self._update_graph(data, chunk_id=chunk['id'], weight_boost=5.0)
+            return True
+            
+        except json.JSONDecodeError as je:
+            # 🚨 这是最常见的错误：LLM 返回的不是合法 JSON
+            print(f"   ❌ [Stage 2 JSON Error] Chunk: {chunk['id']}")
+            print(f"      -> Resp received: {resp}") # 打印出来看看它到底回了什么鬼
+            return False
+        except Exception as e:
+            # 🚨 其他错误（网络超时等）
+            print(f"   ❌ [Stage 2 Error] Chunk {chunk['id']}: {e}")
+            return False
+
+    async def _stage2_async(self, backbone_context_str: str, user_intent: str):
+        """
+        Layer 2 的异步实现：所有 Big Chunk 的请求在同一个事件循环里并发，
+        信号量限制在途请求数 (LLM_MAX_INFLIGHT)
+        """
+        sem = asyncio.Semaphore(LLM_MAX_INFLIGHT)
+        completed_count = 0
+
+        async with make_async_http_client() as http:
+            client = self.local_extractor.async_client(http)
+
+            async def process_single_chunk(chunk):
+                nonlocal completed_count
+                system_prompt, user_prompt = self._stage2_prompts(chunk, backbone_context_str, user_intent)
+                async with sem:
+                    resp = await self.local_extractor.achat(
+                        client,
+                        messages=[{"role": "user", "content": user_prompt}],
+                        system_prompt=system_prompt,
+                        json_mode=True
+                    )
+                ok = self._stage2_apply(chunk, resp)
+                completed_count += 1
+                if completed_count % 2 == 0:
+                    print(f"   Processed {completed_count}/{len(self.big_chunks)} big chunks...", end='\r')
+                return ok
+
+            return await asyncio.gather(*(process_single_chunk(chunk) for chunk in self.big_chunks))
+
     def _stage2_intermediate_enrichment(self, backbone_nodes: List[Dict], user_intent: str):
         """
-        [Layer 2 - Concurrent] 中层填充 (多线程并发版)
+        [Layer 2 - Concurrent] 中层填充 (异步并发版，线程池为后备)
         """
         print(f"\n🌉 [Layer 2] Intermediate Structure Enrichment ({len(self.big_chunks)} Big Chunks)...")
         
         # 准备上下文 (只读操作，不需要锁)
         backbone_ids = [n['id'] for n in backbone_nodes]
         backbone_context_str = ", ".join(backbone_ids[:50])
+
+        # 优先走 asyncio：单线程事件循环承载全部在途请求
+        # 调用方自身运行在事件循环里时 asyncio.run 不可用，回退到线程池
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            asyncio.run(self._stage2_async(backbone_context_str, user_intent))
+            print(f"\n   ✅ Layer 2 Complete.")
+            return
         
         # 定义单个 Chunk 的处理任务
         def process_single_chunk(chunk):
-            system_prompt = (
-                "You are a Structural Engineer. Your goal is to Bridge local details to the Global Backbone."
-                "Prioritize connecting to existing nodes, but also establish local self-contained structures."
-            )
-            
-            user_prompt = (
-                f"User Intent: \"{user_intent}\"\n"
-                f"**Global Backbone Context**: {backbone_context_str}\n\n"
-                f"Current Text Fragment ({chunk['id']}):\n"
-                f"```\n{chunk['text']}\n```\n\n"
-                "Task:\n"
-                "1. **PRIORITY 1 - Anchor to Backbone**: Identify how entities in this text relate to the 'Global Backbone Context'. Create edges connecting local entities to these Backbone Nodes.\n"
-                "2. **PRIORITY 2 - Local Structure**: Extract important entities/relationships that are defined LOCALLY in this text, even if they don't directly touch the Backbone yet.\n"
-                "3. **Completeness**: Do not ignore a valid relationship just because it's not in the backbone.\n\n"
-                "4. **Find As More Nodes And Edges As You Can**"
-                "Output JSON:\n"
-                "{\n"
-                "  \"nodes\": [{\"id\": \"EntityName\", \"desc\": \"Contextual definition\"}],\n"
-                "  \"edges\": [{\"src\": \"Source\", \"dst\": \"Target\", \"desc\": \"Relation\"}]\n"
-                "}"
-            )
-            
+            system_prompt, user_prompt = self._stage2_prompts(chunk, backbone_context_str, user_intent)
             try:
                 # 1. 网络请求
-                resp = self.local_extractor.chat(
-                    messages=[{"role": "user", "content": user_prompt}],
-                    system_prompt=system_prompt,
-                    json_mode=True
-                )
-                
-                # === 🛠️ [DEBUG] 打印原始响应的前50个字符，看看是不是根本没返回 JSON ===
-                # print(f"   [Raw Resp Snippet] {resp[:50].replace('\n', ' ')}...") 
-                
-                cleaned_resp = clean_json_response(resp) # 建议把 clean 拿出来单独赋值，方便调试
-                data = json.loads(cleaned_resp)
-                
-                # 2. 图写入
-                with self.lock:
-                    self._update_graph(data, chunk_id=chunk['id'], weight_boost=5.0)
-                return True
-                
-            except json.JSONDecodeError as je:
-                # 🚨 这是最常见的错误：LLM 返回的不是合法 JSON
-                print(f"   ❌ [Stage 2 JSON Error] Chunk: {chunk['id']}")
-                print(f"      -> Resp received: {resp}") # 打印出来看看它到底回了什么鬼
-                return False
+                with self._llm_slots:
+                    resp = self.local_extractor.chat(
+                        messages=[{"role": "user", "content": user_prompt}],
+                        system_prompt=system_prompt,
+                        json_mode=True
+                    )
             except Exception as e:
-                # 🚨 其他错误（网络超时等）
                 print(f"   ❌ [Stage 2 Error] Chunk {chunk['id']}: {e}")
                 return False
+            # 2. 图写入
+            return self._stage2_apply(chunk, resp)
 
-        # 使用线程池并发执行
-        # max_workers 建议设为 5-10，太高会触发 API Rate Limit
-        with ThreadPoolExecutor(max_workers=8) as executor:
-            # 提交所有任务
-            futures = [executor.submit(process_single_chunk, chunk) for chunk in self.big_chunks]
-            
-            # 等待完成并显示简单进度
-            completed_count = 0
-            for future in as_completed(futures):
-                completed_count += 1
-                if completed_count % 2 == 0:
-                    print(f"   Processed {completed_count}/{len(self.big_chunks)} big chunks...", end='\r')
+        # 使用共享线程池并发执行 (并发上限见 LLM_CONCURRENCY / LLM_MAX_INFLIGHT)
+        # 注意：必须先提交全部任务再等待结果，在提交循环里调用 result() 会退化成串行
+        futures = [self._pool.submit(process_single_chunk, chunk) for chunk in self.big_chunks]
+        
+        # 等待完成并显示简单进度
+        completed_count = 0
+        for future in as_completed(futures):
+            completed_count += 1
+            if completed_count % 2 == 0:
+                print(f"   Processed {completed_count}/{len(self.big_chunks)} big chunks...", end='\r')
         
         print(f"\n   ✅ Layer 2 Complete.")
 
@@ -294,6 +384,12 @@ class LightGraphRAG:
         )
         focus_targets = sorted_nodes
         print(f"   🎯 Focus Targets: {focus_targets[:5]}... (Total {len(focus_targets)})")
+
+        # 检索所需的数据在提交任务前一次性准备好，而不是每个 Focus Node 各算一遍：
+        # Small Chunk 向量矩阵构建一次；所有 Focus Node 的查询文本一次批量编码
+        chunk_index = self._build_small_chunk_index()
+        focus_queries = [f"{n}: {self.graph.nodes[n].get('description', '')}" for n in focus_targets]
+        focus_vecs = dict(zip(focus_targets, self._encode_texts(focus_queries)))
         
         # 线程安全的去重集合
         processed_chunk_ids = set()
@@ -309,8 +405,9 @@ class LightGraphRAG:
                 
             rich_query = f"{focus_node_id}: {node_desc}"
             
-            # 检索 (只读，并发安全)
-            hits = self._search_small_chunks(query=rich_query, top_k=50)
+            # 检索 (只读，并发安全)；查询向量取自提交前的批量编码结果
+            hits = self._search_small_chunks(query=rich_query, top_k=50,
+                                             query_vec=focus_vecs.get(focus_node_id), index=chunk_index)
             
             tasks_run = 0
             for chunk in hits:
@@ -325,15 +422,14 @@ class LightGraphRAG:
                 tasks_run += 1
             return tasks_run
 
-        # 并发执行
-        with ThreadPoolExecutor(max_workers=8) as executor:
-            futures = [executor.submit(process_single_focus_node, target) for target in focus_targets]
-            
-            # 等待结果
-            total_chunks_analyzed = 0
-            for future in as_completed(futures):
-                total_chunks_analyzed += future.result()
-                print(f"   Drilling down... ({total_chunks_analyzed} chunks analyzed)", end='\r')
+        # 并发执行 (先全部提交，再按完成顺序收集结果)
+        futures = [self._pool.submit(process_single_focus_node, target) for target in focus_targets]
+        
+        # 等待结果
+        total_chunks_analyzed = 0
+        for future in as_completed(futures):
+            total_chunks_analyzed += future.result()
+            print(f"   Drilling down... ({total_chunks_analyzed} chunks analyzed)", end='\r')
 
         print(f"\n   ✅ Layer 3 Complete. Analyzed {len(processed_chunk_ids)} unique small chunks.")
 
@@ -366,11 +462,12 @@ class LightGraphRAG:
         
         try:
             # LLM 推理
-            resp = self.local_extractor.chat(
-                messages=[{"role": "user", "content": user_prompt}],
-                system_prompt=system_prompt,
-                json_mode=True
-            )
+            with self._llm_slots:
+                resp = self.local_extractor.chat(
+                    messages=[{"role": "user", "content": user_prompt}],
+                    system_prompt=system_prompt,
+                    json_mode=True
+                )
             
             # === 🛠️ [DEBUG] 检查响应 ===
             if not resp:
@@ -480,17 +577,108 @@ class LightGraphRAG:
     # Phase 4: Graph Optimization (Backbone-Centric Rewiring)
     # =========================================================================
 
+    def _merge_similar_entities(self, protected: Set[str], threshold: float = ENTITY_MERGE_THRESHOLD):
+        """
+        按实体 (名称 + 描述) 的向量相似度合并近似重复的节点 (如大小写、单复数不同的同一概念)。
+        重要度低的节点并入重要度高的节点，沿用 _merge_nodes 的边转移与属性合并逻辑。
+        :param protected: 受保护的节点 (Stage 1 主干)：两个主干节点之间不合并，主干节点只作为合并目标
+        """
+        if not self.embed_model: return
+        names = list(self.graph.nodes())
+        if len(names) < 2: return
+
+        # 只比名称时 "Layer 1"/"Layer 2" 这类不同实体相似度也很高，因此带上描述一起编码
+        texts = [f"{n}: {self.graph.nodes[n].get('description', '')}" for n in names]
+        emb = np.asarray(self._encode_texts(texts), dtype=np.float32)
+        # 分块计算 emb @ emb.T 的上三角部分，找出相似度超过阈值的实体对
+        pairs = []
+        for start in range(0, len(names), ENTITY_SIM_BLOCK):
+            block = emb[start:start + ENTITY_SIM_BLOCK] @ emb.T
+            rows, cols = np.nonzero(block > threshold)
+            for r, c in zip(rows.tolist(), cols.tolist()):
+                i = start + r
+                if c > i:
+                    pairs.append((float(block[r, c]), i, c))
+        if not pairs: return
+
+        # 相似度高的先合并；alias 记录已被并入的节点，处理 A->B->C 这样的链式合并
+        pairs.sort(reverse=True)
+        alias = {}
+        def resolve(n):
+            while n in alias:
+                n = alias[n]
+            return n
+
+        merged = 0
+        for _, i, j in pairs:
+            a, b = resolve(names[i]), resolve(names[j])
+            if a == b: continue
+            # 数字/版本号不同的视为不同实体；两个主干节点之间不合并
+            if ENTITY_NUMBER_RE.findall(a) != ENTITY_NUMBER_RE.findall(b): continue
+            if a in protected and b in protected: continue
+            imp_a = self.graph.nodes[a].get('importance', 0)
+            imp_b = self.graph.nodes[b].get('importance', 0)
+            src, tgt = (b, a) if imp_a >= imp_b else (a, b)
+            # 主干节点只能作为合并目标
+            if src in protected:
+                src, tgt = tgt, src
+            self._merge_nodes(src, tgt, protected)
+            alias[src] = tgt
+            merged += 1
+
+        print(f"   🔗 [Entity Merge] Merged {merged} near-duplicate entities (sim > {threshold}).")
+        self.graph_version += 1
+
+    def _uf_find(self, x):
+        """并查集查找 (路径减半)；未登记的节点视为独立分量"""
+        parent = self._uf
+        root = parent.setdefault(x, x)
+        while root != parent[root]:
+            parent[root] = parent[parent[root]]
+            root = parent[root]
+        return root
+
+    def _uf_union(self, a, b):
+        ra, rb = self._uf_find(a), self._uf_find(b)
+        if ra == rb: return
+        # 按秩合并
+        if self._uf_rank.get(ra, 0) < self._uf_rank.get(rb, 0):
+            ra, rb = rb, ra
+        self._uf[rb] = ra
+        if self._uf_rank.get(ra, 0) == self._uf_rank.get(rb, 0):
+            self._uf_rank[ra] = self._uf_rank.get(ra, 0) + 1
+
+    def _uf_rebuild(self):
+        """按当前图重建并查集 (边视为无向，对应弱连通分量)"""
+        self._uf = {n: n for n in self.graph.nodes()}
+        self._uf_rank = {}
+        for u, v in self.graph.edges():
+            self._uf_union(u, v)
+        self._uf_dirty = False
+
+    def _weak_components(self) -> List[Set[str]]:
+        """由并查集分组得到弱连通分量；有节点被删除过 (分量可能分裂) 时先重建"""
+        if self._uf_dirty:
+            self._uf_rebuild()
+        groups = defaultdict(set)
+        for n in self.graph.nodes():
+            groups[self._uf_find(n)].add(n)
+        return list(groups.values())
+
     def _stage4_graph_optimization(self, max_iterations: int = 3):
         """
         Stage 4: 图谱结构优化
         基于连通分量分析，清洗噪音，合并同义词，强制连通孤岛。
         """
         print(f"\n⚡ [Stage 4] Graph Optimization (Backbone-Centric Rewiring)...")
+        # 连通性用并查集增量维护：CONNECT/MERGE 只会合并分量，直接 union；
+        # 只有 DELETE 可能拆分分量，此时标记为脏，下一轮再整体重建一次
+        self._uf_rebuild()
         
         for i in range(max_iterations):
             # 1. 提取弱连通分量 (针对 DiGraph)
             # 弱连通意味着把边看作无向时是连通的，这符合我们对“孤岛”的定义
-            components = list(nx.weakly_connected_components(self.graph))
+            components = self._weak_components()
             
             if len(components) <= 1:
                 print("   ✅ Graph is fully connected. Optimization finished.")
@@ -499,27 +687,26 @@ class LightGraphRAG:
             # 按节点数量排序，最大的为主干
             components.sort(key=len, reverse=True)
             backbone_nodes = components[0]
-            fragment_nodes = set().union(*components[1:])
+            fragment_count = sum(len(c) for c in components[1:])
             
             # 如果主干太小（比如刚开始构建），可能不需要优化，或者逻辑不同
             if len(backbone_nodes) < 3:
                 print("   ⚠️ Graph too small to optimize.")
                 break
 
-            print(f"   🔄 [Iter {i+1}] Backbone: {len(backbone_nodes)} nodes | Fragments: {len(components)-1} clusters | Orphan Nodes: {len(fragment_nodes)}")
+            print(f"   🔄 [Iter {i+1}] Backbone: {len(backbone_nodes)} nodes | Fragments: {len(components)-1} clusters | Orphan Nodes: {fragment_count}")
 
             # 2. 准备上下文 (Backbone Context)
             # 采样一些 Backbone 的核心边，让 LLM 知道主干里有什么
-            backbone_subgraph = self.graph.subgraph(backbone_nodes)
-            # 优先选择 importance 高的节点的边
-            sorted_edges = sorted(backbone_subgraph.edges(data=True), 
-                                  key=lambda x: self.graph.nodes[x[0]].get('importance', 0) + self.graph.nodes[x[1]].get('importance', 0), 
-                                  reverse=True)
+            # 弱连通分量内节点的出边必然都落在分量内部，直接取出边即可，无需构建 subgraph 视图
+            # 优先选择 importance 高的节点的边 (限制 Token，只给 Top 100 边)
+            # 有界堆只保留前 100 条，不必对主干的全部边排序
+            node_attrs = self.graph.nodes
+            top_edges = heapq.nlargest(100, self.graph.out_edges(backbone_nodes, data=True),
+                                       key=lambda x: node_attrs[x[0]].get('importance', 0) + node_attrs[x[1]].get('importance', 0))
             
             backbone_desc_lines = []
-            for u, v, d in sorted_edges[:100]: # 限制 Token，只给 Top 100 边
-                u_desc = self.graph.nodes[u].get('description', '')[:50]
-                v_desc = self.graph.nodes[v].get('description', '')[:50]
+            for u, v, d in top_edges:
                 rel = d.get('description', 'related')[:30]
                 backbone_desc_lines.append(f"({u}) --[{rel}]--> ({v})")
             
@@ -527,30 +714,25 @@ class LightGraphRAG:
 
             # 3. 准备目标数据 (Fragment Context)
             # 对于孤岛，我们需要把它们的内容发给 LLM
-            fragment_subgraph = self.graph.subgraph(fragment_nodes)
-            fragment_lines = []
-            
-            # 提取碎片中的边
-            for u, v, d in list(fragment_subgraph.edges(data=True))[:80]:
-                u_desc = self.graph.nodes[u].get('description', 'No desc')
-                v_desc = self.graph.nodes[v].get('description', 'No desc')
-                fragment_lines.append(f"EDGE: ({u} [desc: {u_desc}]) --[{d.get('description','?')}]--> ({v})")
+            # 各碎片相对主干的处理互不依赖：按分量大小分组，每组一个请求 (最多 STAGE4_MAX_REQUESTS 组)
+            fragments = components[1:1 + STAGE4_FRAGMENTS_PER_REQUEST * STAGE4_MAX_REQUESTS]
+            fragment_strs = [self._describe_fragments(fragments[k:k + STAGE4_FRAGMENTS_PER_REQUEST])
+                             for k in range(0, len(fragments), STAGE4_FRAGMENTS_PER_REQUEST)]
+            fragment_strs = [fs for fs in fragment_strs if fs.strip()]
             
-            # 提取碎片中的孤立点 (没有边的点)
-            isolates = [n for n in fragment_nodes if fragment_subgraph.degree(n) == 0]
-            for node in isolates[:30]:
-                desc = self.graph.nodes[node].get('description', 'No desc')
-                fragment_lines.append(f"NODE: {node} [desc: {desc}]")
-                
-            fragment_str = "\n".join(fragment_lines)
-            
-            if not fragment_str.strip():
+            if not fragment_strs:
                 print("   -> No meaningful fragments found. Cleaning leftovers.")
                 self.graph.remove_nodes_from(list(nx.isolates(self.graph)))
                 continue
 
-            # 4. LLM 决策
-            self._execute_optimization_prompt(backbone_str, fragment_str, backbone_nodes)
+            # 4. LLM 决策：各组并发请求，收齐后在图锁内统一应用
+            # (保护主干的判断都基于本轮开始时的 backbone_nodes 快照)
+            futures = [self._pool.submit(self._request_optimization_ops, backbone_str, fs) for fs in fragment_strs]
+            all_ops = []
+            for future in as_completed(futures):
+                all_ops.extend(future.result())
+            with self.lock:
+                self._apply_optimization_ops(all_ops, backbone_nodes)
             self.graph_version += 1
 
         # 最终清理：移除仍然无法连接的微小孤立点
@@ -559,8 +741,32 @@ class LightGraphRAG:
             self.graph.remove_nodes_from(final_isolates)
             print(f"   🧹 Final Cleanup: Removed {len(final_isolates)} stubborn isolated nodes.")
 
-    def _execute_optimization_prompt(self, backbone_str, fragment_str, backbone_nodes):
-        """执行优化指令并应用修改"""
+    def _describe_fragments(self, fragments: List[Set[str]], max_edges: int = 80, max_isolates: int = 30) -> str:
+        """
+        一次遍历碎片分量，同时收集碎片内的边 (最多 max_edges 条) 和孤立点 (最多 max_isolates 个)。
+        单节点分量即孤立点 (除非带自环)；多节点分量的出边都在分量内部，直接取出边，无需构建 subgraph。
+        """
+        edge_lines, node_lines = [], []
+        for comp in fragments:
+            if len(edge_lines) >= max_edges and len(node_lines) >= max_isolates:
+                break
+            if len(comp) == 1:
+                (node,) = comp
+                if self.graph.degree(node) == 0:
+                    if len(node_lines) < max_isolates:
+                        desc = self.graph.nodes[node].get('description', 'No desc')
+                        node_lines.append(f"NODE: {node} [desc: {desc}]")
+                    continue
+            # 提取碎片中的边
+            for u, v, d in self.graph.out_edges(comp, data=True):
+                if len(edge_lines) >= max_edges:
+                    break
+                u_desc = self.graph.nodes[u].get('description', 'No desc')
+                edge_lines.append(f"EDGE: ({u} [desc: {u_desc}]) --[{d.get('description','?')}]--> ({v})")
+        return "\n".join(edge_lines + node_lines)
+
+    def _request_optimization_ops(self, backbone_str, fragment_str) -> List[Dict]:
+        """请求 LLM 给出一组碎片的优化指令 (只读，不改图，可并发调用)"""
         system_prompt = "You are a Knowledge Graph Cleaner & Linker."
         
         user_prompt = (
@@ -587,20 +793,27 @@ class LightGraphRAG:
         )
         
         try:
-            resp = self.local_extractor.chat(
-                messages=[{"role": "user", "content": user_prompt}],
-                system_prompt=system_prompt,
-                json_mode=True
-            )
+            with self._llm_slots:
+                resp = self.local_extractor.chat(
+                    messages=[{"role": "user", "content": user_prompt}],
+                    system_prompt=system_prompt,
+                    json_mode=True
+                )
             data = json.loads(clean_json_response(resp))
-            ops = data.get("operations", [])
-            
-            if not ops: 
-                print("   -> LLM suggests no changes.")
-                return
+            return data.get("operations", [])
+        except Exception as e:
+            print(f"   ⚠️ Optimization step failed: {e}")
+            return []
 
-            print(f"   -> Executing {len(ops)} operations...")
-            
+    def _apply_optimization_ops(self, ops: List[Dict], backbone_nodes):
+        """应用优化指令 (调用方需持有 self.lock)；backbone_nodes 为本轮开始时的主干快照"""
+        if not ops: 
+            print("   -> LLM suggests no changes.")
+            return
+
+        print(f"   -> Executing {len(ops)} operations...")
+        
+        try:
             for op in ops:
                 op_type = op.get("type", "").upper()
                 
@@ -609,6 +822,7 @@ class LightGraphRAG:
                         if n in backbone_nodes: continue # 保护主干
                         if self.graph.has_node(n):
                             self.graph.remove_node(n)
+                            self._uf_dirty = True
                             
                 elif op_type == "MERGE":
                     src = op.get("source")
@@ -622,6 +836,7 @@ class LightGraphRAG:
                     weight = op.get("weight", 2.0)
                     if self.graph.has_node(src) and self.graph.has_node(tgt):
                         self.graph.add_edge(src, tgt, description=desc, weight=weight, source_chunk_id="optimization")
+                        self._uf_union(src, tgt)
 
         except Exception as e:
             print(f"   ⚠️ Optimization step failed: {e}")
@@ -652,7 +867,8 @@ class LightGraphRAG:
         if len(src_node.get('description', '')) > len(tgt_node.get('description', '')):
             tgt_node['description'] = src_node['description']
 
-        # 2. Transfer Edges
+        # 2. Transfer Edges (src 的邻居全部转接到 tgt 上，连通性上等价于把 src 所在分量并入 tgt)
+        self._uf_union(src, tgt)
         # Out edges: src -> nbr  ==>  tgt -> nbr
         for _, nbr, data in list(self.graph.out_edges(src, data=True)):
             if nbr == tgt: continue # 避免自环
@@ -694,6 +910,8 @@ class LightGraphRAG:
         # Step 3: Layer 3 - Local Drill-down
         self._stage3_local_drilldown(user_intent)
         self.graph_version +=1
+        # Step 3.5: 本地合并同义实体 (一次批量编码 + 矩阵乘)，减少 Stage 4 需要 LLM 处理的碎片
+        self._merge_similar_entities({n['id'] for n in backbone_nodes if n.get('id')})
         # Step 4: Graph Optimization ---
         self._stage4_graph_optimization(max_iterations=3)
         self.graph_version+=1
@@ -750,12 +968,11 @@ class LightGraphRAG:
         # Step 1: Anchor Identification (Pure Semantic)
         # =================================================
         node_candidates = []
-        for n, attr in self.graph.nodes(data=True):
-            # 组合 "ID + Description" 以捕捉精准语义
-            desc = attr.get('description', 'No description')
-            node_rich_text = f"{n}: {desc}"
-            
-            n_vec = self._get_embedding(node_rich_text)
+        nodes = list(self.graph.nodes(data=True))
+        # 组合 "ID + Description" 以捕捉精准语义
+        descs = [attr.get('description', 'No description') for _, attr in nodes]
+        node_vecs = self._node_embeddings([n for n, _ in nodes], [f"{n}: {desc}" for (n, _), desc in zip(nodes, descs)])
+        for (n, _), desc, n_vec in zip(nodes, descs, node_vecs):
             score = self._cosine_similarity(query_vec, n_vec)
             
             # 语义过滤 (Threshold 0.35)
@@ -775,22 +992,22 @@ class LightGraphRAG:
         # =================================================
         # Step 2: Subgraph Expansion (Contextualization)
         # =================================================
+        # 锚点集合：后续的成员判断都用集合，O(1)
+        anchor_set = set(anchor_ids)
         subgraph_nodes = set(anchor_ids)
         edge_context = []
         
         for anchor in anchor_ids:
-            # Outgoing Edges
-            for nbr in self.graph.successors(anchor):
+            # Outgoing Edges (邻接表直接带出边属性，无需再按 (u, v) 查一次)
+            for nbr, attr in self.graph.succ[anchor].items():
                 if nbr not in subgraph_nodes:
                     subgraph_nodes.add(nbr)
-                    attr = self.graph.edges[anchor, nbr]
                     edge_context.append(f"• {anchor} -> {nbr}: {attr.get('description','')}")
             
             # Incoming Edges (溯源)
-            for nbr in self.graph.predecessors(anchor):
+            for nbr, attr in self.graph.pred[anchor].items():
                 if nbr not in subgraph_nodes:
                     subgraph_nodes.add(nbr)
-                    attr = self.graph.edges[nbr, anchor]
                     edge_context.append(f"• {nbr} -> {anchor}: {attr.get('description','')}")
 
         # =================================================
@@ -811,7 +1028,7 @@ class LightGraphRAG:
                 # 打分逻辑
                 score = 1.0
                 # A. Anchor Bonus: 包含核心锚点
-                if node in anchor_ids:
+                if node in anchor_set:
                     score += 2.0
                 
                 # B. Granularity Bonus: 小切片优先
@@ -839,8 +1056,8 @@ class LightGraphRAG:
         final_context.append("\n### 🕸️ Graph Logic Pathways")
         if edge_context:
             # 排序：优先展示描述更长、更详细的边
-            sorted_edges = sorted(list(set(edge_context)), key=lambda x: len(x), reverse=True)
-            final_context.extend(sorted_edges[:15]) # 展示 Top 15 条边
+            # 有界堆只取 Top 15，不必对全部边排序
+            final_context.extend(heapq.nlargest(15, set(edge_context), key=len)) # 展示 Top 15 条边
         else:
             final_context.append("(No explicit relationships found in subgraph)")
 
@@ -852,8 +1069,8 @@ class LightGraphRAG:
             
             # 获取该 Chunk 命中的图谱实体，辅助 LLM 理解这段话的重点
             hit_nodes = chunk_to_entities.get(cid, [])
-            hit_anchors = [n for n in hit_nodes if n in anchor_ids]
-            other_hits = [n for n in hit_nodes if n not in anchor_ids][:5] # 限制显示数量
+            hit_anchors = [n for n in hit_nodes if n in anchor_set]
+            other_hits = [n for n in hit_nodes if n not in anchor_set][:5] # 限制显示数量
             
             header_info = f"**[Source ID: {cid}]**"
             if hit_anchors:
@@ -871,17 +1088,53 @@ class LightGraphRAG:
     # Helpers
     # =========================================================================
 
-    def _search_small_chunks(self, query: str, top_k: int = 3) -> List[Dict]:
-        """Utility for Layer 3"""
+    def _build_small_chunk_index(self) -> Tuple[List[Dict], np.ndarray]:
+        """把已编码的 Small Chunk 向量堆成矩阵，检索时一次矩阵乘即可算出全部相似度"""
+        indexed = [c for c in self.small_chunks if c.get('vec') is not None]
+        matrix = np.stack([c['vec'] for c in indexed]) if indexed else np.zeros((0, 1024))
+        return indexed, matrix
+
+    def _search_small_chunks(self, query: str, top_k: int = 3, query_vec: Optional[np.ndarray] = None,
+                             index: Optional[Tuple[List[Dict], np.ndarray]] = None) -> List[Dict]:
+        """
+        Utility for Layer 3
+        :param query_vec: 已编码好的查询向量 (可选，省去一次模型调用)
+        :param index: _build_small_chunk_index 的结果 (可选，批量检索时复用)
+        """
         if not self.small_chunks: return []
-        q_vec = self._get_embedding(query)
-        scores = []
-        for c in self.small_chunks:
-            if c['vec'] is None: continue
-            s = self._cosine_similarity(q_vec, c['vec'])
-            scores.append((s, c))
-        scores.sort(key=lambda x: x[0], reverse=True)
-        return [c for s, c in scores[:top_k]]
+        q_vec = query_vec if query_vec is not None else self._get_embedding(query)
+        indexed, matrix = index if index is not None else self._build_small_chunk_index()
+        if not indexed: return []
+        scores = matrix @ q_vec
+        k = min(top_k, len(indexed))
+        # 先 argpartition 取出前 k 个，再只对这 k 个排序
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind='stable')]
+        return [indexed[i] for i in top]
+
+    def _node_embeddings(self, node_ids: List[str], texts: List[str]) -> List[np.ndarray]:
+        """
+        节点向量 (带缓存)：只对新增或描述变化过的节点调用模型，其余直接复用上次的向量。
+        缓存按本次的节点集合重建，已删除节点的向量随之丢弃。
+        """
+        cache = self._node_vecs
+        missing = [i for i, (n, text) in enumerate(zip(node_ids, texts))
+                   if n not in cache or cache[n][0] != text]
+        fresh = self._encode_texts([texts[i] for i in missing]) if missing else []
+        updated = {n: cache[n] for n in node_ids if n in cache}
+        for i, vec in zip(missing, fresh):
+            updated[node_ids[i]] = (texts[i], vec)
+        self._node_vecs = updated
+        return [updated[n][1] for n in node_ids]
+
+    def _encode_texts(self, texts: List[str]) -> np.ndarray:
+        """
+        批量编码 (归一化向量)。SentenceTransformer.encode 内部已按文本长度排序分批再还原顺序，
+        长短文本不会混在同一批里造成大量 padding。
+        """
+        if not self.embed_model: return np.zeros((len(texts), 1024))
+        return self.embed_model.encode(texts, batch_size=ENCODE_BATCH_SIZE, normalize_embeddings=True,
+                                       show_progress_bar=False, convert_to_numpy=True)
 
     def _get_embedding(self, text: str) -> np.ndarray:
         if not self.embed_model: return np.zeros(1024)
@@ -897,6 +1150,7 @@ class LightGraphRAG:
         """
         # 1. 重置图结构
         self.graph = nx.DiGraph()
+        self._node_vecs = {}
         
         # 2. 重置切片列表
         self.small_chunks = []
@@ -911,30 +1165,35 @@ class LightGraphRAG:
 
     def save_graph(self):
         """
-        保存图谱到 JSON (为了兼容性和可读性)
+        保存图谱到 zstd 压缩的 JSON (紧凑格式，orjson 序列化)
         """
         try:
             # 1. 准备图数据
             # NetworkX 的 node_link_data 可以把图转为 JSON 友好的字典
-            # 但我们需要先处理 Set 类型的属性，因为 JSON 不支持 Set
-            G_export = self.graph.copy()
-            for n in G_export.nodes():
-                # Set -> List
-                s = G_export.nodes[n].get('source_chunks', set())
-                G_export.nodes[n]['source_chunks'] = list(s)
+            # (节点属性字典是新建的浅拷贝，直接改写不影响 self.graph，无需先复制整张图)
+            graph_json_data = nx.node_link_data(self.graph)
+            for node in graph_json_data['nodes']:
+                # JSON 不支持 Set：Set -> List
+                node['source_chunks'] = list(node.get('source_chunks', ()))
             
-            # 转换为字典结构
-            graph_json_data = nx.node_link_data(G_export)
-            
-            # 2. 写入 graph.json
-            with open(os.path.join(self.persist_dir, "graph.json"), "w", encoding='utf-8') as f:
-                json.dump(graph_json_data, f, ensure_ascii=False, indent=2)
+            # 2. 写入 graph.json.zst (zstd 压缩，先写临时文件再原子替换，构建中途失败不会留下半个文件)
+            raw = orjson.dumps(graph_json_data, option=orjson.OPT_NON_STR_KEYS)
+            zst_path = os.path.join(self.persist_dir, GRAPH_ZST_FILE)
+            with open(zst_path + ".tmp", "wb") as f:
+                f.write(zstd.ZstdCompressor(level=GRAPH_ZSTD_LEVEL).compress(raw))
+            os.replace(zst_path + ".tmp", zst_path)
+            # 旧版未压缩文件已被取代，删除以免占用空间
+            legacy_path = os.path.join(self.persist_dir, GRAPH_FILE)
+            if os.path.exists(legacy_path):
+                os.remove(legacy_path)
             
             # 3. 写入 chunks.pkl (向量数据还是推荐 pickle，因 numpy array 转 json 较麻烦)
-            with open(os.path.join(self.persist_dir, "chunks.pkl"), "wb") as f:
-                pickle.dump({"small": self.small_chunks, "big": self.big_chunks}, f)
+            chunk_path = os.path.join(self.persist_dir, "chunks.pkl")
+            with open(chunk_path + ".tmp", "wb") as f:
+                pickle.dump({"small": self.small_chunks, "big": self.big_chunks}, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(chunk_path + ".tmp", chunk_path)
                 
-            print(f"💾 Graph saved to {self.persist_dir}/graph.json")
+            print(f"💾 Graph saved to {zst_path}")
         except Exception as e:
             print(f"❌ Save failed: {e}")
 
@@ -943,13 +1202,21 @@ class LightGraphRAG:
         从 JSON 加载图谱
         """
         try:
-            graph_path = os.path.join(self.persist_dir, "graph.json")
+            zst_path = os.path.join(self.persist_dir, GRAPH_ZST_FILE)
+            graph_path = os.path.join(self.persist_dir, GRAPH_FILE)
             chunk_path = os.path.join(self.persist_dir, "chunks.pkl")
             
-            # 1. 加载图结构
-            if os.path.exists(graph_path):
-                with open(graph_path, 'r', encoding='utf-8') as f:
-                    graph_json_data = json.load(f)
+            # 1. 加载图结构 (优先读压缩文件，没有时回退到旧版 graph.json)
+            raw = None
+            if os.path.exists(zst_path):
+                with open(zst_path, 'rb') as f:
+                    raw = zstd.ZstdDecompressor().decompress(f.read())
+            elif os.path.exists(graph_path):
+                with open(graph_path, 'rb') as f:
+                    raw = f.read()
+
+            if raw is not None:
+                graph_json_data = orjson.loads(raw)
                 
                 # 恢复图对象 (Directed Graph)
                 self.graph = nx.node_link_graph(graph_json_data, directed=True)
@@ -1,20 +1,40 @@
 
 import json
 import os
+import time
+from functools import lru_cache
+
+# list_projects 结果的缓存时长 (秒)
+PROJECT_LIST_TTL = 1.0
+
+@lru_cache(maxsize=128)
+def _project_dir(projects_root: str, project_name: str) -> str:
+    # 纯函数：同一 (root, name) 的路径永远不变，缓存无需失效
+    return os.path.join(projects_root, project_name)
 
 class ProjectManager:
     def __init__(self,default_project,projects_root):
         self.current_project = default_project
         self.projects_root = projects_root
+        self._projects_cache = None
+        self._projects_cache_ts = 0.0
         self.ensure_project_exists(default_project)
+        self._set_current(default_project)
+
+    def _set_current(self, project_name: str):
+        """切换当前项目，并预先算好常用路径"""
+        self.current_project = project_name
+        self.current_dir = _project_dir(self.projects_root, project_name)
+        self.history_file = os.path.join(self.current_dir, "history.json")
+        self.graph_db_dir = os.path.join(self.current_dir, "graph_db")
         
     def get_project_dir(self, project_name: str = None):
         if project_name is None:
-            project_name = self.current_project
-        return os.path.join(self.projects_root, project_name)
+            return self.current_dir
+        return _project_dir(self.projects_root, project_name)
 
     def ensure_project_exists(self, project_name: str):
-        p_dir = os.path.join(self.projects_root, project_name)
+        p_dir = _project_dir(self.projects_root, project_name)
         os.makedirs(os.path.join(p_dir, "uploads"), exist_ok=True)
         os.makedirs(os.path.join(p_dir, "graph_db"), exist_ok=True)
         
@@ -27,19 +47,35 @@ class ProjectManager:
         if not os.path.exists(files_record):
             with open(files_record, "w", encoding="utf-8") as f:
                 json.dump([], f)
-                
+        
+        # 新建项目后让列表缓存失效
+        self._projects_cache = None
         return p_dir
 
     def list_projects(self):
+        now = time.monotonic()
+        if self._projects_cache is not None and now - self._projects_cache_ts < PROJECT_LIST_TTL:
+            return list(self._projects_cache)
+
         if not os.path.exists(self.projects_root):
             return []
-        return [d for d in os.listdir(self.projects_root) if os.path.isdir(os.path.join(self.projects_root, d))]
+        # scandir 的 DirEntry.is_dir() 复用目录读取时的类型信息，避免逐个 stat
+        with os.scandir(self.projects_root) as it:
+            projects = [e.name for e in it if e.is_dir()]
+
+        self._projects_cache = projects
+        self._projects_cache_ts = now
+        return list(projects)
+
+    def project_exists(self, project_name: str) -> bool:
+        # 单次 stat，无需扫描整个项目目录
+        return os.path.isdir(_project_dir(self.projects_root, project_name))
 
     def switch_project(self, project_name: str):
-        if project_name not in self.list_projects():
+        if not self.project_exists(project_name):
             raise ValueError(f"Project {project_name} does not exist")
-        self.current_project = project_name
-        return self.get_project_dir(project_name)
+        self._set_current(project_name)
+        return self.current_dir
 
     def get_file_records(self):
         record_path = os.path.join(self.get_project_dir(), "files.json")
@@ -1,12 +1,20 @@
 import os
 import chromadb
-import torch
 import json
 import uuid
-from typing import List, Dict
-from sentence_transformers import SentenceTransformer
+from typing import List, Dict, Tuple, Optional
+from embedding import get_embedding_model
 from langchain_text_splitters import MarkdownHeaderTextSplitter, RecursiveCharacterTextSplitter
 
+# HNSW 索引参数 (仅在集合首次创建时生效)
+# Chroma 默认 search_ef=10，比检索时的 n_results (top_k*3 ~ top_k*5) 还小，召回偏低
+HNSW_METADATA = {
+    "hnsw:space": "cosine",       # 余弦相似度，最适合文本匹配
+    "hnsw:M": 24,
+    "hnsw:construction_ef": 128,
+    "hnsw:search_ef": 100,
+}
+
 class LocalKnowledgeBase:
     def __init__(self, persist_dir: str = "./.local_rag_db"):
         """
@@ -14,23 +22,17 @@ class LocalKnowledgeBase:
         """
         print("--- 初始化 RAG 引擎 (支持 Q&A Key-Value 模式) ---")
         
-        # 1. 显存够大，直接上 BAAI/bge-m3 (约 2.5GB)，中英文效果顶级
-        # 如果下载慢，请提前下载好模型文件夹，把下面的字符串换成路径
-        model_name = "BAAI/bge-m3"
-        
-        device = "cuda" if torch.cuda.is_available() else "cpu"
-        print(f"正在加载 Embedding 模型 ({model_name}) 到 {device}...")
-        
-        self.encoder = SentenceTransformer(model_name, device=device)
+        # 1. Embedding 模型 (BAAI/bge-m3)：进程内共享，多个知识库不再各自加载一份
+        self.encoder = get_embedding_model()
         
         # 2. 初始化本地向量数据库 (ChromaDB)
+        self.persist_dir = persist_dir
         self.client = chromadb.PersistentClient(path=persist_dir)
         
-        # 获取或创建集合
-        # hnsw:space='cosine' 表示使用余弦相似度，最适合文本匹配
+        # 获取或创建集合 (索引参数见 HNSW_METADATA)
         self.collection = self.client.get_or_create_collection(
             name="general_knowledge",
-            metadata={"hnsw:space": "cosine"}
+            metadata=HNSW_METADATA
         )
         print("引擎就绪。")
 
@@ -84,7 +86,8 @@ class LocalKnowledgeBase:
 
         if documents:
             # normalize_embeddings=True 对余弦相似度检索非常重要
-            embeddings = self.encoder.encode(documents, normalize_embeddings=True).tolist()
+            # 直接把 numpy 矩阵交给 Chroma，省去 .tolist() 逐个装箱成 Python float
+            embeddings = self.encoder.encode(documents, normalize_embeddings=True, convert_to_numpy=True)
             
             self.collection.add(
                 ids=ids,
@@ -94,15 +97,16 @@ class LocalKnowledgeBase:
             )
             print(f"成功入库 {len(documents)} 个片段。")
 
-    def add_qa_mistakes(self, json_path: str):
+    def add_qa_mistakes(self, json_path: str) -> bool:
         """
         核心功能2 (升级版)：Key-Value RAG 模式
         读取 JSON 错题集 -> Embedding(Q) -> Store(A)
         目的：当 Query 匹配到报错信息(Q)时，直接返回修复策略(A)，而非无关文本。
+        :return: 是否加载成功 (文件不存在视为无需加载，返回 True)
         """
         if not os.path.exists(json_path):
             print(f"提示: 错题集文件 {json_path} 不存在，跳过加载。")
-            return
+            return True
 
         print(f"正在加载错题经验: {json_path}")
         try:
@@ -111,7 +115,7 @@ class LocalKnowledgeBase:
                 
             if not isinstance(data, list):
                 print("错题集格式错误: 根节点应为 List")
-                return
+                return False
 
             ids = []
             documents = []  # 存 Answer (修复策略)
@@ -140,7 +144,7 @@ class LocalKnowledgeBase:
 
             if questions:
                 # 核心：向量化的是 Question (报错特征)
-                embeddings = self.encoder.encode(questions, normalize_embeddings=True).tolist()
+                embeddings = self.encoder.encode(questions, normalize_embeddings=True, convert_to_numpy=True)
                 
                 self.collection.add(
                     ids=ids,
@@ -149,16 +153,18 @@ class LocalKnowledgeBase:
                     metadatas=metadatas
                 )
                 print(f"成功加载 {len(documents)} 条错题经验。")
+            return True
                 
         except Exception as e:
             print(f"加载错题集失败: {str(e)}")
+            return False
 
     def add_single_qa(self, q: str, a: str, source: str = "runtime_learning"):
         """
         运行时动态添加单条经验 (Experience Replay)
         """
         try:
-            embedding = self.encoder.encode([q], normalize_embeddings=True).tolist()
+            embedding = self.encoder.encode([q], normalize_embeddings=True, convert_to_numpy=True)
             
             unique_id = f"runtime_mistake_{str(uuid.uuid4())[:8]}"
             
@@ -172,13 +178,62 @@ class LocalKnowledgeBase:
         except Exception as e:
             print(f"动态记录经验失败: {e}")
 
+    def clear_qa_experience(self):
+        """删除所有 Q&A 经验条目 (用于错题集全量重建，避免重复入库)"""
+        try:
+            self.collection.delete(where={"type": "qa_experience"})
+        except Exception as e:
+            print(f"清理经验条目失败: {e}")
+
+    def add_qa_batch(self, pairs: List[Tuple[str, str]], source: str = "runtime_learning", ids: Optional[List[str]] = None) -> bool:
+        """
+        批量添加经验：一次 encode 多条 Question，比逐条 add_single_qa 少很多次模型调用
+        :param ids: 可选的确定性 ID (与 pairs 一一对应)。给定时库里已有的条目直接跳过 (不重复编码)，
+                    其余用 upsert 写入，同一份日志反复加载也不会在持久化集合里堆出重复条目
+        :return: 是否全部入库成功 (调用方据此决定是否推进入库标记)
+        """
+        if ids is None:
+            pairs = [(q, a) for q, a in pairs if q and a]
+        else:
+            # 同一批内重复的 ID 只保留最后一条 (upsert 不允许一批里出现重复 ID)
+            keyed = {pid: (q, a) for pid, (q, a) in zip(ids, pairs) if q and a}
+            ids, pairs = list(keyed), list(keyed.values())
+        if not pairs:
+            return True
+        try:
+            if ids is not None:
+                existing = set(self.collection.get(ids=ids, include=[])["ids"])
+                if existing:
+                    kept = [(pid, pair) for pid, pair in zip(ids, pairs) if pid not in existing]
+                    ids, pairs = [pid for pid, _ in kept], [pair for _, pair in kept]
+                if not pairs:
+                    return True
+
+            questions = [q for q, _ in pairs]
+            embeddings = self.encoder.encode(questions, normalize_embeddings=True, convert_to_numpy=True)
+            
+            records = dict(
+                documents=[a for _, a in pairs],
+                embeddings=embeddings,
+                metadatas=[{"source": source, "type": "qa_experience", "original_q": q} for q in questions]
+            )
+            if ids is None:
+                self.collection.add(ids=[f"{source}_{str(uuid.uuid4())[:8]}" for _ in pairs], **records)
+            else:
+                self.collection.upsert(ids=ids, **records)
+            print(f"已批量记录经验 {len(pairs)} 条。")
+            return True
+        except Exception as e:
+            print(f"批量记录经验失败: {e}")
+            return False
+
     def search(self, query: str, top_k: int = 3) -> List[str]:
         """
         [修正版] 智能去重检索
         修正点：针对 QA 数据，基于 Question (original_q) 去重，防止误删不同错误但修复方案相同的条目。
         """
         # 1. 向量化
-        query_vec = self.encoder.encode([query], normalize_embeddings=True).tolist()
+        query_vec = self.encoder.encode([query], normalize_embeddings=True, convert_to_numpy=True)
         
         # 2. 过采样检索
         results = self.collection.query(
@@ -238,7 +293,7 @@ class LocalKnowledgeBase:
         :param score_threshold: 相似度阈值 (0-1)，低于此值的经验将被忽略。建议 0.35 ~ 0.5 之间。
         """
         # 1. 向量化
-        query_vec = self.encoder.encode([query], normalize_embeddings=True).tolist()
+        query_vec = self.encoder.encode([query], normalize_embeddings=True, convert_to_numpy=True)
         
         # 2. 过采样检索 (为了在过滤和去重后还能凑够 top_k，这里多取一些)
         results = self.collection.query(
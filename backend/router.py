@@ -1,8 +1,9 @@
 import json
 import os
+import hashlib
 from Agent import deepseek_agent
 from rag import LocalKnowledgeBase
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional
 
 class RouterAgent:
     def __init__(self, 
@@ -14,10 +15,15 @@ class RouterAgent:
         self.llm = deepseek_agent(model_name=model_name)
         self.learn_mode = learn_mode
         self.experience_file = experience_file
+        # 离线炼丹 (data_refinery) 追加写入的 JSONL 经验日志
+        self.experience_log = os.path.splitext(experience_file)[0] + ".jsonl"
         
         # 1. 初始化 RAG 引擎 (复用 LocalKnowledgeBase)
         # 注意：这里我们复用 rag.py 的能力，将经验池作为 "QA知识" 加载
         self.rag = LocalKnowledgeBase("./.local_rag_db/router")
+
+        # 已录入场景 (q) 的集合，查重 O(1)，避免每次录入都遍历整个经验库
+        self._known_q = set()
         
         # 2. 加载经验 (冷启动)
         if os.path.exists(self.experience_file):
@@ -25,9 +31,46 @@ class RouterAgent:
             # add_qa_mistakes 本质就是加载 list of {q, a}，完全通用
             # 它会自动忽略 json 里的 'source_code' 字段，只存 q 和 a
             self.rag.add_qa_mistakes(self.experience_file)
+            try:
+                with open(self.experience_file, 'r', encoding='utf-8') as f:
+                    self._known_q = {item.get('q') for item in json.load(f)}
+            except Exception:
+                self._known_q = set()
         else:
             print("⚠️ 未找到经验库文件，Router 将从零开始运行。")
 
+        log_items = self._read_experience_log()
+        if log_items:
+            print(f"🧠 Router 正在加载追加经验日志: {self.experience_log} ({len(log_items)} 条)")
+            # 确定性 ID：重启时重复加载同一份日志只会命中已有条目，不会在持久化集合里越堆越多
+            self.rag.add_qa_batch(
+                [(item["q"], item["a"]) for item in log_items], source="router_jsonl",
+                ids=[f"router_jsonl_{self._log_item_key(item)}" for item in log_items]
+            )
+            self._known_q.update(item["q"] for item in log_items)
+
+    def _read_experience_log(self) -> List[Dict[str, Any]]:
+        """读取 JSONL 经验日志 (坏行跳过)"""
+        items = []
+        if not os.path.exists(self.experience_log):
+            return items
+        with open(self.experience_log, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    item = json.loads(line)
+                except ValueError:
+                    continue
+                if item.get("q") and item.get("a"):
+                    items.append(item)
+        return items
+
+    @staticmethod
+    def _log_item_key(item: Dict[str, Any]) -> str:
+        """日志条目的稳定标识：炼丹记录自带源码哈希 _hash，旧记录退化为 q/a 内容的哈希"""
+        if item.get("_hash"):
+            return item["_hash"]
+        return hashlib.md5(f"{item['q']}\0{item['a']}".encode('utf-8')).hexdigest()
+
     def _load_prompt(self, file_path: str) -> str:
         """加载外部提示词文件"""
         try:
@@ -36,10 +79,18 @@ class RouterAgent:
         except FileNotFoundError:
             return ""
 
-    def route_and_analyze(self, user_content: str, user_target:str = "",use_experience:bool = False) -> Dict[str, Any]:
+    def retrieve_experiences(self, user_target: str, top_k: int = 10) -> List[str]:
+        """
+        经验检索：只依赖用户目标，不依赖上下文。
+        调用方可以把它与上下文构建并发执行，再通过 experiences 参数传回。
+        """
+        return self.rag.search_score(query=user_target, top_k=top_k)
+
+    def route_and_analyze(self, user_content: str, user_target:str = "",use_experience:bool = False, experiences: Optional[List[str]] = None) -> Dict[str, Any]:
         """
         核心功能：分析需求 -> 检索经验 -> 制定策略
         (已重构：内置 Prompt，不再依赖外部文件，统一管理参数)
+        :param experiences: 预先检索好的经验 (可选)，为 None 时在此处检索
         """
         print(f"⚡ Router 正在分析需求 (学习模式: {'开启' if self.learn_mode else '关闭'})...")
 
@@ -48,7 +99,7 @@ class RouterAgent:
         
         experience_section = ""
         if use_experience:
-            retrieved_experiences = self.rag.search_score(query=user_target, top_k=10)
+            retrieved_experiences = experiences if experiences is not None else self.retrieve_experiences(user_target, top_k=10)
             if retrieved_experiences:
                 print(f"   [RAG] 联想到 {len(retrieved_experiences)} 条相关设计思路")
                 
@@ -133,17 +184,18 @@ class RouterAgent:
                 "analysis_content": user_content[:2000]
             }
         
-    def analyze_specific_mode(self, user_content: str, user_target: str, specific_type: str, use_experience:bool = False) -> Dict[str, Any]:
+    def analyze_specific_mode(self, user_content: str, user_target: str, specific_type: str, use_experience:bool = False, experiences: Optional[List[str]] = None) -> Dict[str, Any]:
         """
         【定向分析模式 - 增强版】
         支持 Graphviz (DOT) 及 Mermaid 的深度逻辑提取。
+        :param experiences: 预先检索好的经验 (可选)，为 None 时在此处检索
         """
         print(f"⚡ Router 进入定向分析模式 -> 目标类型: {specific_type}")
         
         # 1. 经验检索 (保持原有逻辑，增强针对性)
         experience_section = ""
         if use_experience:
-            retrieved_experiences = self.rag.search_score(query=user_target, top_k=3)
+            retrieved_experiences = experiences if experiences is not None else self.retrieve_experiences(user_target, top_k=3)
             if retrieved_experiences:
                 print(f"   [RAG] 联想到 {len(retrieved_experiences)} 条相关经验")
                 context_list = "\n".join([f"{idx+1}. {exp}" for idx, exp in enumerate(retrieved_experiences)])
@@ -262,7 +314,9 @@ class RouterAgent:
                 }
                 
                 # 3. 持久化存储 (JSON)
-                self._save_to_disk(new_entry)
+                if not self._save_to_disk(new_entry):
+                    print(f"重复的场景，跳过录入: {new_q}")
+                    return
                 
                 # 4. 运行时热更新 (RAG)
                 # 只需要 q 和 a 即可检索
@@ -272,8 +326,13 @@ class RouterAgent:
         except Exception as e:
             print(f"Router 学习失败: {e}")
 
-    def _save_to_disk(self, new_entry: Dict[str, Any]):
-        """追加写入 JSON 文件"""
+    def _save_to_disk(self, new_entry: Dict[str, Any]) -> bool:
+        """追加写入 JSON 文件，返回是否真正写入 (重复场景返回 False)"""
+        # 简单的查重 (基于 Q)
+        # 实际生产中可能允许同一个 Q 有多种 A，这里简单起见去重
+        if new_entry['q'] in self._known_q:
+            return False # 已存在类似场景，暂不重复录入
+
         current_data = []
         
         # 确保目录存在
@@ -286,16 +345,14 @@ class RouterAgent:
             except:
                 current_data = []
         
-        # 简单的查重 (基于 Q)
-        # 实际生产中可能允许同一个 Q 有多种 A，这里简单起见去重
-        for item in current_data:
-            if item.get('q') == new_entry['q']:
-                return # 已存在类似场景，暂不重复录入
-
         current_data.append(new_entry)
+        self._known_q.add(new_entry['q'])
         
+        # 紧凑格式写入：不缩进，文件更小，下次启动 json.load 也更快
         with open(self.experience_file, 'w', encoding='utf-8') as f:
-            json.dump(current_data, f, ensure_ascii=False, indent=2)
+            json.dump(current_data, f, ensure_ascii=False, separators=(',', ':'))
+        return True
+
     def reload_llm_config(self, config: dict):
         """
         【热更新】接收前端配置(驼峰命名)并更新底层 LLM
@@ -9,10 +9,16 @@ import streamlit as st
 import streamlit.components.v1 as components
 from pyvis.network import Network
 import re
+from functools import lru_cache
 from typing import List, Tuple
 
 # --- 配置 ---
 TEMP_UPLOAD_DIR = "./.temp_uploaded_files"
+VALIDATION_CACHE_SIZE = 2048
+
+# Kroki 校验共用一个 Session：keep-alive 复用 TCP/TLS 连接，修复循环里连续校验不再重复握手
+_kroki_session = requests.Session()
+_kroki_session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=16))
 
 # 定义被视为“纯文本”的扩展名，这些文件会被合并给 GraphRAG
 TEXT_EXTENSIONS = {
@@ -22,41 +28,93 @@ TEXT_EXTENSIONS = {
     '.sql', '.ini', '.conf', '.env'
 }
 
+# 图表类型识别 / 硬规则检查用到的正则 (模块级预编译)
+_GRAPHVIZ_DIGRAPH_RE = re.compile(r'^\s*(strict\s+)?digraph', re.IGNORECASE)
+_GRAPHVIZ_GRAPH_RE = re.compile(r'^\s*(strict\s+)?graph', re.IGNORECASE)
+_CLASSDEF_SUBGRAPH_RE = re.compile(r'classDef\s+subgraph\b', re.IGNORECASE)
+
+# Mermaid 图表类型声明关键字 (小写前缀匹配，宁松勿严：本地只拦截"肯定不合法"的代码)
+MERMAID_DIAGRAM_KEYWORDS = (
+    "graph", "flowchart", "sequencediagram", "classdiagram", "statediagram", "erdiagram",
+    "journey", "gantt", "pie", "quadrantchart", "requirementdiagram", "gitgraph",
+    "c4context", "c4container", "c4component", "c4dynamic", "c4deployment",
+    "mindmap", "timeline", "zenuml", "sankey", "xychart", "block", "packet",
+    "kanban", "architecture", "radar", "treemap",
+)
+
+def _mermaid_header_error(code: str):
+    """
+    本地预检：跳过 front matter / %% 注释与指令后，第一行必须是图表类型声明。
+    能确定不合法时返回与 Mermaid 一致的报错文本 (错题本按报错特征检索)，否则返回 None 交给 Kroki。
+    """
+    lines = iter(code.splitlines())
+    for line in lines:
+        stripped = line.strip()
+        if not stripped or stripped.startswith("%%"):
+            continue
+        if stripped == "---":
+            # YAML front matter：直到下一个 --- 为止
+            if not any(l.strip() == "---" for l in lines):
+                return None  # front matter 未闭合，交给 Kroki 判断
+            continue
+        if stripped.lower().startswith(MERMAID_DIAGRAM_KEYWORDS):
+            return None
+        return "No diagram type detected matching given configuration for text: " + stripped[:80]
+    return "No diagram type detected matching given configuration for text: (empty)"
+
+class _ValidationUnavailable(Exception):
+    """验证服务不可用 (网络异常 / Kroki 5xx)：结果照常返回，但不进缓存"""
+    def __init__(self, result: dict):
+        super().__init__(result.get("error", ""))
+        self.result = result
+
 def quick_validate_mermaid(code: str) -> dict:
     """
     验证图表代码 (支持 Mermaid 和 Graphviz)
     自动识别代码类型并调用对应的 Kroki 接口进行验证
+    同一份代码 (去首尾空白后) 的结论是确定的，按代码缓存，重试/修复循环里省掉重复的网络请求
     """
-    code = code.strip()
-    
+    try:
+        return dict(_validate_diagram_cached(code.strip()))
+    except _ValidationUnavailable as e:
+        return e.result
+
+def clear_validation_cache():
+    """清空校验缓存 (批处理任务开始前调用，让缓存只服务于本轮的代码)"""
+    _validate_diagram_cached.cache_clear()
+
+@lru_cache(maxsize=VALIDATION_CACHE_SIZE)
+def _validate_diagram_cached(code: str) -> dict:
     # --- 1. Graphviz (DOT) 识别与验证 ---
     # 特征：以 digraph 开头，或者以 graph 开头且包含 '{' (区分 Mermaid 的 graph TD)
     # 这里的正则匹配：开头是 (strict )? digraph 或者是 graph ... {
-    is_graphviz = re.match(r'^\s*(strict\s+)?digraph', code, re.IGNORECASE) or \
-                  (re.match(r'^\s*(strict\s+)?graph', code, re.IGNORECASE) and '{' in code)
+    is_graphviz = _GRAPHVIZ_DIGRAPH_RE.match(code) or \
+                  ('{' in code and _GRAPHVIZ_GRAPH_RE.match(code))
 
     if is_graphviz:
         try:
             # 使用 Kroki 的 Graphviz 接口进行验证
-            response = requests.post(
+            response = _kroki_session.post(
                 "https://kroki.io/graphviz/svg",
                 json={"diagram_source": code},
                 timeout=10
             )
-            if response.status_code == 200:
-                return {"valid": True, "error": ""}
-            else:
-                # Graphviz 的报错通常比较详细，直接返回
-                return {"valid": False, "error": f"Graphviz Syntax Error: {response.text}"}
         except Exception as e:
             # 网络或其他异常，暂时放行 (Fail Open) 以免阻碍生成
             print(f"⚠️ Graphviz validation skipped due to network: {e}")
+            raise _ValidationUnavailable({"valid": True, "error": ""})
+        if response.status_code == 200:
             return {"valid": True, "error": ""}
+        result = {"valid": False, "error": f"Graphviz Syntax Error: {response.text}"}
+        if response.status_code >= 500:
+            raise _ValidationUnavailable(result)
+        # Graphviz 的报错通常比较详细，直接返回
+        return result
 
     # --- 2. Mermaid 识别与验证 (原有逻辑) ---
     
     # 硬规则检查：防止 classDef subgraph 关键字冲突
-    if re.search(r'classDef\s+subgraph\b', code, re.IGNORECASE):
+    if _CLASSDEF_SUBGRAPH_RE.search(code):
         error_msg = (
             "Syntax Error (Hard Check): "
             "'subgraph' is a reserved keyword and cannot be used as a class name.\n"
@@ -64,20 +122,27 @@ def quick_validate_mermaid(code: str) -> dict:
             "✅ Fix: Rename it to something else (e.g., classDef subgraphStyle ...)"
         )
         return {"valid": False, "error": error_msg}
+
+    # 本地预检：缺少图表类型声明的代码无需再走一次网络请求
+    header_error = _mermaid_header_error(code)
+    if header_error:
+        return {"valid": False, "error": header_error}
     
     try:
-        response = requests.post(
+        response = _kroki_session.post(
             "https://kroki.io/mermaid/svg",
             json={"diagram_source": code},
             timeout=10
         )
-        if response.status_code == 200:
-            return {"valid": True, "error": ""}
-        else:
-            return {"valid": False, "error": response.text}
     except Exception as e:
         # 网络异常时默认返回有效，防止因验证服务挂了导致整个功能不可用
-        return {"valid": True, "error": f"Validation Warning: {str(e)}"}
+        raise _ValidationUnavailable({"valid": True, "error": f"Validation Warning: {str(e)}"})
+    if response.status_code == 200:
+        return {"valid": True, "error": ""}
+    result = {"valid": False, "error": response.text}
+    if response.status_code >= 500:
+        raise _ValidationUnavailable(result)
+    return result
     
 def save_uploaded_files(uploaded_files):
     """保存上传文件"""